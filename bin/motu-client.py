@@ -35,10 +35,16 @@ import os
 import datetime
 import logging
 import logging.config
+import signal
 
 # Import project libraries
 from motu import utils_log
 from motu import motu_api
+from motu import motu_fanout
+from motu import motu_scheduler
+from motu import utils_cancel
+from motu import utils_metrics
+from motu import utils_netcdf
 
 # The necessary required version of Python interpreter
 REQUIRED_VERSION = (3, 5)
@@ -105,7 +111,7 @@ def load_options(config_file, argv):
                         help="the authentication mode: '" + motu_api.AUTHENTICATION_MODE_NONE +
                              "' (for no authentication),'" + motu_api.AUTHENTICATION_MODE_BASIC +
                              "' (for basic authentication), or'" + motu_api.AUTHENTICATION_MODE_CAS +
-                             "' (for Central Authentication Service) [default: %default]")
+                             "' (for Central Authentication Service) [default: %(default)s]")
 
     parser.add_argument('--proxy-server', type=str,
                         help="the proxy server (url)")
@@ -145,6 +151,11 @@ def load_options(config_file, argv):
     parser.add_argument('--longitude-max', '-X', type=float,
                         help="The max longitude (float in the interval [-180 ; 180])")
 
+    parser.add_argument('--tile-size', type=float,
+                        help="Split the geographic box into tiles of at most this size, requested in parallel "
+                             "and stitched back into the output file (float expressing degrees). "
+                             "Boxes crossing the antimeridian are always split.")
+
     parser.add_argument('--depth-min', '-z', type=str,
                         help="The min depth (float in the interval [0 ; 2e31] or string'Surface')")
 
@@ -185,6 +196,10 @@ def load_options(config_file, argv):
                         help="The block used to download file (integer expressing bytes)",
                         default="65536")
 
+    parser.add_argument('--fsync',
+                        help="Flush the downloaded file to the disk before publishing it under its final name",
+                        action='store_true')
+
     parser.add_argument('--socket-timeout', type=float,
                         help="Set a timeout on blocking socket operations (float expressing seconds)")
     parser.add_argument('--user-agent', type=str,
@@ -197,6 +212,15 @@ def load_options(config_file, argv):
                              "returned by the download request: netcdf or netcdf4. "
                              "If not set, netcdf is used.")
 
+    parser.add_argument('--transcode',
+                        help="Transcode the downloaded NetCDF3 files into compressed and chunked NetCDF4 "
+                             "files, in background processes (requires xarray and netCDF4)",
+                        action='store_true')
+
+    parser.add_argument('--compression-level', type=int,
+                        help="The deflate level of the transcoded files, from 1 (fastest) to 9 (smallest)",
+                        default=utils_netcdf.DEFAULT_COMPRESSION_LEVEL)
+
     parser.add_argument('--console-mode',
                         help="Optional parameter used to display result on stdout, "
                              "either URL path to download extraction file, or the XML "
@@ -204,11 +228,150 @@ def load_options(config_file, argv):
                         action='store_true',
                         dest='console_mode')
 
+    parser.add_argument('--fanout', type=str,
+                        help="Run one job per combination of the given values: each {KEY} placeholder "
+                             "of the service id, product id and output file name is replaced "
+                             "(string following format KEY=VALUE1,VALUE2,...). Can be repeated.",
+                        action='append')
+
+    parser.add_argument('--max-per-server', type=int,
+                        help="The maximum number of fan-out jobs run at the same time on a "
+                             "Motu server (integer)",
+                        default=motu_fanout.DEFAULT_MAX_PER_SERVER)
+
+    parser.add_argument('--priority', type=str,
+                        choices=sorted(motu_scheduler.PRIORITIES),
+                        help="The priority class of the request among the fan-out or daemon jobs "
+                             "[default: normal]")
+
+    parser.add_argument('--size-estimates', type=str,
+                        choices=motu_scheduler.ESTIMATES,
+                        help="How the size of the fan-out or daemon jobs is estimated to run the "
+                             "smallest first: 'history' uses the sizes recorded in the journal, "
+                             "'metadata' also computes it offline from the product description, "
+                             "'getsize' also asks Motu [default: history]")
+
+    parser.add_argument('--snap-to-grid',
+                        help="Snap the bounds of the box, depths and period onto the grid of the "
+                             "product, so that requests selecting the same data share their result",
+                        action='store_true',
+                        default=None)
+
+    parser.add_argument('--metadata-cache', type=str,
+                        help="The directory where the product descriptions used to estimate the "
+                             "size of the requests, and the calibration of the estimates, are kept "
+                             "(string)")
+
+    parser.add_argument('--max-rate', type=float,
+                        help="The maximum download rate of all the transfers, shared by all the "
+                             "concurrent downloads (float expressing bytes per second)")
+
+    parser.add_argument('--max-per-host', type=int,
+                        help="The maximum number of connections opened at the same time on a "
+                             "server (integer)")
+
+    parser.add_argument('--adaptive-concurrency',
+                        help="Let the number of connections per server grow while the throughput "
+                             "scales, and back off on errors or latency spikes",
+                        action='store_true',
+                        default=None)
+
+    parser.add_argument('--ca-bundle', type=str,
+                        help="The file (PEM) of the certificate authorities trusted to check the "
+                             "certificates of the servers (string, the ones of the system if not set)")
+
+    parser.add_argument('--tls-ciphers', type=str,
+                        help="The ciphers allowed with TLS 1.2, in the OpenSSL cipher list format "
+                             "(string, the OpenSSL defaults if not set)")
+
+    parser.add_argument('--speed-limit', type=int,
+                        help="The minimal download speed: a transfer slower than that during "
+                             "--speed-time seconds is resumed on a new connection (integer "
+                             "expressing bytes per second)")
+
+    parser.add_argument('--speed-time', type=int,
+                        help="The time the download speed is measured over (integer expressing "
+                             "seconds, default 30)")
+
+    parser.add_argument('--prewarm',
+                        help="Resolve the servers names, open the first connections to the Motu and CAS "
+                             "servers and log in to CAS concurrently, while the request is prepared",
+                        action='store_true',
+                        default=None)
+
+    parser.add_argument('--event-log', type=str,
+                        help="The file the structured events of the requests (job, phase, bytes, "
+                             "latency) are written into as JSON lines (string)")
+
+    parser.add_argument('--trace-file', type=str,
+                        help="The file the tracing spans of the requests are exported into, in the "
+                             "OpenTelemetry JSON format (string)")
+
+    parser.add_argument('--coalesce-dir', type=str,
+                        help="The directory of the lock files used to share the result of identical "
+                             "requests run at the same time by several processes (string)")
+
+    parser.add_argument('--journal', type=str,
+                        help="The SQLite file journaling the asynchronous requests, so that a restarted "
+                             "client reattaches to them and resumes their partial downloads (string)")
+
+    parser.add_argument('--coverage-index', type=str,
+                        help="The SQLite file indexing the files downloaded by the extent of their "
+                             "request, so that the requests they cover are subset locally (string)")
+
+    parser.add_argument('--poll-history', type=str,
+                        help="The SQLite file recording how long the server takes to process the requests "
+                             "of each product, to request their status around the predicted ready time "
+                             "(string, the journal file if not set)")
+
+    parser.add_argument('--limits-file', type=str,
+                        help="The SQLite file recording the size limits of the services learned from "
+                             "their 004-7 errors, to split the requests above them before submitting "
+                             "them (string, the journal file if not set)")
+
+    parser.add_argument('--request-timeout', type=float,
+                        help="Cancel the request (and its parts) if it is not over after the given "
+                             "number of seconds (float)")
+
+    parser.add_argument('--cluster', type=str, metavar='LEASES',
+                        help="Run the fan-out jobs with the other workers sharing the given leases: a "
+                             "SQLite file, or a directory (existing, or ending with a separator) on "
+                             "file systems without reliable locks")
+
+    parser.add_argument('--lease-time', type=float,
+                        help="The time (seconds) after which the jobs of a worker which stopped "
+                             "renewing its leases are given to other workers (float, 120 by default)")
+
+    parser.add_argument('--serve', type=str, metavar='ADDRESS',
+                        help="Run as a daemon accepting jobs on the given Unix socket path or "
+                             "[HOST:]PORT (localhost by default), with shared sessions and limits")
+
+    parser.add_argument('--max-jobs', type=int,
+                        help="The maximum number of jobs run at the same time by the daemon (integer)")
+
+    parser.add_argument('--daemon', type=str, metavar='ADDRESS',
+                        help="Submit the request to the daemon listening on the given address, "
+                             "if it is running (see --serve)")
+
+    parser.add_argument('--cache-proxy', type=str, metavar='ADDRESS',
+                        help="Run as a proxy of the Motu server on the given [HOST:]PORT (localhost "
+                             "by default), answering the requests of its clients from a shared "
+                             "cache of results and forwarding the others with its credentials")
+
+    parser.add_argument('--cache-dir', type=str,
+                        help="The directory of the results cached by the proxy (string, "
+                             "motu-cache by default)")
+
+    parser.add_argument('--cache-size', type=float,
+                        help="The size of the cache of the proxy, the least recently used results "
+                             "being removed beyond (float expressing bytes, unlimited by default)")
+
     # set default values by picking from the configuration file
     default_values = {}
     config = configparser.ConfigParser()
     config.read([config_file])
-    default_values.update(dict(config.items(SECTION)))
+    if config.has_section(SECTION):
+        default_values.update(dict(config.items(SECTION)))
     if default_values.get("variable"):
         default_values["variable"] = [v.strip() for v in default_values["variable"].split(",")]
     parser.set_defaults(**default_values)
@@ -220,6 +383,32 @@ def load_options(config_file, argv):
     return options
 
 
+def motu_daemon_running(address):
+    """Returns whether the daemon is running at the given address, the
+    request being run by this process otherwise."""
+    from motu import motu_daemon
+    if motu_daemon.is_running(address):
+        return True
+    logging.getLogger("motu-client-python").info("No daemon running at %s, running the request locally", address)
+    return False
+
+
+def install_cancellation(_options):
+    """Sets the cancellation token of the request: the first Ctrl-C (or the
+    request timeout) stops the request cleanly, the second one interrupts
+    the process."""
+    _options.cancel = utils_cancel.CancelToken()
+    if _options.request_timeout:
+        _options.cancel.cancel_after(float(_options.request_timeout))
+
+    def interrupted(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        logging.getLogger("motu-client-python").warning("Cancelling the request (Ctrl-C again to interrupt)")
+        _options.cancel.cancel()
+
+    signal.signal(signal.SIGINT, interrupted)
+
+
 def check_version():
     """Utility function that checks the required version of the python interpreter
     is available. Raise an exception if not."""
@@ -273,7 +462,30 @@ if __name__ == '__main__':
         if _options.log_level is not None:
             logging.getLogger().setLevel(int(_options.log_level))
 
-        motu_api.execute_request(_options)
+        console = _options.console_mode or (_options.out_dir or '').startswith("console")
+        if _options.serve:
+            from motu import motu_daemon
+            motu_daemon.serve(_options.serve, _options.max_jobs or motu_daemon.DEFAULT_MAX_JOBS,
+                              _options.max_per_server, _options)
+        elif _options.cache_proxy:
+            from motu import motu_proxy
+            motu_proxy.serve(_options.cache_proxy, _options, _options.cache_dir or 'motu-cache',
+                             _options.cache_size)
+        elif _options.daemon and not console and motu_daemon_running(_options.daemon):
+            from motu import motu_daemon
+            install_cancellation(_options)
+            motu_daemon.execute_request(_options.daemon, _options)
+        elif _options.cluster:
+            from motu import motu_cluster
+            install_cancellation(_options)
+            motu_cluster.execute_cluster(_options)
+        elif _options.fanout:
+            install_cancellation(_options)
+            motu_fanout.execute_fanout(_options)
+        else:
+            install_cancellation(_options)
+            motu_api.execute_request(_options)
+        utils_netcdf.wait_all()
     except Exception as e:
         print(e)
         log.error("Execution failed: %s", e)
@@ -307,3 +519,4 @@ if __name__ == '__main__':
 
     finally:
         log.debug("Elapsed time : %s", str(datetime.datetime.now() - start_time))
+        log.debug("Metrics : %s", utils_metrics.get_metrics().stats())
@@ -1,12 +1,14 @@
-from motu_utils.motu_api import execute_request
+from motu import motu_api
+from motu import motu_fanout
 import optparse
 from configparser import ConfigParser
 import os
 import logging
+import logging.config
 import datetime
 
 CFG_FILE = '~/motuclient/motuclient-python.ini'
-LOG_CFG_FILE = './motu_utils/cfg/log.ini'
+LOG_CFG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log.ini')
 
 SECTION = 'Main'
 
@@ -40,6 +42,28 @@ def load_options():
                        const=logging.DEBUG,
                        dest='log_level')
 
+    parser.add_option( '--user', '-u',
+                       help = "the user name (string)")
+
+    parser.add_option( '--pwd', '-p',
+                       help = "the user password (string)")
+
+    parser.add_option( '--auth-mode',
+                       default = motu_api.AUTHENTICATION_MODE_CAS,
+                       help = "the authentication mode: 'none', 'basic' or 'cas' [default: %default]")
+
+    parser.add_option( '--proxy-server',
+                       help = "the proxy server (url)")
+
+    parser.add_option( '--proxy-user',
+                       help = "the proxy user (string)")
+
+    parser.add_option( '--proxy-pwd',
+                       help = "the proxy password (string)")
+
+    parser.add_option( '--motu', '-m',
+                       help = "the motu server to use (url)")
+
     parser.add_option( '--date-min', '-t',
                        help = "The min date with optional hour resolution (string following format YYYY-MM-DD [HH:MM:SS])")
 
@@ -71,6 +95,10 @@ def load_options():
                        type = 'string',
                        help = "The max depth (float in the interval [0 ; 2e31] or string 'Surface')")
 
+    parser.add_option( '--variable', '-v',
+                       help = "The variables (list of strings)",
+                       action = 'append')
+
     parser.add_option( '--sync-mode', '-S',
                        help = "Sets the download mode to synchronous (not recommended)",
                        action='store_true',
@@ -113,6 +141,10 @@ def load_options():
                        action='store_true',
                        dest='console_mode')
 
+    parser.add_option( '--max-per-server',
+                       type = 'int',
+                       help = "The maximum number of products downloaded at the same time",
+                       default = motu_fanout.DEFAULT_MAX_PER_SERVER)
 
     # set default values by picking from the configuration file
     default_values = {}
@@ -134,12 +166,16 @@ def load_options():
 
 
 def main(daily=True):
+    """Downloads in one parallel pass every product of the Black Sea bundle."""
+    logging.config.fileConfig(LOG_CFG_FILE)
     flag = "d" if daily else "h"
     options, _ = load_options()
-    execute_request(options)
+    if options.log_level is not None:
+        logging.getLogger().setLevel(int(options.log_level))
 
-    for variable in VARIABLES:
-        product_id = PRODUCTS_FORMAT.format(variable=variable, flag=flag)
+    options.service_id = SERVICE
+    options.product_id = PRODUCTS_FORMAT
+    motu_fanout.execute_fanout(options, {"variable": VARIABLES, "flag": (flag,)})
 
 
 if __name__ == '__main__':
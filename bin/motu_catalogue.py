@@ -0,0 +1,140 @@
+"""Local catalogue of Motu products.
+
+refresh: requests the description of products and indexes them
+query: lists the indexed products covering a region, a period, depths and
+       variables, offline
+
+Examples:
+  motu_catalogue.py -c products.db refresh -m URL -u USER -p PWD -s SERVICE -d PRODUCT1 -d PRODUCT2
+  motu_catalogue.py -c products.db query -v thetao -x -10 -X 10 -y 30 -Y 50 -t 2019-01-01 -T 2019-12-31
+"""
+import argparse
+import configparser
+import json
+import logging
+import logging.config
+import os
+import sys
+
+from motu import motu_api
+from motu import motu_catalogue
+
+CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_CFG_FILE = os.path.join(CURRENT_PATH, "motu-client-python.ini")
+LOG_CFG_FILE = os.path.join(CURRENT_PATH, 'log.ini')
+
+SECTION = 'Main'
+
+# options of the configuration file used by the refresh
+CONFIG_OPTIONS = ('user', 'pwd', 'auth_mode', 'proxy_server', 'proxy_user', 'proxy_pwd', 'motu', 'socket_timeout')
+
+
+def load_options(argv=None):
+    """load options to handle"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogue', '-c', required=True,
+                        help="the SQLite file of the catalogue (string)")
+    parser.add_argument('--config-file', default=DEFAULT_CFG_FILE,
+                        help="the configuration file of motu-client, giving the default server and "
+                             "credentials [default: %(default)s]")
+    parser.add_argument('--verbose', action='store_const', const=logging.DEBUG, dest='log_level',
+                        help="print information in stdout")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    refresh = commands.add_parser('refresh', help="request the description of products and index them")
+    refresh.add_argument('--user', '-u', help="the user name (string)")
+    refresh.add_argument('--pwd', '-p', help="the user password (string)")
+    refresh.add_argument('--auth-mode', help="the authentication mode: 'none', 'basic' or 'cas'")
+    refresh.add_argument('--proxy-server', help="the proxy server (url)")
+    refresh.add_argument('--proxy-user', help="the proxy user (string)")
+    refresh.add_argument('--proxy-pwd', help="the proxy password (string)")
+    refresh.add_argument('--motu', '-m', help="the motu server to use (url)")
+    refresh.add_argument('--socket-timeout', type=float,
+                         help="Set a timeout on blocking socket operations (float expressing seconds)")
+    refresh.add_argument('--service-id', '-s', help="The service of the products (string)")
+    refresh.add_argument('--product-id', '-d', action='append', default=[],
+                         help="A product of the service (string). Can be repeated.")
+    refresh.add_argument('--products-file',
+                         help="A file listing the products to index, one 'SERVICE PRODUCT' per line (string)")
+    refresh.add_argument('--max-age', type=float, default=motu_catalogue.DEFAULT_MAX_AGE,
+                         help="The age (seconds) after which a description is requested again "
+                              "[default: %(default)s]")
+    refresh.add_argument('--force', action='store_true',
+                         help="Request the description of every product, whatever its age")
+    refresh.add_argument('--max-per-server', type=int, default=motu_catalogue.DEFAULT_MAX_WORKERS,
+                         help="The number of descriptions requested at the same time [default: %(default)s]")
+
+    query = commands.add_parser('query', help="list the products covering an extent, offline")
+    query.add_argument('--longitude-min', '-x', type=float, help="The min longitude (float)")
+    query.add_argument('--longitude-max', '-X', type=float, help="The max longitude (float)")
+    query.add_argument('--latitude-min', '-y', type=float, help="The min latitude (float)")
+    query.add_argument('--latitude-max', '-Y', type=float, help="The max latitude (float)")
+    query.add_argument('--depth-min', '-z', type=float, help="The min depth (float)")
+    query.add_argument('--depth-max', '-Z', type=float, help="The max depth (float)")
+    query.add_argument('--date-min', '-t', help="The min date (string following format YYYY-MM-DD [HH:MM:SS])")
+    query.add_argument('--date-max', '-T', help="The max date (string following format YYYY-MM-DD [HH:MM:SS])")
+    query.add_argument('--variable', '-v', action='append',
+                       help="A variable (name or standard name) the products must have. Can be repeated.")
+    query.add_argument('--intersects', action='store_true',
+                       help="List the products intersecting the extent, instead of covering it")
+    query.add_argument('--json', action='store_true', help="Print the products as JSON")
+
+    options = parser.parse_args(argv)
+    if options.command == 'refresh':
+        config = configparser.ConfigParser()
+        config.read([options.config_file])
+        if config.has_section(SECTION):
+            for name in CONFIG_OPTIONS:
+                if getattr(options, name) is None and config.has_option(SECTION, name):
+                    setattr(options, name, config.get(SECTION, name))
+        if options.socket_timeout is not None:
+            options.socket_timeout = float(options.socket_timeout)
+    return options
+
+
+def read_products(options):
+    """Returns the (service, product) tuples given by the options."""
+    products = [(options.service_id, product) for product in options.product_id]
+    if options.products_file:
+        with open(options.products_file) as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if len(fields) == 2:
+                    products.append(tuple(fields))
+    return products
+
+
+def main(argv=None):
+    logging.config.fileConfig(LOG_CFG_FILE)
+    logging.getLogger().setLevel(logging.INFO)
+    options = load_options(argv)
+    if options.log_level is not None:
+        logging.getLogger().setLevel(int(options.log_level))
+    catalogue = motu_catalogue.Catalogue(options.catalogue)
+
+    if options.command == 'refresh':
+        request = motu_api.default_options(**dict((name, getattr(options, name)) for name in CONFIG_OPTIONS
+                                                  if getattr(options, name) is not None))
+        counts = catalogue.refresh(request, read_products(options), options.max_age, options.force,
+                                   options.max_per_server)
+        return 1 if counts['failed'] else 0
+
+    products = catalogue.query(options.longitude_min, options.longitude_max,
+                               options.latitude_min, options.latitude_max,
+                               options.depth_min, options.depth_max,
+                               options.date_min, options.date_max,
+                               options.variable, not options.intersects)
+    if options.json:
+        print(json.dumps(products, indent=1))
+    else:
+        for product in products:
+            print("%s %s lon %s lat %s depth %s time %s..%s %s" % (
+                product['service_id'], product['product_id'],
+                '%s..%s' % product['longitude'], '%s..%s' % product['latitude'], '%s..%s' % product['depth'],
+                product['time'][0], product['time'][1], ','.join(product['variables'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Measures the start-up time of the motu client.
+
+Runs 'motu-client.py --help' several times and exits with an error code when
+the median time exceeds the target, so that it can be used as a check in a
+build chain."""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
+CLIENT = os.path.join(CURRENT_PATH, "motu-client.py")
+
+# target median start-up time (seconds)
+DEFAULT_TARGET = 0.3
+
+# number of runs measured
+DEFAULT_RUNS = 10
+
+
+def measure(runs):
+    """Returns the sorted durations (seconds) of the given number of runs."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(CURRENT_PATH), env.get("PYTHONPATH")]))
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, CLIENT, "--help"], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--target', type=float, default=DEFAULT_TARGET,
+                        help="The maximum median start-up time (float expressing seconds)")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                        help="The number of runs measured (integer)")
+    args = parser.parse_args()
+
+    durations = measure(args.runs)
+    median = durations[len(durations) // 2]
+    print("motu-client.py --help: min %.3f s, median %.3f s, max %.3f s (target %.3f s)" %
+          (durations[0], median, durations[-1], args.target))
+    sys.exit(0 if median <= args.target else 1)
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Measures the TLS handshakes of the connections to a server.
+
+Opens several connections in a row to the server of the given url, each
+sending a HEAD request, once with TLS session resumption and once without,
+and prints the number of full and resumed handshakes and their times."""
+
+import argparse
+import time
+from urllib.parse import urlparse
+
+from motu import utils_http
+from motu import utils_metrics
+
+# number of connections measured
+DEFAULT_CONNECTIONS = 20
+
+
+def measure(url, connections, resume):
+    """Returns the metrics of the given number of connections to the server
+    of the url, resuming the TLS sessions or not."""
+    parsed = urlparse(url)
+    metrics = utils_metrics.get_metrics()
+    metrics.clear()
+    utils_http.clear_tls_sessions()
+    for _ in range(connections):
+        if not resume:
+            utils_http.clear_tls_sessions()
+        connection = utils_http.TLSConnection(parsed.netloc)
+        start = time.perf_counter()
+        try:
+            connection.request('HEAD', parsed.path or '/')
+            connection.getresponse().read()
+        finally:
+            connection.close()
+        metrics.observe('connection', time.perf_counter() - start)
+    return metrics.stats()
+
+
+def report(name, stats):
+    counters = stats['counters']
+    timings = stats['timings']
+    print("%-18s full: %3i, resumed: %3i, handshake: mean %.1f ms (min %.1f, max %.1f), "
+          "connection and HEAD: mean %.1f ms" % (
+              name, counters.get('tls.handshakes.full', 0), counters.get('tls.handshakes.resumed', 0),
+              timings['tls.handshake']['mean'] * 1000, timings['tls.handshake']['min'] * 1000,
+              timings['tls.handshake']['max'] * 1000, timings['connection']['mean'] * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('url', help="The https url of the server (string)")
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS,
+                        help="The number of connections measured (integer)")
+    parser.add_argument('--ca-bundle', type=str,
+                        help="The file (PEM) of the certificate authorities trusted (string)")
+    parser.add_argument('--tls-ciphers', type=str,
+                        help="The ciphers allowed with TLS 1.2 (string)")
+    args = parser.parse_args()
+
+    utils_http.configure_tls(args.ca_bundle, args.tls_ciphers)
+    report("without resumption", measure(args.url, args.connections, False))
+    report("with resumption", measure(args.url, args.connections, True))
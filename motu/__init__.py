@@ -1,10 +1,40 @@
-from . import motu_api
-from . import stop_watch
-from . import utils_cas
-from . import utils_collection
-from . import utils_html
-from . import utils_http
-from . import utils_log
-from . import utils_messages
-from . import utils_stream
-from . import utils_unit
+import importlib
+
+# submodules are imported on first access (motu.motu_api...), so that
+# importing the package does not import all of them
+__all__ = ['motu_api',
+           'motu_catalogue',
+           'motu_cluster',
+           'motu_daemon',
+           'motu_fanout',
+           'motu_proxy',
+           'motu_scheduler',
+           'motu_tiles',
+           'stop_watch',
+           'utils_cancel',
+           'utils_cas',
+           'utils_coalesce',
+           'utils_collection',
+           'utils_coverage',
+           'utils_estimate',
+           'utils_governor',
+           'utils_html',
+           'utils_http',
+           'utils_journal',
+           'utils_limits',
+           'utils_log',
+           'utils_messages',
+           'utils_metrics',
+           'utils_metadata',
+           'utils_netcdf',
+           'utils_polling',
+           'utils_stream',
+           'utils_trace',
+           'utils_unit']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
@@ -28,9 +28,14 @@
 
 # import urlparse # WARNING : The urlparse module is renamed to urllib.parse
 from urllib.parse import urlparse, quote_plus
-from io import StringIO
+from urllib.error import HTTPError
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
 import os
 import re
+import hashlib
 import datetime
 import time
 import socket
@@ -41,13 +46,25 @@ from xml.dom import minidom
 from . import utils_log
 from . import utils_unit
 from . import utils_stream
-from . import utils_http
 from . import utils_messages
-from . import utils_cas
+from . import utils_netcdf
 from . import utils_collection
+from . import utils_coalesce
+from . import utils_coverage
+from . import utils_governor
+from . import utils_cancel
+from . import utils_journal
+from . import utils_limits
+from . import utils_metadata
+from . import utils_metrics
+from . import utils_polling
+from . import utils_trace
 from . import stop_watch
 import logging
 
+# utils_http and utils_cas (urllib.request, ssl...) are long to import: they are
+# imported by the functions using them, so that importing this module is fast
+
 # constant for authentication modes
 AUTHENTICATION_MODE_NONE = 'none'
 AUTHENTICATION_MODE_BASIC = 'basic'
@@ -56,6 +73,34 @@ AUTHENTICATION_MODE_CAS = 'cas'
 # constant for date time string format
 DATETIME_FORMAT = "%Y-%m-%d% %H:%M:%S"
 
+# options read without default, None when not given (see default_options)
+REQUEST_OPTIONS = ('user', 'pwd', 'proxy_server', 'proxy_user', 'proxy_pwd', 'motu', 'service_id', 'product_id',
+                   'date_min', 'date_max', 'latitude_min', 'latitude_max', 'longitude_min', 'longitude_max',
+                   'depth_min', 'depth_max', 'variable', 'socket_timeout', 'user_agent', 'outputWritten')
+
+# default values of the other options read without default
+DEFAULT_OPTIONS = {'auth_mode': AUTHENTICATION_MODE_CAS,
+                   'out_dir': '.',
+                   'out_name': 'data.nc',
+                   'block_size': 65536,
+                   'sync': False,
+                   'describe': False,
+                   'size': False,
+                   'console_mode': False}
+
+# minimal interval, in seconds, between two records of the download progress in the journal
+JOURNAL_PROGRESS_INTERVAL = 2
+
+# number of connections opened in advance to the Motu server and to its CAS
+# server (see prewarm): redirection to CAS and service ticket, or submission
+PREWARM_CONNECTIONS = 2
+
+# time (seconds) the speed of a download is measured over, when limited (see dl_2_file)
+DEFAULT_SPEED_TIME = 30
+
+# number of times a stalled download is resumed before failing
+MAX_STALL_RESUMES = 5
+
 
 def get_client_version():
     """Return the version (as a string) of this client.
@@ -73,13 +118,52 @@ def get_client_artefact():
     return 'motu-client-python'
 
 
+def default_options(**values):
+    """Returns the options of a request (see execute_request) holding the
+    given values, and the default values for the others."""
+    import argparse
+    options = dict(DEFAULT_OPTIONS)
+    options.update(dict.fromkeys(REQUEST_OPTIONS))
+    options.update(values)
+    return argparse.Namespace(**options)
+
+
+def normalize_request(_options):
+    """Snaps the bounds of the (checked) request onto the grid of its product
+    when the 'snap_to_grid' option is set, so that requests selecting the
+    same data have the same key (see utils_metadata.snap_request). The grid
+    comes from the describeProduct result of the product, cached in the
+    'metadata_cache' directory if set.
+
+    The request is left as is if the product cannot be described. The key
+    of the snapped request is kept in the 'snapped' option, so that copies
+    of the request with other bounds (tiles, parts) are snapped again."""
+    if not getattr(_options, 'snap_to_grid', False) or _options.describe:
+        return
+    if getattr(_options, 'snapped', None) == canonical_request(_options):
+        return
+    log = logging.getLogger("motu_api")
+    try:
+        grid = utils_metadata.get_product_grid(_options, getattr(_options, 'metadata_cache', None))
+    except Exception as e:
+        log.warning("Unable to snap the request to the grid of %s: %s", _options.product_id, e)
+        # not described again for each use of the request
+        _options.snapped = canonical_request(_options)
+        return
+    utils_metadata.snap_request(_options, grid)
+    _options.snapped = canonical_request(_options)
+    log.debug("Request snapped to the grid: %s", _options.snapped)
+
+
 def build_params(_options):
     """Function that builds the query string for Motu according to the given options"""
+    from . import utils_http
     # temporal = ''
     # geographic = ''
     # vertical = ''
     # other_opt = ''
     log = logging.getLogger("motu_api")
+    normalize_request(_options)
     """
     Build the main url to connect to
     """
@@ -158,6 +242,64 @@ def build_params(_options):
     return utils_http.encode(query_options)
 
 
+def canonical_request(_options):
+    """Returns the identity of the data requested by the given (checked)
+    options, as a tuple of (name, value) couples.
+
+    Options that do not change the data returned (output file, sync mode,
+    credentials...) are not part of it, values are normalized and variables
+    are sorted so that two requests for the same data give the same tuple."""
+
+    def normalize(value):
+        if value is None:
+            return None
+        try:
+            return repr(float(value))
+        except (TypeError, ValueError):
+            return str(value).strip()
+
+    if _options.describe:
+        action = 'describeProduct'
+    elif _options.size:
+        action = 'getSize'
+    else:
+        action = 'productdownload'
+
+    request = [('motu', _options.motu.rstrip('?')),
+               ('action', action),
+               ('service', _options.service_id),
+               ('product', _options.product_id)]
+    if _options.extraction_geographic:
+        request += [('x_lo', normalize(_options.longitude_min)),
+                    ('x_hi', normalize(_options.longitude_max)),
+                    ('y_lo', normalize(_options.latitude_min)),
+                    ('y_hi', normalize(_options.latitude_max))]
+    if _options.extraction_vertical:
+        request += [('z_lo', normalize(_options.depth_min)),
+                    ('z_hi', normalize(_options.depth_max))]
+    if _options.extraction_temporal:
+        request += [('t_lo', normalize(_options.date_min)),
+                    ('t_hi', normalize(_options.date_max))]
+    request.append(('output', _options.outputWritten if _options.extraction_output else 'netcdf'))
+    request.append(('variable', tuple(sorted(set(_options.variable or ())))))
+    return tuple(request)
+
+
+def request_key(_options):
+    """Returns a short string identifying the data requested by the given
+    (checked) options (see canonical_request)."""
+    return hashlib.sha1(repr(canonical_request(_options)).encode("utf-8")).hexdigest()
+
+
+def coalesce_key(_options):
+    """Returns a short string identifying the requests sharing their result
+    (see utils_coalesce): the data requested and the credentials it is
+    requested with, as a result is only shared with requests of the same
+    user."""
+    identity = (canonical_request(_options), _options.auth_mode, _options.user, _options.pwd)
+    return hashlib.sha1(repr(identity).encode("utf-8")).hexdigest()
+
+
 def check_options(_options):
     """function that checks the given options for coherency."""
 
@@ -326,6 +468,9 @@ def get_url_config(_options, data=None):
     # headers
     kargs['headers'] = {"X-Client-Id": get_client_artefact(),
                         "X-Client-Version": quote_plus(get_client_version())}
+    # session shared with other jobs
+    if getattr(_options, 'session', None) is not None:
+        kargs['session'] = _options.session
     # data
     if data is not None:
         kargs['data'] = data
@@ -333,8 +478,11 @@ def get_url_config(_options, data=None):
     return kargs
 
 
-def get_request_url(dl_url, server, **options):
-    """ Get the request url."""
+def get_request_url(dl_url, server, cancel=None, **options):
+    """ Get the request url.
+
+    cancel: (optional) the utils_cancel.CancelToken of the request"""
+    from . import utils_http
     log = logging.getLogger("motu_api")
     stop_wa = stop_watch.local_thread_stop_watch()
     start_time = datetime.datetime.now()
@@ -342,8 +490,9 @@ def get_request_url(dl_url, server, **options):
     log.info("Requesting file to download (this can take a while)...")
 
     # Get request id        
-    m = utils_http.open_url(dl_url, **options)
-    response_str = m.read()
+    with utils_governor.get_governor().slot(dl_url, cancel):
+        m = utils_http.open_url(dl_url, compressed=True, **options)
+        response_str = m.read()
     dom = minidom.parseString(response_str)
     node = dom.getElementsByTagName('statusModeResponse')[0]
     status = node.getAttribute('status')
@@ -366,15 +515,59 @@ def wait_till_finished(reqUrlCAS, **options):
     start_time = datetime.datetime.now()
 
 
-def dl_2_file(dl_url, fh, block_size=65535, isADownloadRequest=None, **options):
+def range_options(options, offset):
+    """Returns the url options requesting the content from the given offset."""
+    options = dict(options)
+    options['headers'] = dict(options.get('headers', {}))
+    options['headers']['Range'] = 'bytes=%i-' % offset
+    options['headers']['Accept-Encoding'] = 'identity'
+    return options
+
+
+def speed_limits(_options):
+    """Returns the arguments of dl_2_file detecting stalled downloads, from
+    the 'speed_limit' and 'speed_time' options."""
+    limits = {}
+    if getattr(_options, 'speed_limit', None):
+        limits['speed_limit'] = int(_options.speed_limit)
+        limits['speed_time'] = int(getattr(_options, 'speed_time', None) or DEFAULT_SPEED_TIME)
+    return limits
+
+
+def dl_2_file(dl_url, fh, block_size=65535, isADownloadRequest=None, fsync=False, resume=None, progress=None,
+              cancel=None, speed_limit=None, speed_time=DEFAULT_SPEED_TIME, **options):
     """ Download the file with the main url (of Motu) file.
      
     Motu can return an error message in the response stream without setting an
     appropriate http error code. So, in that case, the content-type response is
     checked, and if it is text/plain, we consider this as an error.
+
+    The file is written under a temporary name in the same directory, with its
+    space preallocated when its size is known, and renamed once complete.
     
     dl_url: the complete download url of Motu
-    fh: file handler to use to write the downstream"""
+    fh: file handler to use to write the downstream, or a buffer object
+        (see utils_stream.SpillingBuffer)
+    fsync: whether the file is flushed to the disk before being published
+    resume: the number of bytes known to be written in the temporary file by
+            a previous attempt, from which the download is resumed with a
+            Range request. If set, the temporary file is kept on failure. If
+            None, the download starts from scratch
+    progress: (optional) function called with the number of bytes written and
+              the total size (-1 if unknown) while downloading, and called
+              with the bytes kept, None and True when a download to resume
+              fails
+    cancel: (optional) the utils_cancel.CancelToken of the request. Its
+            cancellation interrupts the transfer, and drops the temporary
+            file even when resuming
+    speed_limit: (optional) the minimal speed (bytes per second) of a download
+                 to a file. A transfer slower than that during speed_time
+                 seconds is stalled: it is interrupted and resumed with a
+                 Range request on a new connection, MAX_STALL_RESUMES times
+                 at most
+    speed_time: the time (seconds) the speed is measured over"""
+    from . import utils_cas
+    from . import utils_http
     log = logging.getLogger("motu_api")
     stop_wa = stop_watch.local_thread_stop_watch()
     start_time = datetime.datetime.now()
@@ -382,95 +575,190 @@ def dl_2_file(dl_url, fh, block_size=65535, isADownloadRequest=None, **options):
 
     # download file
     temp = None
-    if not fh.startswith("console"):
-        temp = open(fh, 'w+b')
-
+    if not isinstance(fh, str):
+        temp = fh
+    elif not fh.startswith("console"):
+        temp = utils_stream.AtomicFile(fh, fsync, resume is not None)
+
+    offset = 0
+    if resume and temp is not None:
+        offset = min(resume, temp.written())
+    if offset > 0:
+        options = range_options(options, offset)
+
+    complete = False
+    cancelled = False
     try:
         stop_wa.start('processing')
 
-        m = utils_http.open_url(dl_url, **options)
-        try:
-            # check the real url (after potential redirection) is not a CAS Url scheme
-            match = re.search(utils_cas.CAS_URL_PATTERN, m.url)
-            if match is not None:
-                service, _, _ = dl_url.partition('?')
-                redirection, _, _ = m.url.partition('?')
-                raise Exception(
-                    utils_messages.get_external_messages()['motu-client.exception.authentication.redirected'] % (
-                        service, redirection))
-
-            # check that content type is not text/plain
-            headers = m.info()
-            if "Content-Type" in headers:
-                if len(headers['Content-Type']) > 0:
-                    if isADownloadRequest:
-                        if headers['Content-Type'].startswith('text') or headers['Content-Type'].find('html') != -1:
+        # hold a connection slot on the server, the transfer is limited by the shared bandwidth
+        governor = utils_governor.get_governor()
+        stalls = 0
+        while True:
+            # the transfer of each attempt is interrupted on a stall, see speed_limit
+            attempt = cancel.child() if cancel is not None else utils_cancel.CancelToken()
+            watchdog = None
+            try:
+                with governor.slot(dl_url, cancel) as slot:
+                    # the XML results are compressed, not the NetCDF files
+                    m = utils_http.open_url(dl_url, compressed=not isADownloadRequest, **options)
+                    # a cancellation or a stall shuts the connection down, so that a blocked read returns at once
+                    def interrupt():
+                        slot['interrupted'] = True
+                        utils_http.interrupt(m)
+
+                    attempt.on_cancel(interrupt)
+                    if speed_limit and hasattr(temp, 'restart_at'):
+                        watchdog = utils_stream.StallWatchdog(speed_limit, speed_time, attempt.cancel)
+                    try:
+                        # check the real url (after potential redirection) is not a CAS Url scheme
+                        match = re.search(utils_cas.CAS_URL_PATTERN, m.url)
+                        if match is not None:
+                            service, _, _ = dl_url.partition('?')
+                            redirection, _, _ = m.url.partition('?')
                             raise Exception(
-                                utils_messages.get_external_messages()['motu-client.exception.motu.error'] % m.read())
-
-            log.info('File type: %s' % headers['Content-Type'])
-            # check if a content length (size of the file) has been send
-            size = -1
-            if "Content-Length" in headers:
-                try:
-                    # it should be an integer
-                    size = int(headers["Content-Length"])
-                    log.info('File size: %s (%i B)' % (utils_unit.convert_bytes(size), size))
-                except Exception as e:
-                    size = -1
-                    log.warn('File size is not an integer: %s' % headers["Content-Length"])
-            elif temp is not None:
-                log.warn('File size: %s' % 'unknown')
-
-            processing_time = datetime.datetime.now()
-            stop_wa.stop('processing')
-            stop_wa.start('downloading')
-
-            # performs the download           
-            log.info('Downloading file %s' % os.path.abspath(fh))
-
-            def progress_function(size_read):
-                percent = size_read * 100. / size
-                log.info("- %s (%.1f%%)", utils_unit.convert_bytes(size).rjust(8), percent)
-                td = datetime.datetime.now() - start_time
-
-            def none_function(size_read):
-                percent = 100
-                log.info("- %s (%.1f%%)", utils_unit.convert_bytes(size).rjust(8), percent)
-                td = datetime.datetime.now() - start_time
-
-            if temp is not None:
-                read = utils_stream.copy(m, temp, progress_function if size != -1 else none_function, block_size)
-            else:
-                if isADownloadRequest:
-                    # Console mode, only display the NC file URL on stdout
-                    read = len(m.url)
-                    print(m.url)
-                else:
-                    output = StringIO()
-                    utils_stream.copy(m, output, progress_function if size != -1 else none_function, block_size)
-                    read = len(output.getvalue())
-                    print(output.getvalue())
-
-            end_time = datetime.datetime.now()
-            stop_wa.stop('downloading')
-
-            log.info("Processing  time : %s", str(processing_time - init_time))
-            log.info("Downloading time : %s", str(end_time - processing_time))
-            log.info("Total time       : %s", str(end_time - init_time))
-            log.info("Download rate    : %s/s", utils_unit
-                     .convert_bytes((read / total_milliseconds(end_time - start_time)) * 10 ** 3))
-        finally:
-            m.close()
+                                utils_messages.get_external_messages()['motu-client.exception.authentication.redirected'] % (
+                                    service, redirection))
+
+                        # check that content type is not text/plain
+                        headers = m.info()
+                        if "Content-Type" in headers:
+                            if len(headers['Content-Type']) > 0:
+                                if isADownloadRequest:
+                                    if headers['Content-Type'].startswith('text') or headers['Content-Type'].find('html') != -1:
+                                        raise Exception(
+                                            utils_messages.get_external_messages()['motu-client.exception.motu.error'] % m.read())
+
+                        log.info('File type: %s' % headers['Content-Type'])
+                        # check if a content length (size of the file) has been send
+                        size = -1
+                        if "Content-Length" in headers:
+                            try:
+                                # it should be an integer
+                                size = int(headers["Content-Length"])
+                                log.info('File size: %s (%i B)' % (utils_unit.convert_bytes(size), size))
+                            except Exception as e:
+                                size = -1
+                                log.warn('File size is not an integer: %s' % headers["Content-Length"])
+                        elif temp is not None:
+                            log.warn('File size: %s' % 'unknown')
+
+                        if offset > 0:
+                            if m.getcode() == 206:
+                                log.info('Resuming download after %s' % utils_unit.convert_bytes(offset))
+                                if size >= 0:
+                                    size += offset
+                            else:
+                                # the server ignores the range, download everything again
+                                offset = 0
+                        if (resume is not None or stalls > 0) and temp is not None:
+                            temp.restart_at(offset)
+
+                        if temp is not None:
+                            temp.allocate(size)
+
+                        processing_time = datetime.datetime.now()
+                        stop_wa.stop('processing')
+                        stop_wa.start('downloading')
+
+                        # performs the download           
+                        log.info('Downloading file %s' % (os.path.abspath(fh) if isinstance(fh, str) else 'in memory'))
+
+                        def progress_function(size_read):
+                            percent = (offset + size_read) * 100. / size
+                            log.info("- %s (%.1f%%)", utils_unit.convert_bytes(size).rjust(8), percent)
+                            td = datetime.datetime.now() - start_time
+                            if progress is not None:
+                                progress(offset + size_read, size)
+                            if watchdog is not None:
+                                watchdog.update(size_read)
+
+                        def none_function(size_read):
+                            percent = 100
+                            log.info("- %s (%.1f%%)", utils_unit.convert_bytes(size).rjust(8), percent)
+                            td = datetime.datetime.now() - start_time
+                            if progress is not None:
+                                progress(offset + size_read, size)
+                            if watchdog is not None:
+                                watchdog.update(size_read)
+
+                        if temp is not None:
+                            read = offset + utils_stream.copy(m, temp, progress_function if size != -1 else none_function,
+                                                              block_size, governor.bandwidth.consume, attempt,
+                                                              watchdog is not None)
+                        else:
+                            if isADownloadRequest:
+                                # Console mode, only display the NC file URL on stdout
+                                read = len(m.url)
+                                print(m.url)
+                            else:
+                                output = BytesIO()
+                                utils_stream.copy(m, output, progress_function if size != -1 else none_function, block_size,
+                                                  cancel=attempt)
+                                read = len(output.getvalue())
+                                print(output.getvalue().decode("utf-8"))
+
+                        end_time = datetime.datetime.now()
+                        stop_wa.stop('downloading')
+                        slot['bytes'] = read - offset
+
+                        log.info("Processing  time : %s", str(processing_time - init_time))
+                        log.info("Downloading time : %s", str(end_time - processing_time))
+                        log.info("Total time       : %s", str(end_time - init_time))
+                        log.info("Download rate    : %s/s", utils_unit
+                                 .convert_bytes((read / total_milliseconds(end_time - start_time)) * 10 ** 3))
+                    finally:
+                        if watchdog is not None:
+                            watchdog.stop()
+                        attempt.detach()
+                        m.close()
+                break
+            except Exception:
+                if watchdog is None or not watchdog.stalled or (cancel is not None and cancel.cancelled):
+                    raise
+                stalls += 1
+                utils_metrics.get_metrics().count('download.stalls')
+                if stalls > MAX_STALL_RESUMES:
+                    raise Exception(
+                        utils_messages.get_external_messages()['motu-client.exception.download.stalled'] % (
+                            stalls, utils_unit.convert_bytes(speed_limit), speed_time))
+                offset += watchdog.received
+                log.warn('Download below %s/s for %i seconds, resuming after %s on a new connection' % (
+                    utils_unit.convert_bytes(speed_limit), speed_time, utils_unit.convert_bytes(offset)))
+                options = range_options(options, offset)
+                utils_metrics.get_metrics().count('download.resumes')
+
+        # raise exception if actual size does not match content-length header
+        if temp is not None and size >= 0 and read < size:
+            raise Exception(utils_messages.get_external_messages()['motu-client.exception.download.too-short'] %
+                            (read, size))
+        complete = True
+    except Exception:
+        # reading an interrupted connection fails in various ways
+        cancelled = cancel is not None and cancel.cancelled
+        if cancelled:
+            raise utils_cancel.Cancelled()
+        raise
     finally:
         if temp is not None:
-            temp.flush()
-            temp.close()
+            if complete:
+                temp.commit()
+            elif cancelled:
+                # a cancelled download is not resumed
+                temp.abort(True)
+            else:
+                temp.abort()
+                if resume is not None and progress is not None:
+                    # record what is kept for the next attempt
+                    progress(temp.written(), None, True)
+
 
-    # raise exception if actual size does not match content-length header
-    if temp is not None and size >= 0 and read < size:
-        raise Exception(utils_messages.get_external_messages()['motu-client.exception.download.too-short'] %
-                        (read, size))
+def transcode_output(_options, fh):
+    """Starts the background transcoding of the downloaded file into NetCDF4,
+    if asked by the options."""
+    if getattr(_options, 'transcode', False):
+        level = getattr(_options, 'compression_level', None) or utils_netcdf.DEFAULT_COMPRESSION_LEVEL
+        utils_netcdf.submit(fh, int(level))
 
 
 def execute_request(_options):
@@ -528,7 +816,67 @@ def execute_request(_options):
     * The user agent to use when performing http requests
       - user_agent: 'motu-api-client' 
 
+    * Transcoding of the downloaded NetCDF3 files into compressed NetCDF4
+      files, in a background process, before the request returns
+      - transcode: True
+      - compression_level: 4
+
+    * The size (degrees) of the tiles a large geographic box is split into,
+      tiles being requested in parallel and stitched back (optional). Boxes
+      crossing the antimeridian are always split
+      - tile_size: 10
+
+    * The directory of the lock files used to share the result of identical
+      requests run at the same time by several processes (optional)
+      - coalesce_dir: '/tmp/motu-client'
+
+    * The SQLite file journaling the asynchronous requests, so that a
+      restarted client reattaches to the requests it submitted and resumes
+      their partial downloads (optional)
+      - journal: '/tmp/motu-client/journal.db'
+
+    * The SQLite file indexing the files downloaded by the extent of their
+      request, so that a request covered by a file already downloaded is
+      subset locally (requires xarray, see utils_coverage.execute_covered)
+      - coverage_index: '/data/motu/coverage.db'
+
+    * Whether the bounds of the box, depths and period are snapped onto the
+      grid of the product, so that requests selecting the same data share
+      their result, with the describeProduct results kept in a directory
+      (optional)
+      - snap_to_grid: True
+      - metadata_cache: '/data/motu/metadata'
+
+    * The file the structured events of the requests (job, phase, bytes,
+      latency) are written into as JSON lines (optional)
+      - event_log: '/tmp/motu-client/events.jsonl'
+
+    * The utils_cancel.CancelToken stopping the request (and its parts) when
+      cancelled, which then raises utils_cancel.Cancelled (optional)
+      - cancel: utils_cancel.CancelToken()
+
+    * The file the tracing spans of the requests (check, auth, submit, poll,
+      redirect, download) are exported into, in the OpenTelemetry JSON
+      format (optional, see utils_trace)
+      - trace_file: '/tmp/motu-client/traces.jsonl'
+
+    Returns the list of the files written.
     """
+    utils_trace.configure(getattr(_options, 'trace_file', None))
+    parent = getattr(_options, 'trace_span', None)
+    with utils_trace.span('request', _options, service=_options.service_id,
+                          product=_options.product_id) as request_span:
+        if request_span is None:
+            return _execute_request(_options)
+        # the parts of a split request are linked to it, even when run by other threads
+        _options.trace_span = request_span
+        try:
+            return _execute_request(_options)
+        finally:
+            _options.trace_span = parent
+
+
+def _execute_request(_options):
     global init_time
 
     log = logging.getLogger("motu_api")
@@ -537,155 +885,631 @@ def execute_request(_options):
     stop_wa.start()
     try:
         # at first, we check given options are ok
-        check_options(_options)
+        with utils_trace.span('check', _options):
+            check_options(_options)
+            normalize_request(_options)
 
         # print some trace info about the options set
-        log.log(utils_log.TRACE_LEVEL, '-' * 60)
+        if log.isEnabledFor(utils_log.TRACE_LEVEL):
+            log.log(utils_log.TRACE_LEVEL, '-' * 60)
 
-        for option in dir(_options):
-            if not option.startswith('_'):
-                log.log(utils_log.TRACE_LEVEL, "%s=%s" % (option, getattr(_options, option)))
+            for option in dir(_options):
+                if not option.startswith('_'):
+                    log.log(utils_log.TRACE_LEVEL, "%s=%s", option, getattr(_options, option))
 
-        log.log(utils_log.TRACE_LEVEL, '-' * 60)
+            log.log(utils_log.TRACE_LEVEL, '-' * 60)
 
-        # start of url to invoke
-        url_service = _options.motu
+        if _options.describe or _options.size:
+            _options.out_name = _options.out_name.replace('.nc', '.xml')
 
-        # parameters of the invoked service
-        url_params = build_params(_options)
+        # create a file for storing downloaded stream
+        fh = os.path.join(_options.out_dir, _options.out_name)
+        if _options.console_mode:
+            fh = "console"
 
-        url_config = get_url_config(_options)
+        if fh.startswith("console"):
+            return process_request(_options, fh)
 
-        # check if question mark is in the url
-        question_mark = '?'
-        if url_service.endswith(question_mark):
-            question_mark = ''
-        url = url_service + question_mark + url_params
+        # requests covered by the files already downloaded are subset locally
+        if not (_options.describe or _options.size):
+            files = utils_coverage.execute_covered(_options, fh)
+            if files is not None:
+                return files
 
-        if _options.describe or _options.size:
-            _options.out_name = _options.out_name.replace('.nc', '.xml')
+        # boxes crossing the antimeridian or larger than the tile size are split
+        from . import motu_tiles
+        if motu_tiles.needs_tiling(_options):
+            files = motu_tiles.execute_tiled_request(_options)
+        else:
+            def download():
+                files = process_request(_options, fh)
+                # the result is only shared and indexed once transcoded
+                utils_netcdf.wait_all(files)
+                return files
+
+            # identical requests running at the same time share a single result
+            files = utils_coalesce.coalesce(coalesce_key(_options), fh, download,
+                                            getattr(_options, 'coalesce_dir', None), utils_cancel.get_token(_options))
+        utils_coverage.record(_options, files)
+        return files
+    finally:
+        stop_wa.stop()
 
-        # set-up the socket timeout if any
-        if _options.socket_timeout is not None:
-            log.debug("Setting timeout %s" % _options.socket_timeout)
-            socket.setdefaulttimeout(_options.socket_timeout)
 
-        if _options.auth_mode == AUTHENTICATION_MODE_CAS:
-            stop_wa.start('authentication')
-            # perform authentication before acceding service
+def read_request(_options, as_dataset=True, memory_limit=None):
+    """Submits a request to motu and returns its result without writing it
+    into the output directory. Available options are the ones of
+    execute_request.
+
+    The result is kept in memory up to memory_limit bytes, and spilled into a
+    temporary file beyond (see utils_stream.SpillingBuffer).
+
+    as_dataset: whether the result is returned as an xarray.Dataset (requires
+                xarray), or raw: a memoryview on the bytes received, or the
+                path of the temporary file if the result has been spilled,
+                which the caller then has to remove. describeProduct and
+                getSize results are always returned raw. A spilled dataset
+                is read lazily from its temporary file, removed when the
+                dataset is closed (or garbage collected)
+    memory_limit: the size (bytes) above which the result is spilled to a
+                  temporary file, utils_stream.DEFAULT_MEMORY_LIMIT if not set
+    """
+    global init_time
+
+    log = logging.getLogger("motu_api")
+    init_time = datetime.datetime.now()
+    check_options(_options)
+    normalize_request(_options)
+    if memory_limit is None:
+        memory_limit = utils_stream.DEFAULT_MEMORY_LIMIT
+    buffer = utils_stream.SpillingBuffer(memory_limit)
+    files = process_request(_options, buffer)
+    as_dataset = as_dataset and not (_options.describe or _options.size)
+
+    if files:
+        # the request has been split into several parts by the server size limit
+        if not as_dataset:
+            raise Exception(utils_messages.get_external_messages()['motu-client.exception.read.split'] %
+                            ', '.join(files))
+        import xarray as xr
+        log.info("Opening the %i parts of the result", len(files))
+        return xr.open_mfdataset(files, combine='by_coords')
+
+    if not as_dataset:
+        return buffer.getbuffer() if buffer.path is None else buffer.path
+
+    import xarray as xr
+    if buffer.path is None:
+        return xr.open_dataset(buffer.getbuffer())
+    try:
+        dataset = xr.open_dataset(buffer.path)
+    except Exception:
+        os.remove(buffer.path)
+        raise
+    return _remove_on_close(dataset, buffer.path)
+
+
+def _remove_on_close(dataset, path):
+    """Removes the given file once the dataset read from it is closed, or
+    garbage collected if it is never closed.
+
+    returns the dataset"""
+    import weakref
+
+    def remove():
+        if os.path.exists(path):
+            os.remove(path)
+
+    remover = weakref.finalize(dataset, remove)
+    close = dataset._close
+
+    def close_and_remove():
+        try:
+            if close is not None:
+                close()
+        finally:
+            remover()
+
+    dataset.set_close(close_and_remove)
+    return dataset
+
+
+def get_size(_options):
+    """Asks Motu the size of the result of a request (getSize request).
+
+    _options: the options of the request (see execute_request), modified to
+              run the getSize request
+
+    returns the size in bytes"""
+    _options.size = True
+    _options.describe = False
+    reply = read_request(_options, as_dataset=False)
+    if isinstance(reply, str):
+        path = reply
+        try:
+            with open(path, 'rb') as f:
+                reply = f.read()
+        finally:
+            os.remove(path)
+    dom = minidom.parseString(bytes(reply))
+    for node in dom.getElementsByTagName('requestSize'):
+        size = node.getAttribute('size')
+        if size and float(size) >= 0:
+            return utils_unit.to_bytes(size, node.getAttribute('unit') or 'kb')
+        break
+    raise Exception(utils_messages.get_external_messages()['motu-client.exception.motu.error'] % bytes(reply).decode(
+        'utf-8', 'replace'))
+
+
+def process_request(_options, fh):
+    """Submits the (checked) request to Motu and writes the result into fh
+    (a file name, "console" or a buffer object).
+
+    returns the list of the files written"""
+    from . import utils_cas
+    from . import utils_http
+    log = logging.getLogger("motu_api")
+    stop_wa = stop_watch.local_thread_stop_watch()
+    files = []
+    to_file = isinstance(fh, str) and not fh.startswith("console")
+    cancel = utils_cancel.get_token(_options)
+    utils_cancel.check(cancel)
+    started = time.time()
+    utils_http.configure_tls(getattr(_options, 'ca_bundle', None), getattr(_options, 'tls_ciphers', None))
+    utils_log.configure_events(getattr(_options, 'event_log', None))
+    # the connections are used once ready, the ticket granting ticket once
+    # the login is over
+    login = prewarm(_options) if getattr(_options, 'prewarm', False) else None
+
+    # apply the bandwidth and concurrency limits given in the options, if any
+    utils_governor.get_governor().configure(getattr(_options, 'max_rate', None),
+                                            getattr(_options, 'max_per_host', None),
+                                            getattr(_options, 'adaptive_concurrency', None))
+
+    # start of url to invoke
+    url_service = _options.motu
+
+    # parameters of the invoked service
+    url_params = build_params(_options)
+
+    url_config = get_url_config(_options)
+
+    # check if question mark is in the url
+    question_mark = '?'
+    if url_service.endswith(question_mark):
+        question_mark = ''
+    url = url_service + question_mark + url_params
+
+    # set-up the socket timeout if any
+    if _options.socket_timeout is not None:
+        log.debug("Setting timeout %s" % _options.socket_timeout)
+        socket.setdefaulttimeout(_options.socket_timeout)
+
+    if _options.auth_mode == AUTHENTICATION_MODE_CAS:
+        stop_wa.start('authentication')
+        auth_started = time.time()
+        # perform authentication before acceding service
+        with utils_trace.span('auth', _options, kind=utils_trace.KIND_CLIENT):
             download_url = utils_cas.authenticate_CAS_for_URL(url,
                                                               _options.user,
                                                               _options.pwd,
+                                                              login=login,
                                                               **url_config)
-            url_service = download_url.split("?")[0]
+        url_service = download_url.split("?")[0]
+        log_event(_options, 'auth', latency=time.time() - auth_started)
+        stop_wa.stop('authentication')
+    else:
+        # if none, we do nothing more, in basic, we let the url requester doing the job
+        download_url = url
+
+    # Synchronous mode
+    if _options.sync or _options.describe or _options.size:
+        is_a_download_request = False
+        if not _options.describe and not _options.size:
+            is_a_download_request = True
+        download_started = time.time()
+        with utils_trace.span('download', _options, kind=utils_trace.KIND_CLIENT, mode='sync') as span:
+            dl_2_file(download_url, fh, _options.block_size, is_a_download_request, getattr(_options, 'fsync', False),
+                      progress=first_byte(started), cancel=cancel, **dict(url_config, **speed_limits(_options)))
+            if span is not None and to_file:
+                span.set(bytes=os.path.getsize(fh))
+        log_event(_options, 'download', bytes=os.path.getsize(fh) if to_file else None,
+                  latency=time.time() - download_started)
+        if to_file:
+            files.append(fh)
+            if is_a_download_request:
+                transcode_output(_options, fh)
+        log.info("Done")
+    # Asynchronous mode
+    else:
+        stop_wa.start('wait_request')
+        # the journal records the progress of the request so that a restarted
+        # client reattaches to it instead of submitting it again
+        journal = utils_journal.get_journal(getattr(_options, 'journal', None)) if to_file else None
+        key = request_key(_options) if journal is not None else None
+        job = journal.get(key) if journal is not None else None
+        if job is not None and job['status'] not in utils_journal.PENDING:
+            job = None
+        skip = False
+        status = None
+        dwurl = ""
+        msg = ""
+
+        # the durations of the past requests of the product predict when the
+        # result is ready, so that its status is requested around that time
+        history = utils_polling.get_history(getattr(_options, 'poll_history', None) or
+                                            getattr(_options, 'journal', None))
+        bucket = None
+        schedule = None
+        submitted = time.time()
+        if history is not None:
+            from . import motu_scheduler
+            source = motu_scheduler.ESTIMATES_METADATA if getattr(_options, 'metadata_cache', None) \
+                else motu_scheduler.ESTIMATES_HISTORY
+            bucket = utils_polling.size_bucket(motu_scheduler.estimate_size(_options, source))
+            schedule = history.schedule(_options.service_id, _options.product_id, bucket)
+
+        # requests larger than the known limit of the service are split
+        # before being submitted, instead of waiting for a 004-7 error
+        parts = presplit_parts(_options) if job is None and not getattr(_options, 'split_part', False) else 1
+        if parts > 1:
+            stop_wa.stop('wait_request')
+            return files + execute_parts(_options, parts)
+
+        try:
+            if job is not None and job['remote_uri']:
+                log.info('Reattaching to the request %s, ready for download' % job['request_id'])
+                status = "1"
+                dwurl = job['remote_uri']
+            elif job is not None and job['status_url']:
+                log.info('Reattaching to the request %s' % job['request_id'])
+                status, dwurl, msg = wait_for_request(_options, job['status_url'], schedule, job['created'],
+                                                      **url_config)
+            else:
+                job = None
+                utils_cancel.check(cancel)
+                submitted = time.time()
+                with utils_trace.span('submit', _options, kind=utils_trace.KIND_CLIENT) as span:
+                    request_url = get_request_url(download_url, url_service, cancel, **url_config)
+                    if span is not None and request_url is not None:
+                        span.set(request_id=request_url.rpartition('requestid=')[2])
+                utils_metrics.get_metrics().observe('request.ttfb', time.time() - started)
+                log_event(_options, 'submit', latency=time.time() - submitted,
+                          request_id=request_url.rpartition('requestid=')[2] if request_url else None)
+                if request_url is not None:
+                    if journal is not None:
+                        journal.record(key, request=canonical_request(_options), target=fh,
+                                       request_id=request_url.rpartition('requestid=')[2],
+                                       status_url=request_url, status=utils_journal.SUBMITTED,
+                                       remote_uri=None, bytes=0, size=None, message=None)
+                    status, dwurl, msg = wait_for_request(_options, request_url, schedule, submitted,
+                                                          **url_config)
+                    if status == "1" and history is not None:
+                        history.record(_options.service_id, _options.product_id, bucket, time.time() - submitted)
+        except HTTPError as e:
+            if journal is not None and job is not None:
+                # the request is unknown to the server, it is submitted again next time
+                journal.record(key, status=utils_journal.FAILED, message=str(e))
+            raise
+        except utils_cancel.Cancelled as e:
+            if journal is not None:
+                journal.record(key, status=utils_journal.CANCELLED, message=str(e))
+            raise
+
+        if status == "2":
+            if journal is not None:
+                journal.record(key, status=utils_journal.FAILED, message=msg)
+            if msg.startswith("004-7 : The result file size"):
+                log.info(msg)
+                sizes = re.findall(r"[1-9][0-9]*.[0-9]+MBytes", msg, flags=0)
+                requested_size = float(sizes[0][:-6])
+                allowed_size = float(sizes[1][:-6])
+                # remembered so that the next requests to the service are split before being submitted
+                size_limits(_options).record(urlparse(_options.motu).netloc, _options.service_id,
+                                             utils_unit.to_bytes(allowed_size, 'MBytes'))
+                parts = int(ceil(requested_size / allowed_size))
+                files += execute_parts(_options, parts)
+                skip = True
+            else:
+                log.error(msg)
+                raise Exception(msg)
+        elif status == "1":
+            log.info('The product is ready for download')
+            if dwurl != "":
+                resume = None
+                progress = None
+                if journal is not None:
+                    # resume the bytes already downloaded by a previous attempt
+                    resume = (job['bytes'] or 0) if job is not None and job['remote_uri'] == dwurl else 0
+                    journal.record(key, status=utils_journal.DOWNLOADING, remote_uri=dwurl, bytes=resume)
+                    progress = journal_progress(journal, key)
+                download_started = time.time()
+                try:
+                    with utils_trace.span('download', _options, kind=utils_trace.KIND_CLIENT,
+                                          resumed_bytes=resume or None) as span:
+                        dl_2_file(dwurl, fh, _options.block_size, not (_options.describe or _options.size),
+                                  getattr(_options, 'fsync', False), resume, progress, cancel,
+                                  **dict(url_config, **speed_limits(_options)))
+                        if span is not None and to_file:
+                            span.set(bytes=os.path.getsize(fh))
+                except HTTPError as e:
+                    if journal is not None:
+                        # the result is no longer available, it is requested again next time
+                        journal.record(key, status=utils_journal.FAILED, message=str(e))
+                    raise
+                except utils_cancel.Cancelled as e:
+                    if journal is not None:
+                        # the partial download has been dropped
+                        journal.record(key, status=utils_journal.CANCELLED, bytes=0, message=str(e))
+                    raise
+                if journal is not None:
+                    journal.record(key, status=utils_journal.DONE)
+                log_event(_options, 'download', bytes=os.path.getsize(fh) if to_file else None,
+                          latency=time.time() - download_started)
+                if to_file:
+                    files.append(fh)
+                    transcode_output(_options, fh)
+                log.info("Done")
+            else:
+                log.error("Couldn't retrieve file")
+        if not skip:
+            stop_wa.stop('wait_request')
+
+    return files
+
+
+def prewarm(_options):
+    """Starts opening the connections of the first exchanges of the request
+    in the background: PREWARM_CONNECTIONS connections to the Motu server
+    and, with CAS authentication, to the CAS server, while logging in to it
+    (see utils_cas.login). The CAS server is the one known from a previous
+    authentication of the process, or else the one the Motu server redirects
+    to (see utils_cas.discover_cas_url). Connections are not opened in
+    advance through a proxy.
+
+    The options are given a session if they have none, to keep the ticket
+    granting ticket.
+
+    returns the future of the login, to be waited for before using the
+    ticket granting ticket of the session, None if no login is started"""
+    from . import utils_cas
+    from . import utils_http
+    log = logging.getLogger("motu_api")
+    if _options.proxy:
+        return None
+    if getattr(_options, 'session', None) is None:
+        _options.session = utils_http.Session()
+    url_config = get_url_config(_options)
+
+    def run(task, *args, **kwargs):
+        try:
+            task(*args, **kwargs)
+        except Exception as e:
+            # the request meets the same error and reports it
+            log.debug("Pre-warm failed: %s", e)
+
+    def login():
+        url_cas = utils_cas.known_cas_url(_options.motu)
+        if url_cas is None:
+            url_cas = utils_cas.discover_cas_url(_options.motu, **url_config)
+            if url_cas is None:
+                return
+        connections = ThreadPoolExecutor(max_workers=PREWARM_CONNECTIONS)
+        for _ in range(PREWARM_CONNECTIONS):
+            connections.submit(run, utils_http.warm, url_cas)
+        connections.shutdown(wait=False)
+        utils_cas.login(url_cas, _options.user, _options.pwd, **url_config)
+
+    cas = _options.auth_mode == AUTHENTICATION_MODE_CAS
+    executor = ThreadPoolExecutor(max_workers=PREWARM_CONNECTIONS + 1)
+    for _ in range(PREWARM_CONNECTIONS):
+        executor.submit(run, utils_http.warm, _options.motu)
+    future = executor.submit(run, login) if cas else None
+    executor.shutdown(wait=False)
+    return future
+
+
+def first_byte(started):
+    """Returns a progress function for dl_2_file recording the time from
+    started to the first bytes downloaded (request.ttfb metric)."""
+    recorded = []
+
+    def progress(written, size, final=False):
+        if not recorded and not final:
+            recorded.append(True)
+            utils_metrics.get_metrics().observe('request.ttfb', time.time() - started)
+
+    return progress
+
+
+def size_limits(_options):
+    """Returns the utils_limits.SizeLimits of the services, stored in the
+    'limits_file' option, or the journal file."""
+    return utils_limits.get_limits(getattr(_options, 'limits_file', None) or getattr(_options, 'journal', None))
+
+
+def request_dates(_options):
+    """Returns the bounds of the period of a request (strings or datetimes),
+    as datetimes (UTC).
+
+    raises ValueError if a date string is not in one of the formats of
+    utils_metadata.DATE_FORMATS"""
+    return tuple(datetime.datetime.utcfromtimestamp(utils_metadata.parse_date(value))
+                 for value in (_options.date_min, _options.date_max))
+
+
+def _is_day(value):
+    return isinstance(value, str) and len(value.strip()) == len('YYYY-MM-DD')
+
+
+def _format_date(date, day):
+    return date.strftime('%Y-%m-%d' if day else '%Y-%m-%d %H:%M:%S')
+
+
+def presplit_parts(_options):
+    """Returns the number of parts the request must be split into to fit
+    into the size limit of its service learned from previous 004-7 errors, 1
+    if the limit or the size of the request is unknown.
+
+    The size is estimated as set by the 'size_estimates' option, with a
+    getSize request by default. The getSize request is only sent if the size
+    estimated offline is unknown or near the limit (see
+    motu_scheduler.estimate_offline and utils_limits.CHECK_THRESHOLD), the
+    offline estimate being used otherwise."""
+    from . import motu_scheduler
+    log = logging.getLogger("motu_api")
+    allowed = size_limits(_options).allowed(urlparse(_options.motu).netloc, _options.service_id)
+    if allowed is None or not _options.date_min or not _options.date_max:
+        return 1
+    try:
+        date_min, date_max = request_dates(_options)
+    except ValueError:
+        # requests with dates of unknown format are not split
+        return 1
+    source = getattr(_options, 'size_estimates', None) or motu_scheduler.ESTIMATES_GETSIZE
+    size = None
+    if source == motu_scheduler.ESTIMATES_GETSIZE:
+        # a getSize round trip is only worth it near the limit
+        size = motu_scheduler.estimate_offline(_options)
+        threshold = utils_limits.CHECK_THRESHOLD
+        if size is not None and allowed * threshold <= size <= allowed / threshold:
+            size = None
+    if size is None:
+        size = motu_scheduler.estimate_size(_options, source)
+    if size is None or size <= allowed * utils_limits.SAFETY_MARGIN:
+        return 1
+    parts = min(int(ceil(size / (allowed * utils_limits.SAFETY_MARGIN))), (date_max - date_min).days + 1)
+    log.info("Estimated size %s above the limit of the service (%s)" % (
+        utils_unit.convert_bytes(size), utils_unit.convert_bytes(allowed)))
+    return parts
+
+
+def execute_parts(_options, parts):
+    """Splits the request into the given number of parts by dates, and
+    downloads each part into its own file (suffixed by _<part index>).
+
+    returns the list of the files written"""
+    log = logging.getLogger("motu_api")
+    files = []
+    log.info("Downloading by {} parts.".format(parts))
+    date_min, date_max = request_dates(_options)
+    date_delta = (date_max - date_min) // parts
+    # parts of whole days follow each other by days, others by seconds
+    days = _is_day(_options.date_min) and _is_day(_options.date_max)
+    step = datetime.timedelta(days=1) if days else datetime.timedelta(seconds=1)
+    dates = list()
+    start = date_min
+    for i in range(parts - 1):
+        end = date_min + date_delta * (i + 1)
+        dates.append((_format_date(start, days), _format_date(end, days)))
+        start = end + step
+        log.info("Part {}: {} - {}".format(i + 1, dates[-1][0], dates[-1][1]))
+    dates.append((_format_date(start, days), _format_date(date_max, days)))
+    log.info("Part {}: {} - {}".format(parts, dates[-1][0], dates[-1][1]))
+    base_name, extension = os.path.splitext(_options.out_name)
+    # Download each part
+    for i, (dmin, dmax) in enumerate(dates):
+        log.info("Downloading part {}".format(i + 1))
+        part = copy.copy(_options)
+        part.out_name = base_name + "_" + str(i) + extension
+        part.date_min = dmin
+        part.date_max = dmax
+        # parts already fit, unless the estimate was wrong (004-7 error)
+        part.split_part = True
+        part.cancel = utils_cancel.child_token(_options)
+        files += execute_request(part)
+    return files
+
+
+def wait_for_request(_options, request_url, schedule=None, submitted=None, **url_config):
+    """Polls the status of a submitted request until it is finished.
+
+    request_url: the url giving the status of the request
+    schedule: the utils_polling.PollSchedule giving the delays between the
+              status requests, every 10 seconds if not set
+    submitted: the time the request has been submitted, now if not set
+
+    returns the (status, remote uri, message) of the request, the status being
+    "1" if the result is ready and "2" on error"""
+    from . import utils_cas
+    from . import utils_http
+    log = logging.getLogger("motu_api")
+    stop_wa = stop_watch.local_thread_stop_watch()
+    cancel = utils_cancel.get_token(_options)
+    status = 0
+    dwurl = ""
+    msg = ""
+    if schedule is None:
+        schedule = utils_polling.PollSchedule()
+    if submitted is None:
+        submitted = time.time()
+    polls = 0
+
+    delay = schedule.first_delay(time.time() - submitted)
+    if delay > 0:
+        log.info('Waiting %.0fs for the request to be processed' % delay)
+        utils_cancel.sleep(cancel, delay)
+
+    while True:
+        utils_cancel.check(cancel)
+        if _options.auth_mode == AUTHENTICATION_MODE_CAS:
+            stop_wa.start('authentication')
+            # perform authentication before acceding service
+            with utils_trace.span('auth', _options, kind=utils_trace.KIND_CLIENT):
+                request_url_cas = utils_cas.authenticate_CAS_for_URL(request_url,
+                                                                     _options.user,
+                                                                     _options.pwd, **url_config)
             stop_wa.stop('authentication')
         else:
             # if none, we do nothing more, in basic, we let the url requester doing the job
-            download_url = url
+            request_url_cas = request_url
+
+        poll_started = time.time()
+        with utils_trace.span('poll', _options, kind=utils_trace.KIND_CLIENT, poll=polls + 1) as span:
+            m = utils_http.open_url(request_url_cas, compressed=True, **url_config)
+            motu_reply = m.read()
+            dom = minidom.parseString(motu_reply)
+            polls += 1
+
+            for node in dom.getElementsByTagName('statusModeResponse'):
+                status = node.getAttribute('status')
+                dwurl = node.getAttribute('remoteUri')
+                msg = node.getAttribute('msg')
+            if span is not None:
+                span.set(status=status)
+        log_event(_options, 'poll', latency=time.time() - poll_started, status=status, polls=polls)
+
+        # Check status
+        if status == "0" or status == "3":
+            # in progress/pending
+            log.info('Product is not yet available (request in process)')
+            utils_cancel.sleep(cancel, schedule.next_delay(time.time() - submitted))
+        else:
+            # finished (error|success)
+            break
 
-        # create a file for storing downloaded stream
-        fh = os.path.join(_options.out_dir, _options.out_name)
-        if _options.console_mode:
-            fh = "console"
+    log.debug('Request finished after %.0fs and %i status requests' % (time.time() - submitted, polls))
+    return status, dwurl, msg
 
-        try:
-            # Synchronous mode
-            if _options.sync or _options.describe or _options.size:
-                is_a_download_request = False
-                if not _options.describe and not _options.size:
-                    is_a_download_request = True
-                dl_2_file(download_url, fh, _options.block_size, is_a_download_request, **url_config)
-                log.info("Done")
-            # Asynchronous mode
-            else:
-                stop_wa.start('wait_request')
-                request_url = get_request_url(download_url, url_service, **url_config)
-                skip = False
 
-                if request_url is not None:
-                    # asynchronous mode
-                    status = 0
-                    dwurl = ""
-                    msg = ""
-
-                    while True:
-                        if _options.auth_mode == AUTHENTICATION_MODE_CAS:
-                            stop_wa.start('authentication')
-                            # perform authentication before acceding service
-                            request_url_cas = utils_cas.authenticate_CAS_for_URL(request_url,
-                                                                                 _options.user,
-                                                                                 _options.pwd, **url_config)
-                            stop_wa.stop('authentication')
-                        else:
-                            # if none, we do nothing more, in basic, we let the url requester doing the job
-                            request_url_cas = request_url
-
-                        m = utils_http.open_url(request_url_cas, **url_config)
-                        motu_reply = m.read()
-                        dom = minidom.parseString(motu_reply)
-
-                        for node in dom.getElementsByTagName('statusModeResponse'):
-                            status = node.getAttribute('status')
-                            dwurl = node.getAttribute('remoteUri')
-                            msg = node.getAttribute('msg')
-
-                        # Check status
-                        if status == "0" or status == "3":
-                            # in progress/pending
-                            log.info('Product is not yet available (request in process)')
-                            time.sleep(10)
-                        else:
-                            # finished (error|success)
-                            break
-
-                    if status == "2":
-                        if msg.startswith("004-7 : The result file size"):
-                            import xarray as xr
-                            log.info(msg)
-                            sizes = re.findall(r"[1-9][0-9]*.[0-9]+MBytes", msg, flags=0)
-                            requested_size = float(sizes[0][:-6])
-                            allowed_size = float(sizes[1][:-6])
-                            parts = int(ceil(requested_size / allowed_size))
-                            log.info("Downloading by {} parts.".format(parts))
-                            date_min = datetime.datetime.strptime(_options.date_min, '%Y-%m-%d')
-                            date_max = datetime.datetime.strptime(_options.date_max, '%Y-%m-%d')
-                            date_delta = (date_max - date_min) // parts
-                            dates = list()
-                            for i in range(parts - 1):
-                                dates.append((date_min.strftime('%Y-%m-%d'),
-                                              (date_min + date_delta).strftime('%Y-%m-%d')))
-                                date_min += date_delta + datetime.timedelta(days=1)
-                                log.info("Part {}: {} - {}".format(i + 1, dates[-1][0], dates[-1][1]))
-                            dates.append((date_min.strftime('%Y-%m-%d'), date_max.strftime('%Y-%m-%d')))
-                            log.info("Part {}: {} - {}".format(parts, dates[-1][0], dates[-1][1]))
-                            base_name, extension = os.path.splitext(_options.out_name)
-                            # Download each part
-                            for i, (dmin, dmax) in enumerate(dates):
-                                log.info("Downloading part {}".format(i + 1))
-                                _options.out_name = base_name + "_" + str(i) + extension
-                                _options.date_min = dmin
-                                _options.date_max = dmax
-                                execute_request(_options)
-                            skip = True
-                        else:
-                            log.error(msg)
-                            raise Exception(msg)
-                    elif status == "1":
-                        log.info('The product is ready for download')
-                        if dwurl != "":
-                            dl_2_file(dwurl, fh, _options.block_size, not (_options.describe or _options.size),
-                                      **url_config)
-                            log.info("Done")
-                        else:
-                            log.error("Couldn't retrieve file")
-                if not skip:
-                    stop_wa.stop('wait_request')
-        except Exception:
-            try:
-                if os.path.isfile(fh):
-                    os.remove(fh)
-            except Exception:
-                pass
-            raise
-    finally:
-        stop_wa.stop()
+def log_event(_options, phase, **fields):
+    """Logs a structured event of the request (see utils_log.event), the job
+    being identified by the key of the request."""
+    if utils_log.events_enabled():
+        utils_log.event(phase, job=request_key(_options)[:12], **fields)
+
+
+def journal_progress(journal, key, interval=JOURNAL_PROGRESS_INTERVAL):
+    """Returns a progress function for dl_2_file recording the bytes written
+    in the journal, at most every interval seconds."""
+    last = [0]
+
+    def progress(written, size, final=False):
+        now = time.time()
+        if final:
+            journal.record(key, bytes=written)
+        elif now - last[0] >= interval:
+            last[0] = now
+            journal.record(key, bytes=written, size=size)
+
+    return progress
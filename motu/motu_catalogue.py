@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import copy
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import motu_api
+from . import utils_metadata
+
+# default time (seconds) after which the description of a product is
+# requested again by a refresh
+DEFAULT_MAX_AGE = utils_metadata.DEFAULT_MAX_AGE
+
+# default number of descriptions requested at the same time by a refresh
+DEFAULT_MAX_WORKERS = 4
+
+# products whose longitudes span at least this many degrees are global
+GLOBAL_LONGITUDE_SPAN = 359.
+
+# bounds stored in the spatial index for the unknown extents
+UNKNOWN_LOWER = -1e30
+UNKNOWN_UPPER = 1e30
+
+
+class Catalogue(object):
+    """Local index of the describeProduct results of products, stored in a
+    SQLite database, to find offline the products covering a region, a
+    period, depths and variables.
+
+    The extents are indexed with an R*Tree when SQLite provides it, and with
+    B-tree indexes otherwise."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS products ("
+                                     "id INTEGER PRIMARY KEY, service TEXT NOT NULL, product TEXT NOT NULL, "
+                                     "lon_min REAL, lon_max REAL, lat_min REAL, lat_max REAL, "
+                                     "depth_min REAL, depth_max REAL, time_min REAL, time_max REAL, "
+                                     "refreshed REAL, digest TEXT, description BLOB, "
+                                     "UNIQUE (service, product))")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS variables ("
+                                     "product INTEGER NOT NULL, name TEXT NOT NULL, standard_name TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS variables_name ON variables (name)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS variables_standard_name "
+                                     "ON variables (standard_name)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS variables_product ON variables (product)")
+            try:
+                self._connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_extent USING rtree("
+                                         "id, lon_min, lon_max, lat_min, lat_max, time_min, time_max)")
+                self.rtree = True
+            except sqlite3.OperationalError:
+                self.rtree = False
+                self._connection.execute("CREATE INDEX IF NOT EXISTS products_lat ON products (lat_min, lat_max)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS products_time "
+                                         "ON products (time_min, time_max)")
+
+    def index(self, grid, description=None, digest=None):
+        """Adds or replaces the given utils_metadata.ProductGrid in the
+        catalogue, with the describeProduct result it comes from."""
+        time_range = grid.time_range
+        lon = grid.lon or utils_metadata.Axis(None, None)
+        lat = grid.lat or utils_metadata.Axis(None, None)
+        values = (lon.lower, lon.upper, lat.lower, lat.upper,
+                  grid.depths[0] if grid.depths else None, grid.depths[-1] if grid.depths else None,
+                  time_range[0] if time_range else None, time_range[1] if time_range else None,
+                  time.time(), digest, description)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("INSERT OR IGNORE INTO products (service, product) VALUES (?, ?)",
+                                     (grid.service_id, grid.product_id))
+            product = self._connection.execute("SELECT id FROM products WHERE service = ? AND product = ?",
+                                               (grid.service_id, grid.product_id)).fetchone()['id']
+            self._connection.execute("UPDATE products SET lon_min = ?, lon_max = ?, lat_min = ?, lat_max = ?, "
+                                     "depth_min = ?, depth_max = ?, time_min = ?, time_max = ?, refreshed = ?, "
+                                     "digest = ?, description = ? WHERE id = ?", values + (product,))
+            self._connection.execute("DELETE FROM variables WHERE product = ?", (product,))
+            self._connection.executemany("INSERT INTO variables (product, name, standard_name) VALUES (?, ?, ?)",
+                                         [(product, name, grid.standard_names.get(name))
+                                          for name in grid.variables])
+            if self.rtree:
+                lon_min, lon_max = _index_longitudes(lon.lower, lon.upper)
+                self._connection.execute("INSERT OR REPLACE INTO products_extent VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (product, lon_min, lon_max,
+                                          _known(lat.lower, UNKNOWN_LOWER), _known(lat.upper, UNKNOWN_UPPER),
+                                          _known(values[6], UNKNOWN_LOWER), _known(values[7], UNKNOWN_UPPER)))
+
+    def remove(self, service_id, product_id):
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            row = self._connection.execute("SELECT id FROM products WHERE service = ? AND product = ?",
+                                           (service_id, product_id)).fetchone()
+            if row is None:
+                return
+            self._connection.execute("DELETE FROM variables WHERE product = ?", (row['id'],))
+            self._connection.execute("DELETE FROM products WHERE id = ?", (row['id'],))
+            if self.rtree:
+                self._connection.execute("DELETE FROM products_extent WHERE id = ?", (row['id'],))
+
+    def refresh(self, _options, products, max_age=DEFAULT_MAX_AGE, force=False, max_workers=DEFAULT_MAX_WORKERS):
+        """Requests the description of the given products and indexes them.
+
+        Products described less than max_age seconds ago are skipped, unless
+        force is set, and the products whose description has not changed are
+        only marked as refreshed.
+
+        _options: the options of the requests (see motu_api.execute_request),
+                  giving the Motu server and the authentication
+        products: a list of (service id, product id) tuples
+
+        returns the number of products per outcome: 'added', 'updated',
+        'unchanged', 'skipped' and 'failed'"""
+        log = logging.getLogger("motu_catalogue")
+        counts = dict.fromkeys(('added', 'updated', 'unchanged', 'skipped', 'failed'), 0)
+        with self._lock:
+            known = dict(((row['service'], row['product']), row) for row in
+                         self._connection.execute("SELECT service, product, refreshed, digest FROM products"))
+        now = time.time()
+        stale = []
+        for service_id, product_id in products:
+            row = known.get((service_id, product_id))
+            if not force and row is not None and row['refreshed'] and now - row['refreshed'] < max_age:
+                counts['skipped'] += 1
+            else:
+                stale.append((service_id, product_id))
+
+        if getattr(_options, 'session', None) is None:
+            from . import utils_http
+            _options = copy.copy(_options)
+            _options.session = utils_http.Session()
+
+        def describe(product):
+            options = copy.copy(_options)
+            options.service_id, options.product_id = product
+            return utils_metadata.describe_product(options)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stale)))) as executor:
+            futures = [(product, executor.submit(describe, product)) for product in stale]
+            for (service_id, product_id), future in futures:
+                try:
+                    description = future.result()
+                    digest = hashlib.sha1(description).hexdigest()
+                    row = known.get((service_id, product_id))
+                    if row is not None and row['digest'] == digest:
+                        with self._lock:
+                            self._connection.execute("UPDATE products SET refreshed = ? WHERE service = ? AND "
+                                                     "product = ?", (time.time(), service_id, product_id))
+                        counts['unchanged'] += 1
+                        continue
+                    grid = utils_metadata.parse_describe(description, service_id, product_id)
+                    self.index(grid, description, digest)
+                    counts['updated' if row is not None else 'added'] += 1
+                except Exception as e:
+                    log.error("Unable to describe %s/%s: %s", service_id, product_id, e)
+                    counts['failed'] += 1
+        log.info("Catalogue refreshed: %s", ', '.join('%i %s' % (n, k) for k, n in sorted(counts.items())))
+        return counts
+
+    def query(self, x_lo=None, x_hi=None, y_lo=None, y_hi=None, z_lo=None, z_hi=None, t_lo=None, t_hi=None,
+              variables=None, covering=True):
+        """Returns the products covering (or intersecting, if covering is not
+        set) the given extent and having all the given variables, as
+        dictionaries sorted by service and product.
+
+        The longitudes can cross the antimeridian (x_lo > x_hi), the times
+        are in seconds since the epoch or date strings, and the variables
+        match the names or the standard names of the variables. Bounds which
+        are not set are not checked; products whose extent is unknown only
+        match when the corresponding bounds are not set."""
+        t_lo, t_hi = (utils_metadata.parse_date(t) if isinstance(t, str) else t for t in (t_lo, t_hi))
+        use_rtree = self.rtree and any(v is not None for v in (x_lo, x_hi, y_lo, y_hi, t_lo, t_hi))
+        tables = ["products p"]
+        conditions = []
+        args = []
+
+        def extent(lower, upper, lo, hi, columns):
+            # lo and hi default to each other, a single value being a point
+            lo = hi if lo is None else lo
+            hi = lo if hi is None else hi
+            if lo is None:
+                return
+            for column in columns:
+                conditions.append("%s.%s <= ? AND %s.%s >= ?" % (column, lower, column, upper))
+                args.extend((lo, hi) if covering else (hi, lo))
+
+        columns = ('e', 'p') if use_rtree else ('p',)
+        if use_rtree:
+            tables.append("products_extent e ON e.id = p.id")
+        extent('lat_min', 'lat_max', y_lo, y_hi, columns)
+        extent('time_min', 'time_max', t_lo, t_hi, columns)
+        extent('depth_min', 'depth_max', z_lo, z_hi, ('p',))
+        if x_lo is not None or x_hi is not None:
+            conditions.append("p.lon_min IS NOT NULL AND p.lon_max IS NOT NULL")
+            x_lo = x_hi if x_lo is None else x_lo
+            x_hi = x_lo if x_hi is None else x_hi
+            boxes = _intervals(x_lo, x_hi) if x_lo <= x_hi else []
+            if use_rtree and len(boxes) == 1:
+                conditions.append("e.lon_min <= ? AND e.lon_max >= ?")
+                args.extend(boxes[0] if covering else boxes[0][::-1])
+        for name in set(variables or ()):
+            conditions.append("p.id IN (SELECT product FROM variables WHERE name = ? OR standard_name = ?)")
+            args.extend((name, name))
+
+        query = "SELECT p.* FROM " + " JOIN ".join(tables)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY p.service, p.product"
+        with self._lock:
+            rows = self._connection.execute(query, args).fetchall()
+            results = []
+            for row in rows:
+                if x_lo is not None and not _match_longitudes(row['lon_min'], row['lon_max'], x_lo, x_hi, covering):
+                    continue
+                names = [v['name'] for v in self._connection.execute(
+                    "SELECT name FROM variables WHERE product = ? ORDER BY name", (row['id'],))]
+                results.append(_to_product(row, names))
+        return results
+
+    def products(self):
+        """Returns all the products of the catalogue."""
+        return self.query()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _known(value, default):
+    return default if value is None else value
+
+
+def _intervals(lo, hi):
+    """Splits a longitude range into intervals within [-180, 180]."""
+    if hi - lo >= GLOBAL_LONGITUDE_SPAN:
+        return [(-180., 180.)]
+    lo = motu_api.normalize_longitude(lo)
+    hi = motu_api.normalize_longitude(hi)
+    if lo <= hi:
+        return [(lo, hi)]
+    return [(lo, 180.), (-180., hi)]
+
+
+def _index_longitudes(lo, hi):
+    """The longitude range stored in the spatial index: the smallest interval
+    within [-180, 180] containing the range."""
+    if lo is None or hi is None:
+        return UNKNOWN_LOWER, UNKNOWN_UPPER
+    intervals = _intervals(lo, hi)
+    if len(intervals) > 1:
+        return -180., 180.
+    return intervals[0]
+
+
+def _match_longitudes(lon_min, lon_max, x_lo, x_hi, covering):
+    products = _intervals(lon_min, lon_max)
+    if x_lo > x_hi:
+        # box crossing the antimeridian
+        boxes = [(motu_api.normalize_longitude(x_lo), 180.), (-180., motu_api.normalize_longitude(x_hi))]
+    else:
+        boxes = _intervals(x_lo, x_hi)
+    if covering:
+        return all(any(p_lo <= b_lo and b_hi <= p_hi for p_lo, p_hi in products) for b_lo, b_hi in boxes)
+    return any(p_lo <= b_hi and b_lo <= p_hi for p_lo, p_hi in products for b_lo, b_hi in boxes)
+
+
+def _to_product(row, variables):
+    def date(value):
+        if value is None:
+            return None
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+
+    return {'service_id': row['service'],
+            'product_id': row['product'],
+            'longitude': (row['lon_min'], row['lon_max']),
+            'latitude': (row['lat_min'], row['lat_max']),
+            'depth': (row['depth_min'], row['depth_max']),
+            'time': (date(row['time_min']), date(row['time_max'])),
+            'variables': variables,
+            'refreshed': row['refreshed']}
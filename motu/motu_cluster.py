@@ -0,0 +1,466 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import motu_api
+from . import motu_fanout
+from . import utils_cancel
+from . import utils_coalesce
+from . import utils_messages
+from . import utils_netcdf
+
+# default time (seconds) a lease is held without heartbeat before its job is
+# given to another worker
+DEFAULT_LEASE_TIME = 120
+
+# number of times a job is tried (failures and crashed workers) before being
+# given up
+MAX_ATTEMPTS = 3
+
+# lease statuses
+LEASED = 'leased'
+RELEASED = 'released'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class SQLiteLeases(object):
+    """Leases of the jobs of a batch shared by several workers, stored in a
+    SQLite database. The file must be on a file system whose locks SQLite
+    can rely on (local disk, or a network file system with working locks),
+    see DirectoryLeases otherwise.
+
+    Expiry dates are compared between workers: their clocks must be
+    synchronized."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                                     "key TEXT PRIMARY KEY, status TEXT, worker TEXT, expires REAL, "
+                                     "attempts INTEGER, files TEXT, message TEXT, updated REAL)")
+
+    def get(self, key):
+        """Returns the lease of the given key as a dictionary, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM leases WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        lease = dict(row)
+        lease['files'] = json.loads(lease['files']) if lease['files'] else []
+        return lease
+
+    def claim(self, key, worker, ttl, max_attempts=MAX_ATTEMPTS):
+        """Takes the lease of a job for ttl seconds, unless the job is done,
+        leased by a live worker or has been tried max_attempts times.
+
+        returns whether the lease is taken"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            row = self._connection.execute("SELECT status, worker, expires, attempts FROM leases WHERE key = ?",
+                                           (key,)).fetchone()
+            attempts = 0
+            if row is not None:
+                if row['status'] == DONE or row['status'] == LEASED and row['expires'] >= now:
+                    return False
+                if row['status'] == LEASED:
+                    logging.getLogger("motu_cluster").info("Lease of %s expired (worker %s), reassigning it",
+                                                           key, row['worker'])
+                attempts = row['attempts']
+            if attempts >= max_attempts:
+                return False
+            self._connection.execute("INSERT OR IGNORE INTO leases (key) VALUES (?)", (key,))
+            self._connection.execute("UPDATE leases SET status = ?, worker = ?, expires = ?, attempts = ?, "
+                                     "updated = ? WHERE key = ?", (LEASED, worker, now + ttl, attempts + 1, now, key))
+        return True
+
+    def renew(self, key, worker, ttl):
+        """Extends the lease of a job held by the worker (heartbeat).
+
+        returns whether the worker still holds the lease"""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute("UPDATE leases SET expires = ?, updated = ? WHERE key = ? AND "
+                                              "worker = ? AND status = ?", (now + ttl, now, key, worker, LEASED))
+        return cursor.rowcount > 0
+
+    def complete(self, key, worker, files):
+        """Records the files written by the job."""
+        with self._lock:
+            self._connection.execute("UPDATE leases SET status = ?, worker = ?, files = ?, message = NULL, "
+                                     "updated = ? WHERE key = ?", (DONE, worker, json.dumps(files), time.time(), key))
+
+    def fail(self, key, worker, message):
+        """Records the failure of the job, which can then be tried again."""
+        with self._lock:
+            self._connection.execute("UPDATE leases SET status = ?, message = ?, updated = ? WHERE key = ? AND "
+                                     "worker = ? AND status = ?", (FAILED, message, time.time(), key, worker, LEASED))
+
+    def release(self, key, worker):
+        """Gives the lease of a job up without counting it as an attempt, so
+        that another worker runs it at once."""
+        with self._lock:
+            self._connection.execute("UPDATE leases SET status = ?, attempts = attempts - 1, updated = ? WHERE "
+                                     "key = ? AND worker = ? AND status = ?",
+                                     (RELEASED, time.time(), key, worker, LEASED))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class DirectoryLeases(object):
+    """Leases of the jobs of a batch shared by several workers, stored as
+    files in a shared directory. It only relies on exclusive creations and
+    renames, which network file systems without reliable locks support.
+
+    Each job has a <key>.lease file while leased, whose modification time is
+    the last heartbeat, a <key>.done file once done and a <key>.failed file
+    after a failure. Expiry dates are compared between the workers and the
+    file server: their clocks must be synchronized."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        """Returns the lease of the given key as a dictionary, or None."""
+        done = _read_json(self._path(key, 'done'))
+        if done is not None:
+            return dict(done, key=key, status=DONE)
+        lease = self._read_lease(self._path(key, 'lease'))
+        if lease is not None:
+            return dict(lease, key=key, status=LEASED)
+        failed = _read_json(self._path(key, 'failed'))
+        if failed is not None:
+            return dict(failed, key=key, status=FAILED)
+        return None
+
+    def claim(self, key, worker, ttl, max_attempts=MAX_ATTEMPTS):
+        """Takes the lease of a job for ttl seconds, unless the job is done,
+        leased by a live worker or has been tried max_attempts times.
+
+        returns whether the lease is taken"""
+        lease = self.get(key)
+        if lease is not None:
+            if lease['status'] == DONE:
+                return False
+            if lease['status'] == LEASED and (lease['expires'] >= time.time() or not self._steal(key)):
+                return False
+        attempts = lease.get('attempts', 0) if lease is not None else 0
+        if attempts >= max_attempts:
+            return False
+        lease_path = self._path(key, 'lease')
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as lease_file:
+            json.dump({'worker': worker, 'attempts': attempts + 1, 'ttl': ttl}, lease_file)
+        if os.path.exists(self._path(key, 'done')):
+            # completed by the previous holder meanwhile
+            os.remove(lease_path)
+            return False
+        return True
+
+    def renew(self, key, worker, ttl):
+        """Extends the lease of a job held by the worker (heartbeat). The
+        lease keeps the time to live it was claimed with.
+
+        returns whether the worker still holds the lease"""
+        lease_path = self._path(key, 'lease')
+        lease = self._read_lease(lease_path)
+        if lease is None or lease['worker'] != worker:
+            return False
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, key, worker, files):
+        """Records the files written by the job."""
+        _write_json(self._path(key, 'done'), {'worker': worker, 'files': files, 'completed': time.time()})
+        self._drop(key, worker)
+
+    def fail(self, key, worker, message):
+        """Records the failure of the job, which can then be tried again."""
+        lease = self._read_lease(self._path(key, 'lease'))
+        if lease is None or lease['worker'] != worker:
+            return
+        _write_json(self._path(key, 'failed'), {'worker': worker, 'attempts': lease['attempts'],
+                                                'message': message})
+        self._drop(key, worker)
+
+    def release(self, key, worker):
+        """Gives the lease of a job up without counting it as an attempt, so
+        that another worker runs it at once."""
+        self._drop(key, worker)
+
+    def _path(self, key, kind):
+        return os.path.join(self.path, '%s.%s' % (key, kind))
+
+    def _read_lease(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        # a lease being written is considered fresh
+        lease = _read_json(path) or {'worker': None, 'attempts': 0}
+        lease['expires'] = mtime + lease.get('ttl', DEFAULT_LEASE_TIME)
+        return lease
+
+    def _steal(self, key):
+        """Removes the expired lease of a crashed worker. The lease is moved
+        aside first, so that only one worker takes it over.
+
+        returns whether the lease has been removed"""
+        lease_path = self._path(key, 'lease')
+        stale_path = '%s.%s' % (lease_path, uuid.uuid4().hex[:8])
+        try:
+            os.rename(lease_path, stale_path)
+        except OSError:
+            return False
+        lease = self._read_lease(stale_path)
+        if lease is not None and lease['expires'] >= time.time():
+            # renewed or taken by another worker just before: given back
+            try:
+                os.link(stale_path, lease_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        logging.getLogger("motu_cluster").info("Lease of %s expired (worker %s), reassigning it", key,
+                                               lease['worker'] if lease is not None else 'unknown')
+        return True
+
+    def _drop(self, key, worker):
+        lease_path = self._path(key, 'lease')
+        lease = self._read_lease(lease_path)
+        if lease is not None and lease['worker'] == worker:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex[:8])
+    with open(temp_path, 'w') as json_file:
+        json.dump(value, json_file)
+    os.replace(temp_path, path)
+
+
+def get_leases(path):
+    """Returns the leases stored at the given path: a directory (existing, or
+    ending with a separator) or a SQLite file."""
+    if os.path.isdir(path) or path.endswith(os.sep):
+        return DirectoryLeases(path)
+    return SQLiteLeases(path)
+
+
+def worker_id():
+    """Returns the identifier of this worker process, unique in the cluster."""
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+class Heartbeat(object):
+    """Renews the leases held by a worker every third of their time to live.
+    A job whose lease is lost (worker paused for too long, job reassigned) is
+    cancelled, so that it is not downloaded twice."""
+
+    def __init__(self, leases, worker, ttl):
+        self.leases = leases
+        self.worker = worker
+        self.ttl = ttl
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, key, token):
+        with self._lock:
+            self._held[key] = token
+
+    def remove(self, key):
+        with self._lock:
+            self._held.pop(key, None)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        log = logging.getLogger("motu_cluster")
+        while not self._stop.wait(self.ttl / 3.):
+            with self._lock:
+                held = list(self._held.items())
+            for key, token in held:
+                try:
+                    renewed = self.leases.renew(key, self.worker, self.ttl)
+                except Exception as e:
+                    # the shared storage may be briefly unavailable, the lease lasts a bit longer
+                    log.warning("Cannot renew the lease of %s: %s", key, e)
+                    continue
+                if not renewed:
+                    log.warning("Lease of %s lost, cancelling the job", key)
+                    token.cancel()
+
+
+def execute_cluster(_options, templates=None, max_per_server=None):
+    """Runs the jobs of a fan-out (see motu_fanout.execute_fanout) with the
+    other workers sharing the same leases ('cluster' option, see
+    get_leases), each worker running the same command.
+
+    Each job is run by the worker holding its lease, renewed by heartbeats
+    while the job runs. The jobs of a crashed worker are taken over once
+    their lease expires ('lease_time' option, DEFAULT_LEASE_TIME by
+    default); sharing the journal ('journal' option) then lets the new
+    worker reattach to the Motu requests and resume the downloads. Jobs
+    having the same request key are run once, and the result of the jobs
+    already done by a previous run is reused.
+
+    The worker returns once every job is done or has failed MAX_ATTEMPTS
+    times, and raises an exception if any failed.
+
+    returns the list of the files written for all the jobs of the batch"""
+    log = logging.getLogger("motu_cluster")
+    if templates is None:
+        templates = motu_fanout.parse_templates(getattr(_options, 'fanout', None))
+    if max_per_server is None:
+        max_per_server = int(getattr(_options, 'max_per_server', None) or motu_fanout.DEFAULT_MAX_PER_SERVER)
+    ttl = float(getattr(_options, 'lease_time', None) or DEFAULT_LEASE_TIME)
+    if getattr(_options, 'session', None) is None:
+        from . import utils_http
+        _options.session = utils_http.Session()
+
+    leases = get_leases(_options.cluster)
+    worker = worker_id()
+    cancel = utils_cancel.get_token(_options)
+
+    # identical requests are run once
+    groups = OrderedDict()
+    for job in motu_fanout.expand_jobs(_options, templates):
+        motu_api.check_options(job)
+        groups.setdefault(motu_api.request_key(job), []).append(job)
+    log.info("Worker %s joining a batch of %i jobs (%i distinct)", worker,
+             sum(len(jobs) for jobs in groups.values()), len(groups))
+
+    def finished(lease):
+        if lease is None:
+            return False
+        if lease['status'] == DONE:
+            return True
+        live = lease['status'] == LEASED and lease['expires'] >= time.time()
+        return not live and lease['attempts'] >= MAX_ATTEMPTS
+
+    def run(key):
+        job = groups[key][0]
+        job.cancel = utils_cancel.child_token(_options) or utils_cancel.CancelToken()
+        heartbeat.add(key, job.cancel)
+        log.info("Worker %s running job %s", worker, job.product_id)
+        try:
+            files = motu_api.execute_request(job)
+            utils_netcdf.wait_all(files)
+            # the other workers may not run in the same directory
+            leases.complete(key, worker, [os.path.abspath(f) for f in files])
+        except utils_cancel.Cancelled:
+            if cancel is not None and cancel.cancelled:
+                leases.release(key, worker)
+                raise
+            # lease lost, the job belongs to another worker now
+        except Exception as e:
+            log.error("Job %s failed: %s", job.product_id, e)
+            leases.fail(key, worker, str(e))
+        finally:
+            heartbeat.remove(key)
+
+    def work():
+        while True:
+            utils_cancel.check(cancel)
+            pending = [key for key in groups if not finished(leases.get(key))]
+            if not pending:
+                return
+            claimed = next((key for key in pending if leases.claim(key, worker, ttl)), None)
+            if claimed is not None:
+                run(claimed)
+            else:
+                # the other jobs are run by other workers, which may crash
+                utils_cancel.sleep(cancel, ttl / 3.)
+
+    heartbeat = Heartbeat(leases, worker, ttl)
+    try:
+        with ThreadPoolExecutor(max_workers=max_per_server) as executor:
+            for future in [executor.submit(work) for _ in range(max_per_server)]:
+                future.result()
+    finally:
+        heartbeat.stop()
+
+    results = []
+    failures = []
+    for key, jobs in groups.items():
+        lease = leases.get(key)
+        if lease is None or lease['status'] != DONE:
+            log.error("Job %s failed: %s", jobs[0].product_id, lease.get('message') if lease else 'unknown')
+            failures.extend(job.product_id for job in jobs)
+            continue
+        results += lease['files']
+        source = os.path.join(jobs[0].out_dir, jobs[0].out_name)
+        for job in jobs[1:]:
+            results += utils_coalesce.share(source, lease['files'], os.path.join(job.out_dir, job.out_name))
+
+    if failures:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.fanout.failed'] % (
+            len(failures), sum(len(jobs) for jobs in groups.values()), ', '.join(failures)))
+    return results
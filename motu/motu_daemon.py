@@ -0,0 +1,565 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import functools
+import hmac
+import json
+import logging
+import os
+import secrets
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from . import motu_api
+from . import motu_fanout
+from . import motu_scheduler
+from . import utils_cancel
+from . import utils_governor
+from . import utils_messages
+from . import utils_metrics
+from . import utils_netcdf
+
+# default number of jobs run at the same time by the daemon
+DEFAULT_MAX_JOBS = 8
+
+# default time (seconds) a status query waits for the job to finish
+DEFAULT_WAIT = 30
+
+# job statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# statuses of the jobs that are over
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# options of a submitted job which are not returned by status queries
+SECRET_OPTIONS = ('pwd', 'proxy_pwd')
+
+# options of a job which are objects of the process, not sent nor returned
+LOCAL_OPTIONS = ('session', 'cancel', 'trace_span')
+
+# options a client may set on its jobs, the others are the ones of the daemon
+JOB_OPTIONS = ('auth_mode', 'user', 'pwd', 'motu', 'service_id', 'product_id', 'date_min', 'date_max',
+               'latitude_min', 'latitude_max', 'longitude_min', 'longitude_max', 'depth_min', 'depth_max',
+               'variable', 'out_dir', 'out_name', 'sync', 'describe', 'size', 'block_size', 'user_agent', 'fanout', 'priority', 'size_estimates', 'transcode', 'compression_level',
+               'tile_size', 'snap_to_grid', 'speed_limit', 'speed_time')
+
+# directory of the files holding the tokens of the daemons listening on TCP
+TOKEN_DIR = os.path.join('~', '.motu-client')
+
+# longest time (seconds) a status query waits for the job to finish
+MAX_WAIT = 60
+
+# longest time (seconds) a thin client waits for its job between two checks
+# of its cancellation
+CANCEL_CHECK_INTERVAL = 5
+
+
+
+class Job(object):
+    """A request submitted to the daemon."""
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex[:12]
+        self.options = options
+        self.status = QUEUED
+        self.files = []
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.over = threading.Event()
+        self.future = None
+
+    def to_dict(self):
+        options = dict((k, v) for k, v in vars(self.options).items()
+                       if k not in SECRET_OPTIONS and k not in LOCAL_OPTIONS)
+        return {'id': self.id,
+                'status': self.status,
+                'files': self.files,
+                'error': self.error,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'options': options}
+
+
+class Daemon(object):
+    """Runs the submitted requests on a shared session (CAS tickets), with the
+    shared bandwidth and connection limits of the process, no more than
+    max_jobs at a time and no more than max_per_server per Motu server.
+
+    Jobs are started by the scheduler of the process (see
+    motu_scheduler.Scheduler), according to their 'priority' option and to
+    the size of their result, estimated as set by their 'size_estimates'
+    option.
+
+    Clients only set the options of JOB_OPTIONS, the others (journal, logs,
+    caches, proxy...) are the ones of the daemon. The files are written in
+    the output directory of the daemon or below it."""
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS, max_per_server=motu_fanout.DEFAULT_MAX_PER_SERVER, options=None):
+        from . import utils_http
+        self.options = dict((k, v) for k, v in vars(options or motu_api.default_options()).items()
+                            if k not in LOCAL_OPTIONS)
+        self.out_dir = os.path.realpath(self.options.get('out_dir') or '.')
+        self.session = utils_http.Session()
+        self.scheduler = motu_scheduler.get_scheduler(max_per_server)
+        self.scheduler.max_running = max_jobs
+        self.started = time.time()
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, options):
+        """Queues a request.
+
+        options: a dictionary of the options of motu_api.execute_request (or
+                 motu_fanout.execute_fanout if it has a 'fanout' entry)
+
+        returns the job"""
+        job = Job(self.job_options(options))
+        job.options.session = self.session
+        job.options.cancel = utils_cancel.CancelToken()
+        priority = motu_scheduler.parse_priority(getattr(job.options, 'priority', None))
+        # a fan-out only submits its jobs to the scheduler, it holds no server slot
+        fanout = getattr(job.options, 'fanout', None)
+        with self._lock:
+            self.jobs[job.id] = job
+            job.future = self.scheduler.submit(functools.partial(self._run, job),
+                                               None if fanout else job.options.motu, None, priority, job.id)
+        logging.getLogger("motu_daemon").info("Job %s queued", job.id)
+        if not fanout:
+            estimate = threading.Thread(target=self._estimate, args=(job,))
+            estimate.daemon = True
+            estimate.start()
+        return job
+
+    def job_options(self, values):
+        """Returns the options of a job: the options of the daemon, updated
+        with the given values of the options a client may set.
+
+        raises ValueError if the output of the job is not in the output
+        directory of the daemon"""
+        ignored = sorted(k for k in values if k not in JOB_OPTIONS and k not in LOCAL_OPTIONS)
+        if ignored:
+            logging.getLogger("motu_daemon").debug("Options of the daemon kept: %s", ', '.join(ignored))
+        options = dict(self.options)
+        options.update((k, v) for k, v in values.items() if k in JOB_OPTIONS)
+        out_dir = os.path.realpath(os.path.join(self.out_dir, options.get('out_dir') or '.'))
+        if os.path.commonpath([self.out_dir, out_dir]) != self.out_dir:
+            raise ValueError('the output directory %s is not in %s' % (options.get('out_dir'), self.out_dir))
+        options['out_dir'] = out_dir
+        names = [options.get('out_name') or '']
+        names += [d.partition('=')[2] for d in options.get('fanout') or () if isinstance(d, str)]
+        if any('/' in name or os.sep in name or name == '..' for name in names):
+            raise ValueError('the output file names cannot hold directories')
+        return motu_api.default_options(**options)
+
+    def list(self):
+        """Returns the jobs, oldest first."""
+        with self._lock:
+            return sorted(self.jobs.values(), key=lambda job: job.submitted)
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels a job. A queued job is cancelled at once, a running one
+        stops its polling and downloads and becomes cancelled shortly after.
+
+        returns whether the job is (being) cancelled"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            job.options.cancel.cancel()
+            if job.status != QUEUED or not job.future.cancel():
+                # the running job stops at its next check
+                return True
+            job.status = CANCELLED
+            job.finished = time.time()
+        job.over.set()
+        return True
+
+    def forget(self, job_id):
+        """Drops a finished job from the daemon.
+
+        returns whether the job is dropped"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in FINISHED:
+                return False
+            del self.jobs[job_id]
+            return True
+
+    def status(self):
+        """Returns the state of the daemon, as a dictionary."""
+        with self._lock:
+            jobs = list(self.jobs.values())
+        counts = dict((status, 0) for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED))
+        for job in jobs:
+            counts[job.status] += 1
+        return {'version': motu_api.get_client_version(),
+                'pid': os.getpid(),
+                'uptime': time.time() - self.started,
+                'jobs': counts,
+                'governor': utils_governor.get_governor().stats(),
+                'metrics': utils_metrics.get_metrics().stats()}
+
+    def _estimate(self, job):
+        source = getattr(job.options, 'size_estimates', None) or motu_scheduler.ESTIMATES_HISTORY
+        size = motu_scheduler.estimate_size(job.options, source)
+        if size is not None:
+            self.scheduler.set_size(job.future, size)
+
+    def _run(self, job):
+        log = logging.getLogger("motu_daemon")
+        with self._lock:
+            job.status = RUNNING
+            job.started = time.time()
+        log.info("Job %s started", job.id)
+        try:
+            if getattr(job.options, 'fanout', None):
+                files = motu_fanout.execute_fanout(job.options)
+            else:
+                files = motu_api.execute_request(job.options)
+            # downloaded files are only complete once transcoded
+            utils_netcdf.wait_all(files)
+        except utils_cancel.Cancelled as e:
+            log.info("Job %s cancelled", job.id)
+            with self._lock:
+                job.status = CANCELLED
+                job.error = str(e)
+        except Exception as e:
+            log.error("Job %s failed: %s", job.id, e)
+            with self._lock:
+                job.status = FAILED
+                job.error = str(e)
+        else:
+            log.info("Job %s done", job.id)
+            with self._lock:
+                job.status = DONE
+                job.files = files
+        finally:
+            job.finished = time.time()
+            job.over.set()
+
+
+def _handler_class(daemon, token=None):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class JobRequestHandler(BaseHTTPRequestHandler):
+        """HTTP interface of the daemon:
+
+        GET /status                       state of the daemon
+        GET /scheduler                    queued and running jobs, latest
+                                          scheduling decisions
+        GET /jobs                         all the jobs
+        POST /jobs                        submits a job (JSON options)
+        GET /jobs/<id>[?wait=SECONDS]     state of a job, optionally waiting
+                                          for it to finish (MAX_WAIT seconds
+                                          at most)
+        GET /jobs/<id>/files/<index>      content of a file written by a job
+        DELETE /jobs/<id>                 cancels a queued or running job,
+                                          or drops a finished one
+
+        When a token is set, requests must hold it in an 'Authorization:
+        Bearer <token>' header."""
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split('/') if p]
+            if parts == ['status']:
+                return self._reply(200, daemon.status())
+            if parts == ['scheduler']:
+                return self._reply(200, daemon.scheduler.report())
+            if parts == ['jobs']:
+                return self._reply(200, [job.to_dict() for job in daemon.list()])
+            job = daemon.get(parts[1]) if len(parts) >= 2 and parts[0] == 'jobs' else None
+            if job is None:
+                return self._reply(404, {'error': 'unknown resource %s' % url.path})
+            if len(parts) == 2:
+                wait = parse_qs(url.query).get('wait')
+                if wait:
+                    try:
+                        wait = float(wait[0])
+                    except ValueError:
+                        return self._reply(400, {'error': 'invalid wait %s' % wait[0]})
+                    # a handler thread is not held longer than that
+                    job.over.wait(min(wait, MAX_WAIT) if wait > 0 else 0)
+                return self._reply(200, job.to_dict())
+            if len(parts) == 4 and parts[2] == 'files' and parts[3].isdigit() and int(parts[3]) < len(job.files):
+                return self._send_file(job.files[int(parts[3])])
+            return self._reply(404, {'error': 'unknown resource %s' % url.path})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            if urlparse(self.path).path.rstrip('/') != '/jobs':
+                return self._reply(404, {'error': 'unknown resource %s' % self.path})
+            try:
+                options = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                if not isinstance(options, dict):
+                    raise ValueError('the options must be a JSON object')
+                job = daemon.submit(options)
+            except (TypeError, ValueError) as e:
+                return self._reply(400, {'error': str(e)})
+            return self._reply(201, job.to_dict())
+
+        def do_DELETE(self):
+            if not self._authorized():
+                return
+            parts = [p for p in urlparse(self.path).path.split('/') if p]
+            if len(parts) != 2 or parts[0] != 'jobs' or daemon.get(parts[1]) is None:
+                return self._reply(404, {'error': 'unknown resource %s' % self.path})
+            if daemon.cancel(parts[1]):
+                return self._reply(200, daemon.get(parts[1]).to_dict())
+            if daemon.forget(parts[1]):
+                return self._reply(200, {'id': parts[1], 'status': 'dropped'})
+            return self._reply(409, {'error': 'job %s cannot be cancelled' % parts[1]})
+
+        def _authorized(self):
+            if token is None:
+                return True
+            scheme, _, value = (self.headers.get('Authorization') or '').partition(' ')
+            if scheme == 'Bearer' and hmac.compare_digest(value.strip().encode('utf-8'), token.encode('utf-8')):
+                return True
+            # the body of a rejected request is not read
+            self.close_connection = True
+            self._reply(401, {'error': 'missing or invalid token'})
+            return False
+
+        def _reply(self, code, value):
+            body = json.dumps(value).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_file(self, path):
+            try:
+                f = open(path, 'rb')
+            except (IOError, OSError) as e:
+                return self._reply(410, {'error': str(e)})
+            with f:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                self.send_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile)
+
+        def address_string(self):
+            # clients of a Unix socket have no address
+            return self.client_address[0] if self.client_address else 'local'
+
+        def log_message(self, format, *args):
+            logging.getLogger("motu_daemon").debug("%s - %s", self.address_string(), format % args)
+
+    return JobRequestHandler
+
+
+def parse_address(address):
+    """Parses the address of the daemon: a path (containing a '/') for a Unix
+    socket, or [HOST:]PORT for HTTP (localhost by default).
+
+    returns the path, or a (host, port) tuple"""
+    if '/' in address:
+        return address
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def token_path(address):
+    """Returns the path of the file holding the token of the daemon listening
+    on the given TCP address (a (host, port) tuple), readable by its owner
+    only. Clients on other hosts need a copy of this file."""
+    return os.path.join(os.path.expanduser(TOKEN_DIR), 'daemon-%i.token' % address[1])
+
+
+def read_token(address):
+    """Returns the token of the daemon listening on the given address, None
+    for a Unix socket or if the token file cannot be read."""
+    address = parse_address(address)
+    if isinstance(address, str):
+        return None
+    try:
+        with open(token_path(address)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def serve(address, max_jobs=DEFAULT_MAX_JOBS, max_per_server=motu_fanout.DEFAULT_MAX_PER_SERVER, options=None):
+    """Runs the daemon until interrupted.
+
+    On a Unix socket, only the owner of the daemon can connect. On TCP, the
+    clients must send the token written in the file given by token_path,
+    which only the owner can read.
+
+    address: the Unix socket path, or [HOST:]PORT to listen to (see
+             parse_address)
+    max_jobs: the number of jobs run at the same time
+    max_per_server: the number of jobs run at the same time on a Motu server
+    options: the options of the jobs which clients cannot set, and the output
+             directory of the jobs (see Daemon)"""
+    import socketserver
+    from http.server import ThreadingHTTPServer
+    log = logging.getLogger("motu_daemon")
+
+    daemon = Daemon(max_jobs, max_per_server, options)
+    address = parse_address(address)
+    token = None
+    # the jobs hold credentials: the socket and the token file are created
+    # readable by the owner only
+    umask = os.umask(0o077)
+    try:
+        if isinstance(address, str):
+            class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            if os.path.exists(address):
+                os.remove(address)
+            server = UnixHTTPServer(address, _handler_class(daemon))
+        else:
+            token = secrets.token_urlsafe(32)
+            server = ThreadingHTTPServer(address, _handler_class(daemon, token))
+            # the port may have been chosen by the system
+            address = server.server_address[:2]
+            os.makedirs(os.path.dirname(token_path(address)), exist_ok=True)
+            with open(token_path(address), 'w') as f:
+                f.write(token)
+    finally:
+        os.umask(umask)
+    log.info("Daemon listening on %s", address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Daemon interrupted")
+    finally:
+        server.server_close()
+        path = address if isinstance(address, str) else token_path(address)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _connection(address, timeout):
+    import http.client
+    address = parse_address(address)
+    if not isinstance(address, str):
+        return http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+
+    return UnixHTTPConnection('localhost', timeout=timeout)
+
+
+def call(address, method, path, value=None, timeout=None):
+    """Calls the daemon at the given address.
+
+    value: the value sent as JSON, if any
+
+    returns the JSON reply, decoded"""
+    connection = _connection(address, timeout)
+    try:
+        body = json.dumps(value).encode('utf-8') if value is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        token = read_token(address)
+        if token is not None:
+            headers['Authorization'] = 'Bearer ' + token
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        reply = json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
+    if response.status >= 400:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.daemon.error'] % (
+            address, reply.get('error')))
+    return reply
+
+
+def is_running(address):
+    """Returns whether a daemon listens on the given address."""
+    try:
+        call(address, 'GET', '/status', timeout=5)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def execute_request(address, _options, wait=DEFAULT_WAIT):
+    """Runs a request in the daemon at the given address and waits for it,
+    as a thin client.
+
+    _options: the options of the request (see motu_api.execute_request). The
+              output directory is made absolute, as the daemon may not run in
+              the same directory. When the cancellation token ('cancel'
+              option) is cancelled, the job is cancelled in the daemon
+
+    returns the list of the files written"""
+    log = logging.getLogger("motu_daemon")
+    cancel = utils_cancel.get_token(_options)
+    options = dict((k, v) for k, v in vars(_options).items() if k not in LOCAL_OPTIONS)
+    if options.get('out_dir') and not options['out_dir'].startswith('console'):
+        options['out_dir'] = os.path.abspath(options['out_dir'])
+    if cancel is not None:
+        wait = min(wait, CANCEL_CHECK_INTERVAL)
+    job = call(address, 'POST', '/jobs', options)
+    log.info("Job %s submitted to the daemon at %s", job['id'], address)
+    while job['status'] not in FINISHED:
+        if cancel is not None and cancel.cancelled:
+            log.info("Cancelling job %s", job['id'])
+            call(address, 'DELETE', '/jobs/%s' % job['id'], timeout=30)
+            raise utils_cancel.Cancelled()
+        job = call(address, 'GET', '/jobs/%s?wait=%s' % (job['id'], wait), timeout=wait + 30)
+    if job['status'] == CANCELLED:
+        raise utils_cancel.Cancelled()
+    if job['status'] != DONE:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.daemon.job-failed'] % (
+            job['id'], job['error'] or job['status']))
+    for path in job['files']:
+        log.info("Written %s", path)
+    return job['files']
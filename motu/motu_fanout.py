@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import copy
+import functools
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import motu_api
+from . import motu_scheduler
+from . import utils_cancel
+from . import utils_messages
+from . import utils_netcdf
+
+# default number of jobs submitted at the same time to a given Motu server
+DEFAULT_MAX_PER_SERVER = motu_scheduler.DEFAULT_MAX_PER_SERVER
+
+# options on which the fan-out templates are applied
+TEMPLATED_OPTIONS = ('service_id', 'product_id', 'out_name')
+
+
+def parse_templates(fanout):
+    """Builds the templates dictionary from the command line definitions.
+
+    fanout: a list of strings following the format KEY=VALUE1,VALUE2,...
+
+    returns a dictionary KEY -> [VALUE1, VALUE2, ...]"""
+    templates = {}
+    for definition in fanout or ():
+        key, sep, values = definition.partition('=')
+        if not sep or not key.strip():
+            raise Exception(utils_messages.get_external_messages()['motu-client.exception.option.fanout'] % definition)
+        templates[key.strip()] = [v.strip() for v in values.split(',') if v.strip()]
+    return templates
+
+
+def expand_jobs(_options, templates):
+    """Expands the templates into a list of options, one per job.
+
+    Each combination of the template values is applied with str.format on the
+    service identifier, the product identifier and the output file name. When
+    the output file name does not depend on the templates, the product
+    identifier is appended to it so that jobs do not overwrite each other.
+    Without output file name, the files are named after the product
+    identifier.
+
+    _options: the options of the request, used as a model for each job
+    templates: a dictionary KEY -> list of values"""
+    keys = sorted(templates.keys())
+    jobs = []
+    for values in itertools.product(*[templates[k] for k in keys]):
+        fields = dict(zip(keys, values))
+        job = copy.copy(_options)
+        job.cancel = utils_cancel.child_token(_options)
+        for option in TEMPLATED_OPTIONS:
+            value = getattr(_options, option, None)
+            if isinstance(value, str):
+                setattr(job, option, value.format(**fields))
+        if job.out_name == _options.out_name and len(keys) > 0:
+            if _options.out_name is None:
+                # files named by the server: named after the product
+                job.out_name = job.product_id + ".nc"
+            else:
+                base_name, extension = os.path.splitext(_options.out_name)
+                job.out_name = base_name + "_" + job.product_id + extension
+        jobs.append(job)
+    return jobs
+
+
+def execute_fanout(_options, templates=None, max_per_server=None):
+    """Runs in parallel one request per combination of the templates values.
+
+    All the jobs share the same session (CAS tickets) and no more than
+    max_per_server jobs are run at the same time on a Motu server. Failures
+    are logged per job, and an exception is raised once every job is over if
+    any of them failed.
+
+    _options: the options of the request (see motu_api.execute_request), where
+              service_id, product_id and out_name can hold {KEY} placeholders
+    templates: a dictionary KEY -> list of values. If not set, it is read from
+               the 'fanout' option (list of KEY=VALUE1,VALUE2 strings)
+    max_per_server: the maximum number of concurrent jobs per server. If not
+                    set, the 'max_per_server' option is used
+
+    returns the list of the files written"""
+    log = logging.getLogger("motu_fanout")
+
+    if templates is None:
+        templates = parse_templates(getattr(_options, 'fanout', None))
+    if max_per_server is None:
+        max_per_server = int(getattr(_options, 'max_per_server', None) or DEFAULT_MAX_PER_SERVER)
+
+    if getattr(_options, 'session', None) is None:
+        from . import utils_http
+        _options.session = utils_http.Session()
+
+    jobs = expand_jobs(_options, templates)
+    log.info("Fan-out of %i jobs (at most %i at a time per server)", len(jobs), max_per_server)
+    return run_jobs(jobs, max_per_server)
+
+
+def run_jobs(jobs, max_per_server=DEFAULT_MAX_PER_SERVER, name=lambda job: job.product_id, shared_slots=True):
+    """Runs the given jobs (options of motu_api.execute_request) in parallel,
+    with no more than max_per_server jobs at the same time on a Motu server.
+
+    Jobs are started by priority class ('priority' option), the smallest
+    first within a class (see motu_scheduler.Scheduler). Sizes are estimated
+    according to the 'size_estimates' option (see
+    motu_scheduler.estimate_size).
+
+    Failures are logged per job, and an exception is raised once every job is
+    over if any of them failed. Jobs whose cancellation token ('cancel'
+    option) is cancelled leave the queue at once, and utils_cancel.Cancelled
+    is then raised.
+
+    name: the function giving the name of a job in the logs
+    shared_slots: whether the jobs run in the scheduler shared with the
+                  other fan-outs of the process, within its per server limit
+                  set at its first use, and within max_per_server for this
+                  batch. Jobs run on behalf of another job (parts of a
+                  request) must use their own scheduler, or they could wait
+                  for a slot held by their parent.
+
+    returns the list of the files written"""
+    log = logging.getLogger("motu_fanout")
+    if shared_slots:
+        scheduler = motu_scheduler.get_scheduler(max_per_server)
+        batch = motu_scheduler.Batch(max_per_server)
+    else:
+        scheduler = motu_scheduler.Scheduler(max_per_server)
+        batch = None
+
+    def run(job):
+        log.info("Starting job %s", name(job))
+        files = motu_api.execute_request(job)
+        log.info("Job %s done", name(job))
+        return files
+
+    def estimate(job):
+        source = getattr(job, 'size_estimates', None) or motu_scheduler.ESTIMATES_HISTORY
+        return motu_scheduler.estimate_size(job, source)
+
+    # estimates may need a request to the server: they are run in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), max_per_server))) as executor:
+        sizes = list(executor.map(estimate, jobs))
+
+    futures = [(job, scheduler.submit(functools.partial(run, job), job.motu, size,
+                                      motu_scheduler.parse_priority(getattr(job, 'priority', None)), name(job),
+                                      batch))
+               for job, size in zip(jobs, sizes)]
+    for job, future in futures:
+        token = utils_cancel.get_token(job)
+        if token is not None:
+            # queued jobs of a cancelled batch give their place up at once
+            token.on_cancel(future.cancel)
+    failures = []
+    cancelled = False
+    results = []
+    for job, future in futures:
+        try:
+            results += future.result()
+        except Exception as e:
+            token = utils_cancel.get_token(job)
+            if token is not None and token.cancelled:
+                log.info("Job %s cancelled", name(job))
+                cancelled = True
+                continue
+            log.error("Job %s failed: %s", name(job), e)
+            failures.append(name(job))
+
+    # downloaded files are only complete once transcoded
+    utils_netcdf.wait_all()
+
+    if cancelled:
+        raise utils_cancel.Cancelled()
+    if failures:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.fanout.failed'] % (
+            len(failures), len(jobs), ', '.join(failures)))
+
+    return results
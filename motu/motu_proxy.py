@@ -0,0 +1,474 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from xml.sax.saxutils import quoteattr
+
+from . import motu_api
+from . import utils_messages
+from . import utils_metrics
+
+# time (seconds) the describeProduct and getSize results are served from the
+# cache: they change with the products, unlike the extractions
+METADATA_MAX_AGE = 3600
+
+# time (seconds) the error of a failed request is returned to the clients
+# asking for its status
+FAILURE_MAX_AGE = 600
+
+# size of the blocks sent to the clients
+BLOCK_SIZE = 65536
+
+# query parameters of Motu giving the options of a request, the others
+# (session, scriptVersion...) do not change its result
+QUERY_OPTIONS = {'service': 'service_id',
+                 'product': 'product_id',
+                 'x_lo': 'longitude_min',
+                 'x_hi': 'longitude_max',
+                 'y_lo': 'latitude_min',
+                 'y_hi': 'latitude_max',
+                 'z_lo': 'depth_min',
+                 'z_hi': 'depth_max',
+                 't_lo': 'date_min',
+                 't_hi': 'date_max',
+                 'output': 'outputWritten'}
+
+# options of the proxy which are not used by the requests it forwards
+PROXY_OPTIONS = ('cache_proxy', 'cache_dir', 'cache_size', 'serve', 'daemon', 'cluster', 'fanout', 'cancel')
+
+
+class Fill(object):
+    """The result of a request being received from Motu, written into a file
+    of the cache and read at the same time by all the clients waiting for it.
+
+    It is the buffer object given to motu_api.process_request (see
+    utils_stream.SpillingBuffer): the file is published under its name in
+    the cache once complete.
+
+    path: the file of the cache the result is published as"""
+
+    def __init__(self, path):
+        self.path = path
+        self.temp = '%s.%s.part' % (path, uuid.uuid4().hex[:8])
+        self.size = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.error = None
+        self._file = open(self.temp, 'wb')
+        self._condition = threading.Condition()
+
+    def allocate(self, size):
+        """Called once the transfer starts, with its size (-1 if unknown)."""
+        with self._condition:
+            self.size = size if size >= 0 else None
+            self.started = True
+            self._condition.notify_all()
+
+    def write(self, block):
+        self._file.write(block)
+        self._file.flush()
+        with self._condition:
+            self.written += len(block)
+            self._condition.notify_all()
+
+    def commit(self):
+        self._file.close()
+        with self._condition:
+            os.replace(self.temp, self.path)
+            self.done = True
+            self._condition.notify_all()
+
+    def abort(self, discard=False):
+        self._file.close()
+        with self._condition:
+            # readers already streaming the file keep it open
+            os.remove(self.temp)
+            self.started = False
+            self._condition.notify_all()
+
+    def fail(self, error):
+        """Records why the request failed, for the clients waiting for it."""
+        if not self._file.closed:
+            # failed before the transfer
+            self.abort()
+        with self._condition:
+            self.error = error
+            self._condition.notify_all()
+
+    def wait_started(self, timeout=None):
+        """Waits for the transfer to start (or for the request to fail).
+
+        returns whether it has started"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.started or self.done or self.error is not None, timeout)
+            if self.error is not None:
+                raise Exception(self.error)
+            return self.started or self.done
+
+    def stream(self, out, block_size=BLOCK_SIZE):
+        """Writes the result into out as it is received, until it is
+        complete. Raises an exception if the request fails meanwhile."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.started or self.done or self.error is not None)
+            if self.error is not None:
+                raise Exception(self.error)
+            f = open(self.path if self.done else self.temp, 'rb')
+        with f:
+            sent = 0
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self.written > sent or self.done or self.error is not None)
+                    if self.error is not None:
+                        raise Exception(self.error)
+                    available = self.written - sent
+                    if available == 0 and self.done:
+                        return
+                while available > 0:
+                    block = f.read(min(block_size, available))
+                    out.write(block)
+                    sent += len(block)
+                    available -= len(block)
+
+
+class Proxy(object):
+    """Answers the requests of Motu from a cache of results shared by the
+    clients of the proxy, and forwards the others to the Motu server with the
+    credentials of the proxy. Identical requests arriving while the result
+    is being received share the transfer: all the clients get the data as it
+    arrives, while it is written into the cache.
+
+    options: the options of the requests forwarded (see
+             motu_api.execute_request): Motu server, authentication,
+             proxy...
+    cache_dir: the directory of the results
+    cache_size: (optional) the size (bytes) of the cache, the least recently
+                used results being removed beyond"""
+
+    def __init__(self, options, cache_dir, cache_size=None):
+        from . import utils_http
+        self.options = dict((k, v) for k, v in vars(options).items() if k not in PROXY_OPTIONS)
+        self.options['session'] = utils_http.Session()
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.started = time.time()
+        self._fills = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def request_options(self, query):
+        """Returns the (checked) options of the request given by the query
+        (parsed, see urllib.parse.parse_qs) sent by a client."""
+        values = dict(self.options)
+        for name, option in QUERY_OPTIONS.items():
+            values[option] = query[name][0] if name in query else None
+        action = query.get('action', [''])[0].lower()
+        values['describe'] = action == 'describeproduct'
+        values['size'] = action == 'getsize'
+        values['variable'] = query.get('variable')
+        values['out_dir'] = self.cache_dir
+        values['console_mode'] = False
+        _options = motu_api.default_options(**values)
+        motu_api.check_options(_options)
+        motu_api.normalize_request(_options)
+        _options.out_name = motu_api.request_key(_options) + '.nc'
+        return _options
+
+    def cached(self, _options):
+        """Returns the path of the cached result of the request, None if it
+        is not in the cache."""
+        key = motu_api.request_key(_options)
+        path = os.path.join(self.cache_dir, key + ('.xml' if _options.describe or _options.size else '.nc'))
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+        if (_options.describe or _options.size) and time.time() - modified > METADATA_MAX_AGE:
+            return None
+        if not (_options.describe or _options.size):
+            # the most recently used results are kept (see evict)
+            os.utime(path)
+        return path
+
+    def fetch(self, _options):
+        """Returns the result of the request: the path of the file of the
+        cache if it is there, or the Fill of the result being received,
+        forwarding the request to Motu unless it is already in progress."""
+        metrics = utils_metrics.get_metrics()
+        key = motu_api.request_key(_options)
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is not None:
+                metrics.count('proxy.coalesced')
+                return fill
+            path = self.cached(_options)
+            if path is not None:
+                metrics.count('proxy.hits')
+                return path
+            metrics.count('proxy.misses')
+            fill = Fill(os.path.join(self.cache_dir,
+                                     key + ('.xml' if _options.describe or _options.size else '.nc')))
+            self._fills[key] = fill
+            self._failures.pop(key, None)
+        worker = threading.Thread(target=self._forward, args=(key, _options, fill), name='proxy-' + key[:8])
+        worker.daemon = True
+        worker.start()
+        return fill
+
+    def status(self, key):
+        """Returns the status of a request in the Motu format: ("1", None) if
+        its result can be downloaded, ("2", message) if it failed, ("0",
+        None) if it is in progress."""
+        with self._lock:
+            fill = self._fills.get(key)
+            failure = self._failures.get(key)
+        if fill is not None:
+            if fill.error is not None:
+                return "2", fill.error
+            return ("1", None) if fill.started or fill.done else ("0", None)
+        if os.path.isfile(os.path.join(self.cache_dir, key + '.nc')):
+            return "1", None
+        if failure is not None:
+            return "2", failure[1]
+        return "2", utils_messages.get_external_messages()['motu-client.exception.proxy.unknown-request'] % key
+
+    def result(self, key):
+        """Returns the result of a request (see fetch) by its key, None if it
+        is unknown."""
+        with self._lock:
+            fill = self._fills.get(key)
+        if fill is not None:
+            return fill
+        path = os.path.join(self.cache_dir, key + '.nc')
+        return path if os.path.isfile(path) else None
+
+    def stats(self):
+        """Returns the state of the proxy, as a dictionary."""
+        with self._lock:
+            in_flight = len(self._fills)
+        return {'version': motu_api.get_client_version(),
+                'pid': os.getpid(),
+                'uptime': time.time() - self.started,
+                'in_flight': in_flight,
+                'cache': {'directory': os.path.abspath(self.cache_dir),
+                          'size': sum(size for _, size, _ in self._entries())},
+                'metrics': utils_metrics.get_metrics().stats()}
+
+    def evict(self):
+        """Removes the least recently used results beyond the size of the
+        cache."""
+        if not self.cache_size:
+            return
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.cache_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            utils_metrics.get_metrics().count('proxy.evictions')
+            logging.getLogger("motu_proxy").debug("Removed %s from the cache", path)
+
+    def _entries(self):
+        """Returns the (path, size, last use) of the results in the cache."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.nc') or name.endswith('.xml'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _forward(self, key, _options, fill):
+        log = logging.getLogger("motu_proxy")
+        log.info("Forwarding request %s to %s", key, _options.motu)
+        try:
+            files = motu_api.process_request(_options, fill)
+            if files:
+                # the server limit split the result into several files
+                for f in files:
+                    os.remove(f)
+                raise Exception(utils_messages.get_external_messages()['motu-client.exception.proxy.split'] % (
+                    key, len(files)))
+            if not fill.done:
+                raise Exception(utils_messages.get_external_messages()['motu-client.exception.proxy.no-result'] % key)
+        except Exception as e:
+            log.error("Request %s failed: %s", key, e)
+            fill.fail(str(e))
+            with self._lock:
+                self._failures[key] = (time.time(), str(e))
+                now = time.time()
+                for k in [k for k, (failed, _) in self._failures.items() if now - failed > FAILURE_MAX_AGE]:
+                    del self._failures[k]
+        else:
+            log.info("Request %s cached (%i bytes)", key, fill.written)
+        finally:
+            with self._lock:
+                del self._fills[key]
+        self.evict()
+
+
+def _handler_class(proxy):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class MotuRequestHandler(BaseHTTPRequestHandler):
+        """HTTP interface of the proxy:
+
+        GET <any path>?action=...         the requests of Motu
+                                          (productdownload in status or
+                                          console mode, getreqstatus,
+                                          describeProduct, getSize)
+        GET /results/<key>                result of a request, streamed
+                                          while it is received
+        GET /status                       state of the proxy"""
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [p for p in url.path.split('/') if p]
+            action = query.get('action', [''])[0].lower()
+            if parts == ['status'] and not action:
+                return self._reply(200, 'application/json', json.dumps(proxy.stats()))
+            if len(parts) == 2 and parts[0] == 'results':
+                return self._send_result(proxy.result(parts[1]))
+            if action == 'getreqstatus':
+                key = query.get('requestid', [''])[0]
+                status, msg = proxy.status(key)
+                return self._status(status, key, msg)
+            if action not in ('productdownload', 'describeproduct', 'getsize'):
+                return self._reply(400, 'text/plain', 'unsupported action %s' % action)
+            try:
+                _options = proxy.request_options(query)
+            except Exception as e:
+                return self._reply(400, 'text/plain', str(e))
+            result = proxy.fetch(_options)
+            if action == 'productdownload' and query.get('mode', [''])[-1] == 'status':
+                # the client polls the status, then downloads the result from the proxy
+                return self._status("0", motu_api.request_key(_options))
+            return self._send_result(result)
+
+        def _status(self, status, key, msg=None):
+            remote_uri = 'http://%s/results/%s' % (self.headers.get('Host'), key) if status == "1" else ''
+            body = '<statusModeResponse status="%s" requestId=%s remoteUri=%s msg=%s/>' % (
+                status, quoteattr(key), quoteattr(remote_uri), quoteattr(msg or ''))
+            self._reply(200, 'text/xml', body)
+
+        def _reply(self, code, content_type, text):
+            body = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_result(self, result):
+            if result is None:
+                return self._reply(404, 'text/plain', 'unknown result %s' % self.path)
+            if isinstance(result, str):
+                content_type = 'text/xml' if result.endswith('.xml') else 'application/x-netcdf'
+                try:
+                    f = open(result, 'rb')
+                except (IOError, OSError) as e:
+                    return self._reply(410, 'text/plain', str(e))
+                with f:
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                    self.end_headers()
+                    while True:
+                        block = f.read(BLOCK_SIZE)
+                        if not block:
+                            return
+                        self.wfile.write(block)
+            try:
+                result.wait_started()
+            except Exception as e:
+                return self._reply(502, 'text/plain', str(e))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml' if result.path.endswith('.xml') else 'application/x-netcdf')
+            if result.size is not None:
+                self.send_header('Content-Length', str(result.size))
+            else:
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            try:
+                result.stream(self.wfile)
+            except Exception as e:
+                # the client sees a truncated result
+                logging.getLogger("motu_proxy").warning("Result %s interrupted: %s", self.path, e)
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            logging.getLogger("motu_proxy").debug("%s - %s", self.address_string(), format % args)
+
+    return MotuRequestHandler
+
+
+def serve(address, options, cache_dir, cache_size=None):
+    """Runs the proxy until interrupted.
+
+    address: [HOST:]PORT to listen to (localhost by default, see
+             motu_daemon.parse_address)
+    options: the options of the requests forwarded to Motu (see Proxy)
+    cache_dir: the directory of the results
+    cache_size: (optional) the size (bytes) of the cache"""
+    from http.server import ThreadingHTTPServer
+    from . import motu_daemon
+    log = logging.getLogger("motu_proxy")
+
+    if options.motu is None:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.option.mandatory'] % 'motu')
+    proxy = Proxy(options, cache_dir, cache_size)
+    address = motu_daemon.parse_address(address)
+    if isinstance(address, str):
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.proxy.address'] % address)
+    server = ThreadingHTTPServer(address, _handler_class(proxy))
+    log.info("Proxy of %s listening on %s:%i, caching into %s", options.motu, address[0], address[1], cache_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Proxy interrupted")
+    finally:
+        server.server_close()
@@ -0,0 +1,331 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import collections
+import copy
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+from . import utils_estimate
+from . import utils_metadata
+from . import utils_unit
+
+# priority classes, the lower the more urgent
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITIES = {'high': HIGH, 'normal': NORMAL, 'low': LOW}
+
+# default number of jobs run at the same time on a Motu server
+DEFAULT_MAX_PER_SERVER = 4
+
+# default waiting time (seconds) after which a queued job is promoted to the
+# next priority class, so that large or low priority jobs are not starved
+DEFAULT_AGING = 600
+
+# number of scheduling decisions kept for the status report
+REPORT_SIZE = 200
+
+# sources of the size estimates
+ESTIMATES_NONE = 'none'
+ESTIMATES_HISTORY = 'history'
+ESTIMATES_METADATA = 'metadata'
+ESTIMATES_GETSIZE = 'getsize'
+ESTIMATES = (ESTIMATES_NONE, ESTIMATES_HISTORY, ESTIMATES_METADATA, ESTIMATES_GETSIZE)
+
+# the process-wide scheduler (see get_scheduler)
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class Batch(object):
+    """A group of jobs (e.g. a fan-out) with its own limit of jobs run at the
+    same time on a server, on top of the limit of the scheduler."""
+
+    def __init__(self, max_per_server):
+        self.max_per_server = max_per_server
+
+
+class _Entry(object):
+    """A job queued in the scheduler."""
+
+    def __init__(self, function, server, size, priority, name, sequence, batch=None):
+        self.function = function
+        self.server = server
+        self.batch = batch
+        self.size = size
+        self.priority = priority
+        self.name = name
+        self.sequence = sequence
+        self.future = Future()
+        self.submitted = time.time()
+        self.started = None
+
+    def to_dict(self, now, aging):
+        return {'job': self.name,
+                'server': self.server,
+                'priority': priority_name(self.priority),
+                'effective_priority': priority_name(self.effective_priority(now, aging)),
+                'size': self.size,
+                'waited': (self.started or now) - self.submitted}
+
+    def effective_priority(self, now, aging):
+        if not aging:
+            return self.priority
+        return max(HIGH, self.priority - int((now - self.submitted) / aging))
+
+
+class Scheduler(object):
+    """Runs jobs in threads, in the order of their priority class, shortest
+    (estimated size) first within a class, with no more than max_per_server
+    jobs at the same time on a server.
+
+    Jobs of unknown size are run after the jobs of known size of their class.
+    A job waiting for more than aging seconds is promoted to the next class,
+    so that no job waits forever. Jobs without server (e.g. jobs only
+    submitting other jobs) are run immediately.
+
+    The decisions taken are kept for the status report (see report)."""
+
+    def __init__(self, max_per_server=DEFAULT_MAX_PER_SERVER, aging=DEFAULT_AGING, max_running=None):
+        self.max_per_server = max_per_server
+        self.aging = aging
+        self.max_running = max_running
+        self.decisions = collections.deque(maxlen=REPORT_SIZE)
+        self._queue = []
+        self._running = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function, server=None, size=None, priority=NORMAL, name=None, batch=None):
+        """Queues a job.
+
+        function: the function run by the job, without argument
+        server: the url of the server the job runs on, None if the job does
+                not hold a server slot
+        size: the estimated size (bytes) of the job result, None if unknown
+        priority: the priority class (HIGH, NORMAL or LOW)
+        name: the name of the job in the logs and the status report
+        batch: (optional) the Batch of the job, limiting further the jobs of
+               the batch run at the same time on a server
+
+        returns the future of the job result"""
+        with self._lock:
+            self._sequence += 1
+            entry = _Entry(function, urlparse(server).netloc if server else None, size, priority,
+                           name or 'job %i' % self._sequence, self._sequence, batch)
+            self._queue.append(entry)
+        self._dispatch()
+        return entry.future
+
+    def set_size(self, future, size):
+        """Sets the estimated size of a queued job, when known after its
+        submission."""
+        with self._lock:
+            for entry in self._queue:
+                if entry.future is future:
+                    entry.size = size
+        self._dispatch()
+
+    def report(self):
+        """Returns the state of the scheduler, as a dictionary: the queued
+        jobs in the order they would be started, the running jobs, and the
+        latest decisions taken."""
+        now = time.time()
+        with self._lock:
+            queue = sorted(self._queue, key=lambda e: self._order(e, now))
+            return {'max_per_server': self.max_per_server,
+                    'aging': self.aging,
+                    'queued': [entry.to_dict(now, self.aging) for entry in queue],
+                    'running': [entry.to_dict(now, self.aging) for entry in self._running],
+                    'decisions': list(self.decisions)}
+
+    def _order(self, entry, now):
+        size = entry.size if entry.size is not None else float('inf')
+        return entry.effective_priority(now, self.aging), size, entry.sequence
+
+    def _dispatch(self):
+        log = logging.getLogger("motu_scheduler")
+        started = []
+        with self._lock:
+            now = time.time()
+            self._queue = [entry for entry in self._queue if not entry.future.cancelled()]
+            running = collections.Counter(entry.server for entry in self._running)
+            batches = collections.Counter((entry.batch, entry.server) for entry in self._running
+                                          if entry.batch is not None)
+            total = sum(n for server, n in running.items() if server is not None)
+            for entry in sorted(self._queue, key=lambda e: self._order(e, now)):
+                if entry.server is not None:
+                    if running[entry.server] >= self.max_per_server:
+                        continue
+                    if self.max_running is not None and total >= self.max_running:
+                        continue
+                    if entry.batch is not None and \
+                            batches[entry.batch, entry.server] >= entry.batch.max_per_server:
+                        continue
+                    batches[entry.batch, entry.server] += 1
+                    total += 1
+                if not entry.future.set_running_or_notify_cancel():
+                    continue
+                running[entry.server] += 1
+                entry.started = now
+                self._queue.remove(entry)
+                self._running.append(entry)
+                decision = entry.to_dict(now, self.aging)
+                decision['started'] = now
+                decision['queued'] = len(self._queue)
+                self.decisions.append(decision)
+                started.append(entry)
+        for entry in started:
+            log.info("Starting %s (priority %s, size %s, waited %.0fs)", entry.name, priority_name(entry.priority),
+                     utils_unit.convert_bytes(entry.size) if entry.size is not None else 'unknown',
+                     entry.started - entry.submitted)
+            thread = threading.Thread(target=self._run, args=(entry,), name=entry.name)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, entry):
+        try:
+            result = entry.function()
+        except BaseException as e:
+            entry.future.set_exception(e)
+        else:
+            entry.future.set_result(result)
+        finally:
+            with self._lock:
+                self._running.remove(entry)
+            self._dispatch()
+
+
+def priority_name(priority):
+    for name, value in PRIORITIES.items():
+        if value == priority:
+            return name
+    return str(priority)
+
+
+def parse_priority(priority):
+    """Returns the priority class of the given name or value, NORMAL if not
+    set."""
+    if priority is None:
+        return NORMAL
+    if isinstance(priority, int):
+        return priority
+    if str(priority).lower() not in PRIORITIES:
+        raise ValueError("Unknown priority '%s' (expected %s)" % (priority, ', '.join(sorted(PRIORITIES))))
+    return PRIORITIES[str(priority).lower()]
+
+
+def get_scheduler(max_per_server=None):
+    """Returns the scheduler shared by the whole process. The per server
+    limit is set the first time the scheduler is used (DEFAULT_MAX_PER_SERVER
+    if not given): the batches of jobs sharing the scheduler have their own
+    limit on top of it (see Batch)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(max_per_server or DEFAULT_MAX_PER_SERVER)
+        return _scheduler
+
+
+def estimate_offline(_options):
+    """Estimates the size (bytes) of the result of a (checked) request
+    without contacting the server: from the previous downloads of the same
+    request recorded in the journal, or from the product description if it
+    is cached (see the 'metadata_cache' option) and NumPy available.
+
+    returns the estimated size, or None if unknown"""
+    size = estimate_size(_options, ESTIMATES_HISTORY)
+    if size is not None:
+        return size
+    try:
+        return utils_estimate.estimate_request(_options, getattr(_options, 'metadata_cache', None), offline=True)
+    except Exception as e:
+        logging.getLogger("motu_scheduler").debug("Unable to estimate the size of %s: %s",
+                                                   getattr(_options, 'product_id', None), e)
+        return None
+
+
+def estimate_size(_options, source=ESTIMATES_HISTORY):
+    """Estimates the size (bytes) of the result of a request.
+
+    source: ESTIMATES_HISTORY to use the size of the previous downloads of
+            the same request recorded in the journal (see the 'journal'
+            option), ESTIMATES_METADATA to compute it offline from the
+            product description when there is no history (see
+            utils_estimate), ESTIMATES_GETSIZE to ask Motu (getSize request)
+            when there is no history, ESTIMATES_NONE not to estimate.
+            The getSize results calibrate the offline estimates of the
+            products whose description is cached (see the 'metadata_cache'
+            option)
+
+    returns the estimated size, or None if unknown"""
+    from . import motu_api
+    from . import utils_journal
+    log = logging.getLogger("motu_scheduler")
+    if source == ESTIMATES_NONE or getattr(_options, 'describe', False) or getattr(_options, 'size', False):
+        return None
+    _options = copy.copy(_options)
+    try:
+        motu_api.check_options(_options)
+    except Exception:
+        # invalid requests fail when run
+        return None
+    journal = utils_journal.get_journal(getattr(_options, 'journal', None))
+    if journal is not None:
+        job = journal.get(motu_api.request_key(_options))
+        if job is not None and job['status'] == utils_journal.DONE and job['size'] and job['size'] > 0:
+            return job['size']
+    cache_dir = getattr(_options, 'metadata_cache', None)
+    if source == ESTIMATES_METADATA:
+        try:
+            return utils_estimate.estimate_request(_options, cache_dir)
+        except Exception as e:
+            log.warning("Unable to estimate the size of %s: %s", getattr(_options, 'product_id', None), e)
+    elif source == ESTIMATES_GETSIZE:
+        estimated = None
+        if cache_dir and os.path.exists(utils_metadata.cache_path(cache_dir, _options.service_id,
+                                                                  _options.product_id)):
+            try:
+                grid = utils_metadata.get_product_grid(_options, cache_dir)
+                estimated = utils_estimate.estimate(grid, **utils_estimate.options_bounds(_options))
+            except Exception as e:
+                log.debug("Unable to estimate the size of %s: %s", getattr(_options, 'product_id', None), e)
+        try:
+            size = motu_api.get_size(_options)
+        except Exception as e:
+            log.warning("Unable to get the size of %s: %s", getattr(_options, 'product_id', None), e)
+            return None
+        utils_estimate.calibrate(cache_dir, _options.service_id, _options.product_id, estimated, size)
+        return size
+    return None
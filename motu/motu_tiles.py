@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import copy
+import logging
+import math
+import os
+
+from . import motu_api
+from . import motu_fanout
+from . import utils_cancel
+
+# longitude coordinates names looked for when stitching tiles
+LONGITUDE_NAMES = ('longitude', 'lon', 'x')
+
+# latitude coordinates names looked for when stitching tiles
+LATITUDE_NAMES = ('latitude', 'lat', 'y')
+
+# tolerance (degrees) when comparing a box to the tile size
+EPSILON = 1e-9
+
+
+def _edges(lo, hi, size):
+    """Splits [lo, hi] in intervals of the given size (the last one can be
+    smaller)."""
+    if not size or hi - lo <= size + EPSILON:
+        return [(lo, hi)]
+    count = int(math.ceil((hi - lo) / size - EPSILON))
+    return [(lo + i * size, min(hi, lo + (i + 1) * size)) for i in range(count)]
+
+
+def split_box(x_lo, x_hi, y_lo, y_hi, tile_size=None):
+    """Splits a geographic box into sub-boxes which do not cross the
+    antimeridian, and which are no larger than tile_size degrees if set.
+
+    Longitudes are normalized in [-180 ; 180]. A box whose normalized minimal
+    longitude is greater than its maximal one crosses the antimeridian.
+
+    returns a list of (x_lo, x_hi, y_lo, y_hi, offset) tuples, where offset is
+    the value (0 or 360) to add to the longitudes of the sub-box to unwrap it
+    after the western part of the box"""
+    x_lo = motu_api.normalize_longitude(float(x_lo))
+    x_hi = motu_api.normalize_longitude(float(x_hi))
+    y_lo, y_hi = float(y_lo), float(y_hi)
+    if x_hi < x_lo:
+        x_hi += 360
+
+    boxes = []
+    for a, b in _edges(x_lo, x_hi, tile_size):
+        pieces = [(a, 180, 0), (180, b, 360)] if a < 180 < b else [(a, b, 360 if a >= 180 else 0)]
+        for p, q, offset in pieces:
+            for c, d in _edges(y_lo, y_hi, tile_size):
+                boxes.append((p - offset, q - offset, c, d, offset))
+    return boxes
+
+
+def needs_tiling(_options):
+    """Returns whether the (checked) request has to be split into tiles: its box
+    crosses the antimeridian, or it is larger than the 'tile_size' option."""
+    if not _options.extraction_geographic:
+        return False
+    return len(split_box(_options.longitude_min, _options.longitude_max,
+                         _options.latitude_min, _options.latitude_max,
+                         _tile_size(_options))) > 1
+
+
+def _tile_size(_options):
+    tile_size = getattr(_options, 'tile_size', None)
+    return float(tile_size) if tile_size else None
+
+
+def execute_tiled_request(_options):
+    """Runs the request as one request per tile (see split_box), in parallel,
+    and stitches the tiles back into the output file.
+
+    Stitching requires xarray. Without it, the tiles are left as separate
+    files.
+
+    returns the list of the files written"""
+    log = logging.getLogger("motu_tiles")
+    boxes = split_box(_options.longitude_min, _options.longitude_max,
+                      _options.latitude_min, _options.latitude_max,
+                      _tile_size(_options))
+    max_per_server = int(getattr(_options, 'max_per_server', None) or motu_fanout.DEFAULT_MAX_PER_SERVER)
+    log.info("Splitting the geographic box into %i tiles", len(boxes))
+
+    base_name, extension = os.path.splitext(_options.out_name)
+    # position of the tiles in the grid of tiles, west to east and south to
+    # north, to drop the seams they share with their neighbours
+    columns = sorted(set(x_lo + offset for x_lo, _, _, _, offset in boxes))
+    rows = sorted(set(y_lo for _, _, y_lo, _, _ in boxes))
+    jobs = []
+    offsets = {}
+    positions = {}
+    for i, (x_lo, x_hi, y_lo, y_hi, offset) in enumerate(boxes):
+        job = copy.copy(_options)
+        job.cancel = utils_cancel.child_token(_options)
+        job.longitude_min, job.longitude_max = x_lo, x_hi
+        job.latitude_min, job.latitude_max = y_lo, y_hi
+        job.out_name = base_name + "_tile" + str(i) + extension
+        jobs.append(job)
+        offsets[job.out_name] = offset
+        positions[job.out_name] = (columns.index(x_lo + offset), rows.index(y_lo))
+
+    files = motu_fanout.run_jobs(jobs, max_per_server,
+                                 name=lambda job: "%s [%s ; %s] x [%s ; %s]" % (
+                                     job.out_name, job.longitude_min, job.longitude_max,
+                                     job.latitude_min, job.latitude_max),
+                                 shared_slots=False)
+    if _options.describe or _options.size:
+        return files
+
+    try:
+        import xarray as xr
+    except ImportError:
+        log.warning("xarray is not available, tiles are left as separate files")
+        return files
+
+    target = os.path.join(_options.out_dir, _options.out_name)
+    log.info("Stitching %i files into %s", len(files), target)
+    opened = []
+    try:
+        datasets = []
+        for f in files:
+            ds = xr.open_dataset(f)
+            opened.append(ds)
+            offset = offsets[_tile_of(f, offsets)]
+            lon = _coordinate(ds, LONGITUDE_NAMES)
+            if offset and lon is not None:
+                ds = ds.assign_coords({lon: ds[lon] + offset})
+            datasets.append(ds)
+        stitched = xr.combine_by_coords(_drop_seams(files, datasets, offsets, positions))
+        temp_path = os.path.join(os.path.dirname(os.path.abspath(target)), '.%s.part' % _options.out_name)
+        stitched.to_netcdf(temp_path)
+        os.replace(temp_path, target)
+    finally:
+        for ds in opened:
+            ds.close()
+    for f in files:
+        os.remove(f)
+    return [target]
+
+
+def _tile_of(f, offsets):
+    """Returns the output file name of the tile which has written the given
+    file (the tile output itself, or one of its parts)."""
+    stem = os.path.splitext(os.path.basename(f))[0]
+    for name in offsets:
+        tile_stem = os.path.splitext(name)[0]
+        if stem == tile_stem or stem.startswith(tile_stem + '_'):
+            return name
+    raise ValueError('%s is not a tile' % f)
+
+
+def _coordinate(ds, names):
+    for name in names:
+        if name in ds.coords:
+            return name
+    return None
+
+
+def _drop_seams(files, datasets, offsets, positions):
+    """Drops from each tile the longitudes (latitudes) which are not beyond
+    the ones of its western (southern) neighbour: the server returns the
+    points on the edge shared by two tiles in both of them.
+
+    returns the datasets, in the order of the files"""
+    tiles = [positions[_tile_of(f, offsets)] for f in files]
+
+    def highest(names, position):
+        values = [float(ds[_coordinate(ds, names)].max()) for ds, tile in zip(datasets, tiles)
+                  if tile == position and _coordinate(ds, names) is not None and ds[_coordinate(ds, names)].size]
+        return max(values) if values else None
+
+    limits = {}
+    for column, row in set(tiles):
+        limits[column, row] = (highest(LONGITUDE_NAMES, (column - 1, row)) if column else None,
+                               highest(LATITUDE_NAMES, (column, row - 1)) if row else None)
+    result = []
+    for ds, tile in zip(datasets, tiles):
+        for names, limit in zip((LONGITUDE_NAMES, LATITUDE_NAMES), limits[tile]):
+            name = _coordinate(ds, names)
+            # curvilinear grids have no index to drop the seams along
+            if limit is not None and name is not None and ds[name].dims == (name,):
+                ds = ds.isel({name: ds[name].values > limit})
+        result.append(ds)
+    return result
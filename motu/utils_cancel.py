@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import threading
+import time
+
+from . import utils_messages
+
+# time (seconds) between two checks of the cancellation by the waits which
+# cannot be interrupted (locks, slots, results of other requests)
+CHECK_PERIOD = 0.5
+
+
+class Cancelled(Exception):
+    """Raised by the operations of a cancelled request."""
+
+    def __init__(self, message=None):
+        Exception.__init__(self, message or utils_messages.get_external_messages()['motu-client.exception.cancelled'])
+
+
+class CancelToken(object):
+    """Cancellation shared by the operations of a request (submission,
+    polling, download) which check it between their steps, and by the parts
+    of a split request, each part holding a child token.
+
+    parent: (optional) the token of the request this one is a part of, whose
+            cancellation cancels this one too"""
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._timer = None
+        self._detach = parent.on_cancel(self.cancel) if parent is not None else None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancels the request and its parts, and runs the registered
+        callbacks (see on_cancel)."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            if self._timer is not None:
+                self._timer.cancel()
+        for callback in callbacks:
+            callback()
+
+    def cancel_after(self, timeout):
+        """Cancels the request if it is still running after timeout seconds."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(timeout, self.cancel)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def on_cancel(self, callback):
+        """Registers a function called (without argument) when the token is
+        cancelled, at once if it already is. Used to interrupt blocking
+        operations.
+
+        returns a function unregistering the callback"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def check(self):
+        """Raises Cancelled if the request is cancelled."""
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, delay):
+        """Sleeps for delay seconds, raising Cancelled as soon as the request
+        is cancelled."""
+        if self._event.wait(max(0, delay)):
+            raise Cancelled()
+
+    def child(self):
+        """Returns the token of a part of the request."""
+        return CancelToken(self)
+
+    def detach(self):
+        """Stops following the cancellation of the parent token, once the
+        part is over."""
+        if self._detach is not None:
+            self._detach()
+            self._detach = None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def get_token(_options):
+    """Returns the cancellation token of the request ('cancel' option), None
+    if it cannot be cancelled."""
+    return getattr(_options, 'cancel', None)
+
+
+def child_token(_options):
+    """Returns a token for a part of the request, cancelled with it, None if
+    the request cannot be cancelled."""
+    token = get_token(_options)
+    return token.child() if token is not None else None
+
+
+def check(token):
+    """Raises Cancelled if the given token (possibly None) is cancelled."""
+    if token is not None:
+        token.check()
+
+
+def sleep(token, delay):
+    """Sleeps for delay seconds, interrupted by the cancellation of the given
+    token (possibly None)."""
+    if token is None:
+        time.sleep(delay)
+    else:
+        token.wait(delay)
@@ -28,6 +28,7 @@
 
 import logging
 import re
+import threading
 
 from . import utils_http
 from . import utils_messages
@@ -36,12 +37,58 @@ from . import utils_log
 from . import utils_collection
 
 from urllib.parse import parse_qs, urlparse, urlencode, quote_plus
+from urllib.error import HTTPError
 
 # pattern used to search for a CAS url within a response
 CAS_URL_PATTERN = '(.*)/login.*'
 
+# CAS tickets services the Motu services redirect to: service url -> CAS url
+_cas_urls = {}
+_cas_urls_lock = threading.Lock()
 
-def authenticate_CAS_for_URL(url, user, pwd, **url_config):
+
+def known_cas_url(url):
+    """Returns the url of the CAS tickets service the given Motu service
+    redirected to when last authenticating in this process, None if
+    unknown."""
+    with _cas_urls_lock:
+        return _cas_urls.get(url.partition('?')[0].rstrip('?'))
+
+
+def _tickets_url(redirected_url):
+    """Returns the url of the CAS tickets service from the url of the CAS
+    login page a service redirected to, None if it is not one."""
+    m = re.search(CAS_URL_PATTERN, redirected_url)
+    return m.group(1) + '/v1/tickets' if m is not None else None
+
+
+def discover_cas_url(url, **url_config):
+    """Returns the url of the CAS tickets service the given Motu service
+    redirects to, None if it does not redirect to a CAS login page. The url
+    is then known (see known_cas_url)."""
+    server = url.partition('?')[0].rstrip('?')
+    connexion = utils_http.open_url(url, **url_config)
+    connexion.close()
+    if connexion.url == url:
+        return None
+    url_cas = _tickets_url(connexion.url)
+    if url_cas is not None:
+        with _cas_urls_lock:
+            _cas_urls[server] = url_cas
+    return url_cas
+
+
+def login(url_cas, user, pwd, **url_config):
+    """Obtains the Ticket Granting Ticket of the user into the session of
+    url_config, unless it already holds one, so that the next
+    authentications only ask for a service ticket."""
+    session = url_config.get('session')
+    if session is None or session.get_ticket(url_cas, user) is not None:
+        return
+    session.set_ticket(url_cas, user, request_ticket_granting_ticket(url_cas, user, pwd, **url_config))
+
+
+def authenticate_CAS_for_URL(url, user, pwd, login=None, **url_config):
     """Performs a CAS authentication for the given URL service and returns
     the service url with the obtained credential.
     
@@ -49,13 +96,17 @@ def authenticate_CAS_for_URL(url, user, pwd, **url_config):
     1) A connection is opened on the given URL
     2) We check that the response is an HTTP redirection
     3) Redirected URL contains the CAS address
-    4) We ask for a ticket for the given user and password
+    4) We ask for a ticket for the given user and password (unless the
+       session given in url_config already holds one)
     5) We ask for a service ticket for the given service
     6) Then we return a new url with the ticket attached
     
     url: the url of the service to invoke
     user: the username
-    pwd: the password"""
+    pwd: the password
+    login: the future of a login in progress into the session (see
+           motu_api.prewarm), waited for before looking for the ticket
+           granting ticket in the session"""
 
     log = logging.getLogger("utils_cas:authenticate_CAS_for_URL")
 
@@ -76,13 +127,50 @@ def authenticate_CAS_for_URL(url, user, pwd, **url_config):
     p = parse_qs(urlparse(connexion.url).query, keep_blank_values=False)
     redirect_service_url = p['service'][0]
 
-    m = re.search(CAS_URL_PATTERN, redirected_url)
+    url_cas = _tickets_url(redirected_url)
 
-    if m is None:
+    if url_cas is None:
         raise Exception(
             utils_messages.get_external_messages()['motu-client.exception.authentication.unfound-url'] % redirected_url)
 
-    url_cas = m.group(1) + '/v1/tickets'
+    with _cas_urls_lock:
+        _cas_urls[server] = url_cas
+
+    if login is not None:
+        # failures of the login are met again below
+        login.exception()
+    session = url_config.get('session')
+    tgt = session.get_ticket(url_cas, user) if session is not None else None
+    if tgt is not None:
+        log.log(utils_log.TRACE_LEVEL, 'TGT (from session): %s', tgt)
+        try:
+            ticket = request_service_ticket(url_cas, tgt, redirect_service_url, **url_config)
+        except HTTPError:
+            # the ticket granting ticket has expired: log in again
+            session.set_ticket(url_cas, user, None)
+            tgt = None
+
+    if tgt is None:
+        tgt = request_ticket_granting_ticket(url_cas, user, pwd, **url_config)
+        if session is not None:
+            session.set_ticket(url_cas, user, tgt)
+        ticket = request_service_ticket(url_cas, tgt, redirect_service_url, **url_config)
+
+    # we append the download url with the ticket and return the result  
+    service_url = redirect_service_url + '&ticket=' + ticket
+
+    utils_log.log_url(log, "service url is:\t", service_url)
+
+    return service_url
+
+
+def request_ticket_granting_ticket(url_cas, user, pwd, **url_config):
+    """Logs the user into the CAS server and returns the Ticket Granting Ticket.
+
+    url_cas: the url of the CAS tickets service
+    user: the username
+    pwd: the password"""
+    log = logging.getLogger("utils_cas:request_ticket_granting_ticket")
 
     opts = urlencode(dict(username=user, password=pwd))
 
@@ -95,30 +183,33 @@ def authenticate_CAS_for_URL(url, user, pwd, **url_config):
         log.log(utils_log.TRACE_LEVEL, 'utils_html.FounderParser() line: %s', line)
         fp.feed(line.decode("utf-8"))
 
+    if fp.action_ is None:
+        raise Exception(utils_messages.get_external_messages()['motu-client.exception.authentication.tgt'])
+
     tgt = fp.action_[fp.action_.rfind('/') + 1:]
     log.log(utils_log.TRACE_LEVEL, 'TGT: %s', tgt)
+    return tgt
+
+
+def request_service_ticket(url_cas, tgt, service_url, **url_config):
+    """Asks the CAS server a service ticket for the given service.
 
-    # WARNING : don't use 'fp.action_' as url : it seems protocol is always http never https 
+    url_cas: the url of the CAS tickets service
+    tgt: the Ticket Granting Ticket of the user
+    service_url: the url of the service to grant"""
+    log = logging.getLogger("utils_cas:request_service_ticket")
+
+    # WARNING : don't use 'fp.action_' as url : it seems protocol is always http never https
     # use 'url_cas', extract TGT from 'fp.action_' , then construct url_ticket.
-    # url_ticket = fp.action_
     url_ticket = url_cas + '/' + tgt
 
-    if url_ticket is None:
-        raise Exception(utils_messages.get_external_messages()['motu-client.exception.authentication.tgt'])
-
     utils_log.log_url(log, "found url ticket:\t", url_ticket)
 
-    opts = utils_http.encode(utils_collection.ListMultimap(service=quote_plus(redirect_service_url)))
+    opts = utils_http.encode(utils_collection.ListMultimap(service=quote_plus(service_url)))
 
     utils_log.log_url(log, 'Granting user for service\t', url_ticket + '?' + opts)
     url_config['data'] = opts
     ticket = utils_http.open_url(url_ticket, **url_config).readline().decode("utf-8")
 
     utils_log.log_url(log, "found service ticket:\t", ticket)
-
-    # we append the download url with the ticket and return the result  
-    service_url = redirect_service_url + '&ticket=' + ticket
-
-    utils_log.log_url(log, "service url is:\t", service_url)
-
-    return service_url
+    return ticket
@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, wait
+
+try:
+    import fcntl
+except ImportError:
+    # no cross-process coordination on platforms without flock
+    fcntl = None
+
+from . import utils_cancel
+
+# time (seconds) after which the recorded result of a request is removed
+# from the lock directory, the processes waiting for it having long got it
+RECORD_MAX_AGE = 24 * 3600
+
+# requests in progress in this process: key -> Future of (target, files written)
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def coalesce(key, target, function, lock_dir=None, cancel=None):
+    """Runs function only once for all the identical requests in progress.
+
+    The first caller for a given key (the leader) runs the function, which
+    returns the list of the files it has written. Callers arriving while the
+    leader is running wait for it and get a copy of its files under their own
+    target name instead of running the request again.
+
+    When lock_dir is set, processes sharing this directory are coordinated the
+    same way through a lock file per key.
+
+    key: the canonical key of the request
+    target: the file the caller expects as result
+    function: the function performing the request (no argument)
+    lock_dir: (optional) the directory of the lock files
+    cancel: (optional) the utils_cancel.CancelToken of the caller, which stops
+            its wait for the result of another request
+
+    returns the list of the files written for the caller"""
+    log = logging.getLogger("utils_coalesce")
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _in_flight[key] = future
+
+    if not leader:
+        log.info("An identical request is in progress, waiting for its result")
+        while cancel is not None and not future.done():
+            cancel.check()
+            wait([future], utils_cancel.CHECK_PERIOD)
+        source, files = future.result()
+        return share(source, files, target)
+
+    try:
+        files = _run_locked(key, target, function, lock_dir, cancel)
+        future.set_result((target, files))
+        return files
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def _run_locked(key, target, function, lock_dir, cancel=None):
+    """Runs function while holding the lock file of the key. If another process
+    holds it, waits for it and reuses its result when it succeeded.
+
+    The lock file is removed by the process holding it once the result is
+    published, a process which then gets the lock of the removed file locking
+    the new one instead."""
+    log = logging.getLogger("utils_coalesce")
+    if lock_dir is None or fcntl is None:
+        return function()
+
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    lock_path = os.path.join(lock_dir, key + '.lock')
+    record_path = os.path.join(lock_dir, key + '.json')
+    started = time.time()
+
+    while True:
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                log.info("An identical request is in progress in another process, waiting for its result")
+                _wait_lock(lock_file, cancel)
+                record = _read_record(record_path, started)
+                if record is not None:
+                    return share(record['target'], record['files'], target)
+            if not _is_locked_file(lock_file, lock_path):
+                continue
+            try:
+                files = function()
+                _write_record(record_path, target, files)
+                return files
+            finally:
+                os.remove(lock_path)
+                _remove_old_records(lock_dir)
+
+
+def _wait_lock(lock_file, cancel):
+    """Locks the lock file held by another process, checking the cancellation
+    of the caller (utils_cancel.CancelToken, possibly None) meanwhile."""
+    while True:
+        utils_cancel.sleep(cancel, utils_cancel.CHECK_PERIOD)
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+
+def _is_locked_file(lock_file, lock_path):
+    """Returns whether the opened lock file is still the one at lock_path."""
+    try:
+        stat = os.stat(lock_path)
+    except (IOError, OSError):
+        return False
+    opened = os.fstat(lock_file.fileno())
+    return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+
+def _remove_old_records(lock_dir):
+    """Removes the results recorded more than RECORD_MAX_AGE seconds ago, no
+    longer awaited by any process."""
+    now = time.time()
+    for name in os.listdir(lock_dir):
+        path = os.path.join(lock_dir, name)
+        try:
+            if name.endswith('.json') and now - os.path.getmtime(path) > RECORD_MAX_AGE:
+                os.remove(path)
+        except (IOError, OSError):
+            # removed by another process meanwhile
+            pass
+
+
+def _read_record(record_path, since):
+    """Returns the result recorded after 'since' (a timestamp), or None if
+    there is no such result or its files are gone."""
+    try:
+        with open(record_path) as record_file:
+            record = json.load(record_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if record.get('completed', 0) < since:
+        return None
+    files = record.get('files', [])
+    if not all(os.path.isfile(f) for f in files):
+        return None
+    return record
+
+
+def _write_record(record_path, target, files):
+    temp_path = record_path + '.tmp'
+    with open(temp_path, 'w') as record_file:
+        json.dump({'completed': time.time(),
+                   'target': os.path.abspath(target),
+                   'files': [os.path.abspath(f) for f in files]}, record_file)
+    os.replace(temp_path, record_path)
+
+
+def share(source, files, target):
+    """Copies the files written for the source target under the name of the
+    given target.
+
+    A request split into several parts writes files named after its target
+    (e.g. data_0.nc, data_1.nc for data.nc): the same suffixes are kept.
+    Only the files named that way are renamed (not data.nc.bak, nor
+    data_old.txt), the others are copied under their own name.
+
+    returns the list of the files copied"""
+    log = logging.getLogger("utils_coalesce")
+    source_base, source_extension = os.path.splitext(os.path.abspath(source))
+    target_base, target_extension = os.path.splitext(target)
+
+    copies = []
+    for f in files:
+        f_abs = os.path.abspath(f)
+        suffix = f_abs[len(source_base):len(f_abs) - len(source_extension)]
+        if f_abs == os.path.abspath(source):
+            name = target
+        elif (f_abs.startswith(source_base + '_') and f_abs.endswith(source_extension) and
+              os.sep not in suffix and '.' not in suffix):
+            name = target_base + suffix + target_extension
+        else:
+            name = os.path.join(os.path.dirname(target), os.path.basename(f))
+        if os.path.abspath(name) != f_abs:
+            log.info("Copying %s to %s", f, name)
+            shutil.copyfile(f, name)
+        copies.append(name)
+    return copies
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import copy
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import utils_cancel
+from . import utils_metadata
+from . import utils_metrics
+
+# bounds stored for the axes requested whole
+UNBOUNDED_LOWER = -1e30
+UNBOUNDED_UPPER = 1e30
+
+# names of the dimensions of the axes in the downloaded files
+LONGITUDE_NAMES = ('longitude', 'lon', 'x')
+LATITUDE_NAMES = ('latitude', 'lat', 'y')
+DEPTH_NAMES = ('depth', 'deptht', 'lev', 'z')
+TIME_NAMES = ('time', 't')
+
+# number of time steps read at a time when subsetting (with dask)
+CHUNK_STEPS = 24
+
+# format of the dates of the requests of the uncovered periods
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# opened indexes: path -> CoverageIndex
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class NotCovered(Exception):
+    """Raised when a file does not hold the data of a request after all."""
+
+
+class CoverageIndex(object):
+    """Index of the files downloaded, by the extent of their request
+    (product, box, depths, period and variables), stored in a SQLite
+    database, to find the files holding the data of a new request."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS downloads ("
+                                     "path TEXT PRIMARY KEY, motu TEXT, service TEXT, product TEXT, "
+                                     "lon_min REAL, lon_max REAL, lat_min REAL, lat_max REAL, "
+                                     "depth_min REAL, depth_max REAL, time_min REAL, time_max REAL, "
+                                     "variables TEXT, recorded REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS downloads_product "
+                                     "ON downloads (service, product, time_min, time_max)")
+
+    def record(self, path, extent):
+        """Records the file holding the data of the given extent (see
+        request_extent)."""
+        values = (extent['motu'], extent['service'], extent['product'], extent['lon'][0], extent['lon'][1],
+                  extent['lat'][0], extent['lat'][1], extent['depth'][0], extent['depth'][1],
+                  extent['time'][0], extent['time'][1], ','.join(extent['variables'] or ()), time.time())
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO downloads VALUES "
+                                     "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (os.path.abspath(path),) + values)
+
+    def find(self, extent, partial=False):
+        """Returns the files holding the data of the given extent, the most
+        recent first, as dictionaries of their path and extent.
+
+        partial: whether the files covering only a part of the period (but
+                 the whole box, depths and variables) are returned too"""
+        args = [extent['motu'], extent['service'], extent['product'],
+                extent['lon'][0], extent['lon'][1], extent['lat'][0], extent['lat'][1],
+                extent['depth'][0], extent['depth'][1]]
+        query = ("SELECT * FROM downloads WHERE motu = ? AND service = ? AND product = ? "
+                 "AND lon_min <= ? AND lon_max >= ? AND lat_min <= ? AND lat_max >= ? "
+                 "AND depth_min <= ? AND depth_max >= ? ")
+        if partial:
+            query += "AND time_min < ? AND time_max > ? "
+            args += [extent['time'][1], extent['time'][0]]
+        else:
+            query += "AND time_min <= ? AND time_max >= ? "
+            args += list(extent['time'])
+        with self._lock:
+            rows = self._connection.execute(query + "ORDER BY recorded DESC", args).fetchall()
+        files = []
+        for row in rows:
+            variables = row['variables'].split(',') if row['variables'] else None
+            if variables is not None and (extent['variables'] is None or
+                                          not set(extent['variables']).issubset(variables)):
+                continue
+            if not os.path.isfile(row['path']):
+                self.remove(row['path'])
+                continue
+            files.append({'path': row['path'],
+                          'time': (row['time_min'], row['time_max']),
+                          'variables': variables})
+        return files
+
+    def remove(self, path):
+        with self._lock:
+            self._connection.execute("DELETE FROM downloads WHERE path = ?", (os.path.abspath(path),))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_index(path):
+    """Returns the index stored in the given file, shared by all the threads
+    of the process, or None if path is not set."""
+    if not path:
+        return None
+    with _indexes_lock:
+        if path not in _indexes:
+            logging.getLogger("utils_coverage").debug("Opening coverage index %s", path)
+            _indexes[path] = CoverageIndex(path)
+        return _indexes[path]
+
+
+def _seconds(value):
+    if value is None:
+        return None
+    return utils_metadata.parse_date(value)
+
+
+def request_extent(_options):
+    """Returns the extent of the data requested by the (checked) options, as
+    a dictionary: server, service, product, (lower, upper) bounds of each
+    axis (the unbounded ones being UNBOUNDED_LOWER or UNBOUNDED_UPPER), times
+    in seconds since the epoch, and sorted variables (None for all of them).
+
+    returns None for the requests which are not indexed: other outputs than
+    NetCDF, boxes crossing the antimeridian"""
+    if _options.extraction_output and _options.outputWritten != 'netcdf':
+        return None
+
+    def bounds(lower, upper, convert=float):
+        return (UNBOUNDED_LOWER if lower is None else convert(lower),
+                UNBOUNDED_UPPER if upper is None else convert(upper))
+
+    lon = bounds(_options.longitude_min, _options.longitude_max)
+    if lon[0] > lon[1]:
+        return None
+    return {'motu': _options.motu.rstrip('?'),
+            'service': _options.service_id,
+            'product': _options.product_id,
+            'lon': lon,
+            'lat': bounds(_options.latitude_min, _options.latitude_max),
+            'depth': bounds(_options.depth_min, _options.depth_max),
+            'time': bounds(_options.date_min, _options.date_max, _seconds),
+            'variables': tuple(sorted(set(_options.variable))) if _options.variable else None}
+
+
+def record(_options, files):
+    """Records the result of a request in the index given by its
+    'coverage_index' option, if any. Results split into several files are
+    recorded by part."""
+    index = get_index(getattr(_options, 'coverage_index', None))
+    if index is None or len(files) != 1 or _options.describe or _options.size:
+        return
+    extent = request_extent(_options)
+    if extent is not None:
+        index.record(files[0], extent)
+
+
+def _dimension(dataset, names):
+    return next((name for name in names if name in dataset.dims), None)
+
+
+def subset(path, _options):
+    """Returns the part of the given file requested by the options, as a
+    lazy xarray.Dataset: the cells whose coordinates are within the bounds
+    of the request. Its data are only read when written, by blocks of
+    CHUNK_STEPS time steps if dask is available.
+
+    Requires xarray. Raises NotCovered if the file does not hold the whole
+    extent (e.g. its longitudes are in [0, 360])."""
+    import importlib.util
+    import xarray as xr
+    chunks = {} if importlib.util.find_spec('dask') is not None else None
+    dataset = xr.open_dataset(path, chunks=chunks)
+    if chunks is not None:
+        time_dim = _dimension(dataset, TIME_NAMES)
+        if time_dim is not None:
+            dataset = dataset.chunk({time_dim: CHUNK_STEPS})
+    if _options.variable:
+        missing = [v for v in _options.variable if v not in dataset.variables]
+        if missing:
+            raise NotCovered("%s has no variable %s" % (path, ', '.join(missing)))
+        dataset = dataset[list(_options.variable)]
+
+    selection = {}
+    for names, lower, upper in ((LONGITUDE_NAMES, _options.longitude_min, _options.longitude_max),
+                                (LATITUDE_NAMES, _options.latitude_min, _options.latitude_max),
+                                (DEPTH_NAMES, _options.depth_min, _options.depth_max)):
+        dim = _dimension(dataset, names)
+        if dim is None or (lower is None and upper is None):
+            continue
+        values = dataset[dim].values
+        lower = float(lower) if lower is not None else min(values[0], values[-1])
+        upper = float(upper) if upper is not None else max(values[0], values[-1])
+        # the file must hold the requested range, within a cell
+        first_step = abs(values[1] - values[0]) if len(values) > 1 else 0
+        last_step = abs(values[-1] - values[-2]) if len(values) > 1 else 0
+        low_end, high_end = (values[0], values[-1]) if values[0] <= values[-1] else (values[-1], values[0])
+        if low_end > lower + first_step or high_end < upper - last_step:
+            raise NotCovered("%s does not cover %s [%s, %s]" % (path, dim, lower, upper))
+        selection[dim] = slice(lower, upper) if values[0] <= values[-1] else slice(upper, lower)
+
+    time_dim = _dimension(dataset, TIME_NAMES)
+    if time_dim is not None and (_options.date_min is not None or _options.date_max is not None):
+        lower, upper = (datetime.datetime.utcfromtimestamp(_seconds(d)) if d is not None else None
+                        for d in (_options.date_min, _options.date_max))
+        selection[time_dim] = slice(lower, upper)
+
+    dataset = dataset.sel(selection)
+    for dim in selection:
+        if dataset.sizes[dim] == 0:
+            raise NotCovered("%s has no data in the requested %s range" % (path, dim))
+    return dataset
+
+
+def _write(dataset, fh):
+    """Writes the dataset into the file fh, replaced once complete."""
+    temp_path = os.path.join(os.path.dirname(os.path.abspath(fh)), '.%s.part' % os.path.basename(fh))
+    try:
+        dataset.to_netcdf(temp_path)
+        os.replace(temp_path, fh)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def execute_covered(_options, fh):
+    """Writes the result of the request into fh from the files already
+    downloaded, found in the index given by the 'coverage_index' option.
+
+    A file covering the whole request is subset locally. A file covering
+    the box, depths and variables but only a part of the period is subset
+    for that part, and only the periods before and after it are requested
+    to Motu, the parts being then concatenated.
+
+    returns the list of the files written, or None if the request has to be
+    sent to Motu (nothing covered, xarray missing...)"""
+    log = logging.getLogger("utils_coverage")
+    index = get_index(getattr(_options, 'coverage_index', None))
+    extent = request_extent(_options) if index is not None else None
+    if extent is None:
+        return None
+    try:
+        for source in index.find(extent):
+            try:
+                dataset = subset(source['path'], _options)
+            except NotCovered as e:
+                log.debug("%s", e)
+                continue
+            log.info("Subsetting %s, covering the request", source['path'])
+            with dataset:
+                _write(dataset, fh)
+            utils_metrics.get_metrics().count('coverage.local')
+            index.record(fh, extent)
+            return [fh]
+        for source in index.find(extent, partial=True):
+            files = _execute_partial(_options, fh, source)
+            if files is not None:
+                index.record(fh, extent)
+                return files
+    except ImportError as e:
+        log.debug("Local subsetting unavailable: %s", e)
+    return None
+
+
+def _execute_partial(_options, fh, source):
+    """Subsets the given file for the part of the period it covers, and
+    requests the rest of the period to Motu.
+
+    returns the list of the files written, None if the file does not hold
+    the data it should"""
+    import xarray as xr
+    from . import motu_api
+    log = logging.getLogger("utils_coverage")
+    lower, upper = request_extent(_options)['time']
+    covered = copy.copy(_options)
+    covered.date_min = _date(max(lower, source['time'][0]))
+    covered.date_max = _date(min(upper, source['time'][1]))
+    try:
+        local = subset(source['path'], covered)
+    except NotCovered as e:
+        log.debug("%s", e)
+        return None
+    time_dim = _dimension(local, TIME_NAMES)
+    if time_dim is None:
+        local.close()
+        return None
+
+    log.info("Subsetting %s for %s - %s, requesting the rest of the period",
+             source['path'], covered.date_min, covered.date_max)
+    utils_metrics.get_metrics().count('coverage.partial')
+    base_name, extension = os.path.splitext(_options.out_name)
+    remote_files = []
+    try:
+        # the bounds are requested again, their duplicated times are dropped
+        for name, date_min, date_max in (('before', lower, source['time'][0]), ('after', source['time'][1], upper)):
+            if date_min >= date_max:
+                continue
+            part = copy.copy(_options)
+            part.date_min = _options.date_min if date_min == lower else _date(date_min)
+            part.date_max = _options.date_max if date_max == upper else _date(date_max)
+            part.out_name = '%s_%s%s' % (base_name, name, extension)
+            # the uncovered part is not looked up again
+            part.coverage_index = None
+            part.cancel = utils_cancel.child_token(_options)
+            remote_files += motu_api.execute_request(part)
+        datasets = [local] + [xr.open_dataset(f) for f in remote_files]
+        try:
+            combined = xr.concat(datasets, dim=time_dim, data_vars='minimal', coords='minimal')
+            combined = combined.sortby(time_dim)
+            combined = combined.isel({time_dim: ~combined.indexes[time_dim].duplicated()})
+            _write(combined, fh)
+        finally:
+            for dataset in datasets:
+                dataset.close()
+    finally:
+        for f in remote_files:
+            if os.path.exists(f):
+                os.remove(f)
+    return [fh]
+
+
+def _date(seconds):
+    if not UNBOUNDED_LOWER < seconds < UNBOUNDED_UPPER:
+        return None
+    return datetime.datetime.utcfromtimestamp(seconds).strftime(DATE_FORMAT)
@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import json
+import logging
+import os
+import threading
+
+from . import utils_metadata
+
+# bytes of a value of a variable (float32, the usual type of the products)
+BYTES_PER_VALUE = 4
+
+# bytes of the headers and coordinates of a result file
+HEADER_BYTES = 20000
+
+# default steps used when the server does not publish them (degrees and
+# seconds). The calibration factor then absorbs the actual resolution.
+DEFAULT_GEO_STEP = 1.
+DEFAULT_TIME_STEP = 86400.
+
+# name of the calibration file in the metadata cache directory
+CALIBRATION_FILE = 'calibration.json'
+
+# maximum number of getSize results averaged by the calibration, so that it
+# follows the changes of the products
+CALIBRATION_SAMPLES = 20
+
+_calibration_lock = threading.Lock()
+
+
+def _axis_count(np, lo, hi, axis, periodic=False):
+    """Number of grid points of the axis within [lo, hi] (arrays)."""
+    lower = axis.lower if axis is not None and axis.lower is not None else -np.inf
+    upper = axis.upper if axis is not None and axis.upper is not None else np.inf
+    step = axis.step if axis is not None and axis.step else DEFAULT_GEO_STEP
+    if periodic:
+        # boxes crossing the antimeridian have lo > hi
+        width = np.where(hi >= lo, hi - lo, hi - lo + 360.)
+        if np.isfinite(upper - lower):
+            width = np.minimum(width, upper - lower)
+        return np.floor(width / step + 1e-9) + 1
+    lo = np.maximum(lo, lower)
+    hi = np.minimum(hi, upper)
+    return np.where(hi >= lo, np.floor((hi - lo) / step + 1e-9) + 1, 0)
+
+
+def _depth_count(np, lo, hi, depths):
+    if not depths:
+        return np.ones(np.broadcast(lo, hi).shape)
+    depths = np.asarray(depths, dtype=float)
+    return np.maximum(np.searchsorted(depths, hi, 'right') - np.searchsorted(depths, lo, 'left'), 0)
+
+
+def _time_count(np, lo, hi, times):
+    if not times:
+        return np.ones(np.broadcast(lo, hi).shape)
+    count = 0
+    for start, end, step in times:
+        step = step if step is not None else DEFAULT_TIME_STEP
+        if not step:
+            count = count + ((lo <= start) & (start <= hi))
+            continue
+        first = np.ceil((np.maximum(lo, start) - start) / step - 1e-9)
+        last = np.floor((np.minimum(hi, end) - start) / step + 1e-9)
+        count = count + np.maximum(last - first + 1, 0)
+    return count
+
+
+def estimate(grid, x_lo, x_hi, y_lo, y_hi, z_lo=None, z_hi=None, t_lo=None, t_hi=None, variables=None,
+             factor=1.):
+    """Estimates the size (bytes) of extractions of a product.
+
+    The bounds can be numbers or NumPy arrays (broadcast together), so that
+    thousands of candidate extractions are estimated at once. Requires NumPy.
+
+    grid: the utils_metadata.ProductGrid of the product
+    x_lo, x_hi, y_lo, y_hi: the geographic box, in degrees (x_lo > x_hi for
+                            boxes crossing the antimeridian)
+    z_lo, z_hi: the depth range, all the depths if not set
+    t_lo, t_hi: the time range in seconds since the epoch, all the times if
+                not set
+    variables: the number of variables, or the list of their names, all the
+               variables of the product if not set
+    factor: the calibration factor of the product (see calibration)
+
+    returns the estimated sizes: a float, or an array for array bounds"""
+    import numpy as np
+
+    x_lo, x_hi, y_lo, y_hi = (np.asarray(v, dtype=float) for v in (x_lo, x_hi, y_lo, y_hi))
+    z_lo = np.asarray(-np.inf if z_lo is None else z_lo, dtype=float)
+    z_hi = np.asarray(np.inf if z_hi is None else z_hi, dtype=float)
+    t_lo = np.asarray(-np.inf if t_lo is None else t_lo, dtype=float)
+    t_hi = np.asarray(np.inf if t_hi is None else t_hi, dtype=float)
+    if variables is None:
+        variables = len(grid.variables) or 1
+    elif not isinstance(variables, int):
+        variables = len(variables)
+
+    cells = (_axis_count(np, x_lo, x_hi, grid.lon, periodic=True) *
+             _axis_count(np, y_lo, y_hi, grid.lat) *
+             _depth_count(np, z_lo, z_hi, grid.depths) *
+             _time_count(np, t_lo, t_hi, grid.times))
+    sizes = cells * variables * BYTES_PER_VALUE * factor + HEADER_BYTES
+    return float(sizes) if np.ndim(sizes) == 0 else sizes
+
+
+def options_bounds(_options):
+    """Returns the bounds of a request as the keyword arguments of estimate."""
+    def number(name):
+        value = getattr(_options, name, None)
+        return float(value) if value is not None else None
+
+    def date(name):
+        value = getattr(_options, name, None)
+        return utils_metadata.parse_date(value) if value else None
+
+    bounds = {'x_lo': number('longitude_min'), 'x_hi': number('longitude_max'),
+              'y_lo': number('latitude_min'), 'y_hi': number('latitude_max'),
+              'z_lo': number('depth_min'), 'z_hi': number('depth_max'),
+              't_lo': date('date_min'), 't_hi': date('date_max'),
+              'variables': getattr(_options, 'variable', None) or None}
+    # a missing bound of the box means the full extent
+    for name, default in (('x_lo', -180.), ('x_hi', 180.), ('y_lo', -90.), ('y_hi', 90.)):
+        if bounds[name] is None:
+            bounds[name] = default
+    return bounds
+
+
+def load_calibration(cache_dir):
+    """Returns the calibration of the products: a dictionary 'SERVICE/PRODUCT'
+    -> {'factor': ..., 'samples': ...}."""
+    path = os.path.join(cache_dir, CALIBRATION_FILE) if cache_dir else None
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibration_factor(cache_dir, service_id, product_id):
+    """Returns the calibration factor of a product, 1 if not calibrated."""
+    entry = load_calibration(cache_dir).get('%s/%s' % (service_id, product_id))
+    return entry['factor'] if entry else 1.
+
+
+def calibrate(cache_dir, service_id, product_id, estimated, actual):
+    """Records the actual size of an extraction (getSize result) estimated
+    with a calibration factor of 1, updating the calibration factor of the
+    product with the average of the latest ratios."""
+    if not cache_dir or not estimated or actual is None or actual <= 0:
+        return
+    ratio = (actual - HEADER_BYTES) / max(estimated - HEADER_BYTES, 1.)
+    if ratio <= 0:
+        return
+    key = '%s/%s' % (service_id, product_id)
+    with _calibration_lock:
+        calibration = load_calibration(cache_dir)
+        entry = calibration.get(key, {'factor': ratio, 'samples': 0})
+        samples = min(entry['samples'], CALIBRATION_SAMPLES - 1)
+        entry = {'factor': (entry['factor'] * samples + ratio) / (samples + 1), 'samples': samples + 1}
+        calibration[key] = entry
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = os.path.join(cache_dir, CALIBRATION_FILE)
+        temp_path = '%s.%i.part' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(calibration, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    logging.getLogger("utils_estimate").debug("Calibration of %s: %.3g (%i samples)", key, entry['factor'],
+                                              entry['samples'])
+
+
+def estimate_request(_options, cache_dir=None, offline=False):
+    """Estimates the size (bytes) of the result of a request, offline when the
+    describeProduct result of the product is cached in cache_dir (see
+    utils_metadata.get_product_grid).
+
+    offline: return None if the description is not cached instead of
+             requesting it"""
+    grid = utils_metadata.get_product_grid(_options, cache_dir, offline=offline)
+    if grid is None:
+        return None
+    factor = calibration_factor(cache_dir, _options.service_id, _options.product_id)
+    return estimate(grid, factor=factor, **options_bounds(_options))
@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from . import utils_cancel
+
+# default number of connections opened at the same time on a host
+DEFAULT_MAX_PER_HOST = 4
+
+# upper bound of the number of connections when the limit is adaptive
+ADAPTIVE_MAX_PER_HOST = 16
+
+# a request slower than this factor times the average latency is a spike
+LATENCY_SPIKE_FACTOR = 3.0
+
+# the aggregated throughput must grow by this ratio to add one more connection
+SCALING_GAIN = 0.1
+
+# weight of the last sample in the moving averages
+EWMA_WEIGHT = 0.2
+
+
+class TokenBucket(object):
+    """Token bucket limiting the number of bytes per second transferred by all
+    the threads sharing it.
+
+    rate: the number of bytes per second, None or 0 for no limit
+    burst: the size of the bucket in bytes (one second of transfer by default)"""
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Changes the rate (bytes per second, None or 0 for no limit)."""
+        with self._lock:
+            self.rate = rate if rate else None
+            self.burst = burst if burst else (self.rate or 0)
+            self._tokens = self.burst
+            self._stamp = time.time()
+
+    def consume(self, n):
+        """Takes n tokens from the bucket, waiting as long as necessary."""
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                # a block bigger than the bucket is let through once the bucket is full
+                if self._tokens >= min(n, self.burst):
+                    self._tokens -= n
+                    return
+                wait = (min(n, self.burst) - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter(object):
+    """Semaphore with an adjustable limit on the connections opened on a host.
+
+    When adaptive, the limit is decreased by half on errors and latency spikes,
+    and increased by one while the aggregated throughput keeps growing."""
+
+    def __init__(self, host, limit=DEFAULT_MAX_PER_HOST, adaptive=False):
+        self.host = host
+        self.limit = limit
+        self.adaptive = adaptive
+        self.active = 0
+        self._condition = threading.Condition()
+        self._latency = None
+        self._rate = None
+        self._last_aggregate = None
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = max(1, limit)
+            self._condition.notify_all()
+
+    def acquire(self, cancel=None):
+        """Waits for a free connection slot, raising utils_cancel.Cancelled
+        if the given token (possibly None) is cancelled meanwhile."""
+        with self._condition:
+            while self.active >= self.limit:
+                utils_cancel.check(cancel)
+                self._condition.wait(utils_cancel.CHECK_PERIOD)
+            self.active += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def report(self, elapsed, nbytes=0, error=False):
+        """Reports the outcome of an operation done on the host.
+
+        elapsed: the duration of the operation (seconds)
+        nbytes: the number of bytes transferred, 0 for a simple request
+        error: whether the operation failed"""
+        if not self.adaptive:
+            return
+        log = logging.getLogger("utils_governor")
+        with self._condition:
+            if error:
+                self._decrease("error")
+                return
+            if nbytes == 0:
+                if self._latency is not None and elapsed > LATENCY_SPIKE_FACTOR * self._latency:
+                    self._decrease("latency spike (%.1f s)" % elapsed)
+                self._latency = _ewma(self._latency, elapsed)
+                return
+            if elapsed <= 0:
+                return
+            self._rate = _ewma(self._rate, nbytes / elapsed)
+            aggregate = self._rate * max(1, self.active)
+            if self._last_aggregate is None or aggregate > self._last_aggregate * (1 + SCALING_GAIN):
+                if self.limit < ADAPTIVE_MAX_PER_HOST:
+                    self.limit += 1
+                    log.debug("%s: throughput scales, %i connections allowed", self.host, self.limit)
+                    self._condition.notify()
+                self._last_aggregate = aggregate
+
+    def _decrease(self, reason):
+        self.limit = max(1, self.limit // 2)
+        self._last_aggregate = None
+        logging.getLogger("utils_governor").info("%s: %s, backing off to %i connections",
+                                                  self.host, reason, self.limit)
+
+
+class Governor(object):
+    """Bandwidth and per host concurrency limits shared by all the threads of
+    the process. Limits can be changed at any time with configure."""
+
+    def __init__(self):
+        self.bandwidth = TokenBucket()
+        self.max_per_host = DEFAULT_MAX_PER_HOST
+        self.adaptive = False
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_rate=None, max_per_host=None, adaptive=None):
+        """Changes the limits. Limits given as None are left unchanged.
+
+        max_rate: the number of bytes per second of all the downloads, 0 for
+                  no limit
+        max_per_host: the number of connections opened at the same time on a
+                      host
+        adaptive: whether the number of connections per host adapts to the
+                  throughput, errors and latency"""
+        if max_rate is not None:
+            self.bandwidth.set_rate(float(max_rate))
+        with self._lock:
+            if max_per_host is not None:
+                self.max_per_host = int(max_per_host)
+            if adaptive is not None:
+                self.adaptive = bool(adaptive)
+            for limiter in self._hosts.values():
+                limiter.adaptive = self.adaptive
+                if max_per_host is not None:
+                    limiter.set_limit(self.max_per_host)
+
+    def host(self, url):
+        """Returns the limiter of the host of the given url."""
+        netloc = urlparse(url).netloc
+        with self._lock:
+            if netloc not in self._hosts:
+                self._hosts[netloc] = HostLimiter(netloc, self.max_per_host, self.adaptive)
+            return self._hosts[netloc]
+
+    def stats(self):
+        """Returns the state of the limits, as a dictionary."""
+        with self._lock:
+            hosts = list(self._hosts.values())
+        return {'max_rate': self.bandwidth.rate,
+                'adaptive': self.adaptive,
+                'hosts': dict((limiter.host, {'limit': limiter.limit, 'active': limiter.active})
+                              for limiter in hosts)}
+
+    @contextmanager
+    def slot(self, url, cancel=None):
+        """Holds a connection slot on the host of the given url. The duration
+        and the outcome of the block are reported to the host limiter; the
+        block can add the number of bytes it transferred to the yielded
+        dictionary ('bytes' key), and set its 'interrupted' key when it
+        interrupts its own transfer (cancellation, stall).
+
+        Only the errors of the server or of the network (see
+        is_server_error) of a block which was not interrupted are reported
+        as errors.
+
+        cancel: (optional) the utils_cancel.CancelToken of the request, which
+                stops the wait for a slot"""
+        limiter = self.host(url)
+        limiter.acquire(cancel)
+        stats = {'bytes': 0, 'interrupted': False}
+        start = time.time()
+        try:
+            yield stats
+        except Exception as e:
+            if not stats['interrupted'] and is_server_error(e):
+                limiter.report(time.time() - start, error=True)
+            raise
+        else:
+            limiter.report(time.time() - start, stats['bytes'])
+        finally:
+            limiter.release()
+
+
+def is_server_error(e):
+    """Returns whether an exception is an error of the server or of the
+    network: HTTP 5xx or 429 answers, failed or broken connections and
+    timeouts. Cancellations, other HTTP answers and local errors (e.g. disk
+    errors) are not."""
+    # imported here as they are rather long to import
+    from http.client import HTTPException
+    from urllib.error import HTTPError, URLError
+    if isinstance(e, HTTPError):
+        return e.code >= 500 or e.code == 429
+    return isinstance(e, (URLError, ConnectionError, TimeoutError, HTTPException))
+
+
+def _ewma(average, sample):
+    if average is None:
+        return sample
+    return (1 - EWMA_WEIGHT) * average + EWMA_WEIGHT * sample
+
+
+_governor = Governor()
+
+
+def get_governor():
+    """Returns the governor shared by the whole process."""
+    return _governor
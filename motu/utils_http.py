@@ -26,53 +26,368 @@
 #  along with this library; if not, write to the Free Software Foundation,
 #  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
-from .utils_log import HTTPDebugProcessor, TRACE_LEVEL
+from .utils_log import log_url, TRACE_LEVEL
+from . import utils_metrics
+from . import utils_trace
 # import urllib2
 # import httplib
 # import cookielib
 # import utils_log
-from http.client import HTTPSConnection
+from http.client import HTTPConnection, HTTPSConnection
 from urllib.request import *
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
+import errno
 import logging
+import os
+import selectors
 import ssl
 import socket
+import threading
+import time
+import zlib
 from http.cookiejar import CookieJar
 
+# time (seconds) the addresses of a host are kept (see resolve)
+DNS_TTL = 300
 
-class TLS1Connection(HTTPSConnection):
-    """Like HTTPSConnection but more specific"""
+# time (seconds) after which a connection opened in advance and still unused
+# is dropped, servers closing idle connections
+WARM_MAX_AGE = 15
 
-    def __init__(self, host, **kwargs):
-        HTTPSConnection.__init__(self, host, **kwargs)
+# delay (seconds) after which the next address of a host is tried while the
+# previous attempts are still connecting (happy eyeballs)
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# resolved addresses: (host, port) -> (expiry time, getaddrinfo list)
+_addresses = {}
+_addresses_lock = threading.Lock()
+
+# TLS context shared by the connections, built from the configuration
+# [CA bundle, ciphers] (see configure_tls), and TLS sessions kept for
+# resumption: (server name, port) -> ssl.SSLSession
+_ssl_context = None
+_tls_config = [None, None]
+_tls_sessions = {}
+_tls_lock = threading.Lock()
+
+
+class HTTPDebugProcessor(BaseHandler):
+    """ Track HTTP requests and responses with this custom handler.
+    """
+
+    def __init__(self, log, log_level=TRACE_LEVEL):
+        self.log_level = log_level
+        self.log = log
+
+    def http_request(self, request):
+        # requests are only formatted when traced
+        if not self.log.isEnabledFor(self.log_level):
+            return request
+        host, full_url = request.host, request.get_full_url()
+        url_path = full_url[full_url.find(host) + len(host):]
+        log_url(self.log, "Requesting: ", full_url, self.log_level)
+        self.log.log(self.log_level, "%s %s", request.get_method(), url_path)
+
+        for header in request.header_items():
+            self.log.log(self.log_level, " . %s: %s", *header)
+
+        return request
+
+    def http_response(self, request, response):
+        if not self.log.isEnabledFor(self.log_level):
+            return response
+        code, msg, hdrs = response.code, response.msg, response.headers
+        self.log.log(self.log_level, "Response:")
+        self.log.log(self.log_level, " HTTP/1.x %s %s", code, msg)
+
+        for headers in hdrs.items():
+            self.log.log(self.log_level, " . %s : %s", *headers)
+
+        return response
+
+
+def resolve(host, port):
+    """Returns the addresses of a host (see socket.getaddrinfo), resolved
+    once every DNS_TTL seconds for the whole process."""
+    now = time.time()
+    with _addresses_lock:
+        entry = _addresses.get((host, port))
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with _addresses_lock:
+        _addresses[(host, port)] = (now + DNS_TTL, addresses)
+    return addresses
+
+
+def _interleave(addresses):
+    """Orders the addresses alternating their families, starting with the
+    family of the first one (RFC 8305)."""
+    families = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+        by_family[address[0]].append(address)
+    ordered = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+
+def create_connection(host, port, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """Like socket.create_connection, with the addresses given by resolve,
+    connecting with happy eyeballs (RFC 8305): the next address (alternating
+    IPv6 and IPv4) is tried every HAPPY_EYEBALLS_DELAY seconds, or as soon
+    as an attempt fails, without waiting for the previous attempts, and the
+    first connected socket is kept."""
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    deadline = time.time() + timeout if timeout is not None else None
+    addresses = _interleave(resolve(host, port))
+    selector = selectors.DefaultSelector()
+    attempts = []
+    connected = None
+    error = None
+    try:
+        next_attempt = time.time()
+        while connected is None and (addresses or attempts):
+            now = time.time()
+            if addresses and (not attempts or now >= next_attempt):
+                family, kind, protocol, _, address = addresses.pop(0)
+                sock = socket.socket(family, kind, protocol)
+                attempts.append(sock)
+                try:
+                    sock.setblocking(False)
+                    if source_address:
+                        sock.bind(source_address)
+                    result = sock.connect_ex(address)
+                except OSError as e:
+                    result = e.errno
+                if result == 0:
+                    connected = sock
+                    break
+                if result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                else:
+                    error = OSError(result, os.strerror(result))
+                    attempts.remove(sock)
+                    sock.close()
+                next_attempt = now + HAPPY_EYEBALLS_DELAY
+                continue
+            if deadline is not None and now >= deadline:
+                raise socket.timeout("timed out")
+            wait = next_attempt - now if addresses else None
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    connected = sock
+                    break
+                error = OSError(result, os.strerror(result))
+                attempts.remove(sock)
+                sock.close()
+                # the next address is tried at once
+                next_attempt = time.time()
+    finally:
+        selector.close()
+        for sock in attempts:
+            if sock is not connected:
+                sock.close()
+    if connected is None:
+        raise error if error is not None else OSError("No address found for %s" % host)
+    connected.settimeout(timeout)
+    return connected
+
+
+class Connection(HTTPConnection):
+    """HTTPConnection using the addresses given by resolve."""
 
     def connect(self):
-        """Overrides HTTPSConnection.connect to specify TLS version"""
-        # Standard implementation from HTTPSConnection, which is not
-        # designed for extension, unfortunately
-        sock = socket.create_connection((self.host, self.port),
-                                        self.timeout, self.source_address)
+        self.sock = create_connection(self.host, self.port, self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if getattr(self, '_tunnel_host', None):
-            self.sock = sock
             self._tunnel()
 
-        # This is the only difference; default wrap_socket uses SSLv23
-        self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
-                                    ssl_version=ssl.PROTOCOL_TLSv1)
 
+def configure_tls(ca_bundle=None, ciphers=None):
+    """Sets the certificate authorities and the ciphers of the TLS context
+    shared by all the connections of the process (see get_ssl_context).
+    Changing them drops the sessions kept for resumption.
+
+    ca_bundle: the file (PEM) of the certificate authorities trusted, the
+               ones of the system if None
+    ciphers: the allowed ciphers (OpenSSL cipher list format) for TLS 1.2,
+             the OpenSSL defaults if None"""
+    global _ssl_context
+    with _tls_lock:
+        if _tls_config == [ca_bundle, ciphers]:
+            return
+        _tls_config[:] = [ca_bundle, ciphers]
+        _ssl_context = None
+        _tls_sessions.clear()
+
+
+def get_ssl_context():
+    """Returns the TLS context shared by all the connections of the process:
+    TLS 1.2 or later, certificates checked (see configure_tls)."""
+    global _ssl_context
+    with _tls_lock:
+        if _ssl_context is None:
+            ca_bundle, ciphers = _tls_config
+            context = ssl.create_default_context(cafile=ca_bundle)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            if ciphers:
+                context.set_ciphers(ciphers)
+            _ssl_context = context
+        return _ssl_context
+
+
+def clear_tls_sessions():
+    """Drops the TLS sessions kept for resumption."""
+    with _tls_lock:
+        _tls_sessions.clear()
+
+
+def _save_session(key, sock):
+    session = getattr(sock, 'session', None)
+    if session is not None:
+        with _tls_lock:
+            _tls_sessions[key] = session
+
+
+class TLSConnection(Connection, HTTPSConnection):
+    """HTTPSConnection using the shared TLS context (see get_ssl_context) and
+    resuming the TLS session of the previous connection to the same server,
+    which saves a round trip and the key exchange of a full handshake."""
 
-class TLS1Handler(HTTPSHandler):
-    """Like HTTPSHandler but more specific"""
+    def __init__(self, host, **kwargs):
+        kwargs['context'] = get_ssl_context()
+        HTTPSConnection.__init__(self, host, **kwargs)
 
-    def __init__(self):
-        HTTPSHandler.__init__(self)
+    def connect(self):
+        Connection.connect(self)
+        server_hostname = getattr(self, '_tunnel_host', None) or self.host
+        self._session_key = (server_hostname, self.port)
+        with _tls_lock:
+            session = _tls_sessions.get(self._session_key)
+        start = time.time()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+        metrics = utils_metrics.get_metrics()
+        metrics.observe('tls.handshake', time.time() - start)
+        metrics.count('tls.handshakes.resumed' if self.sock.session_reused else 'tls.handshakes.full')
+        _save_session(self._session_key, self.sock)
+
+    def getresponse(self):
+        response = HTTPSConnection.getresponse(self)
+        # TLS 1.3 session tickets are sent by the server after the handshake
+        if self.sock is not None:
+            _save_session(self._session_key, self.sock)
+        return response
 
-    def https_open(self, req):
-        return self.do_open(TLS1Connection, req)
 
+class TLSHandler(HTTPSHandler):
+    """HTTPSHandler opening TLSConnection connections, or the connections
+    opened in advance (see warm)."""
 
-# Overide default handler
-install_opener(build_opener(TLS1Handler()))
+    def https_open(self, req):
+        return self.do_open(_pooled('https', TLSConnection), req)
+
+
+class PooledHTTPHandler(HTTPHandler):
+    """HTTPHandler using the connections opened in advance (see warm)."""
+
+    def http_open(self, req):
+        return self.do_open(_pooled('http', Connection), req)
+
+
+class ConnectionPool(object):
+    """Connections opened in advance to the servers a request is about to
+    talk to (see warm), so that its first exchanges do not wait for the
+    name resolution and the handshakes. Each connection serves one request,
+    urllib closing the connections after their response.
+
+    max_age: the time (seconds) after which an unused connection is dropped"""
+
+    def __init__(self, max_age=WARM_MAX_AGE):
+        self.max_age = max_age
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def put(self, scheme, connection):
+        with self._lock:
+            self._connections.setdefault((scheme, connection.host, connection.port), []).append(
+                (time.time(), connection))
+
+    def get(self, scheme, host, port):
+        """Returns a connection opened to the given server, None if none is
+        available."""
+        stale = []
+        found = None
+        with self._lock:
+            connections = self._connections.get((scheme, host, port), [])
+            while connections and found is None:
+                opened, connection = connections.pop(0)
+                if time.time() - opened < self.max_age:
+                    found = connection
+                else:
+                    stale.append(connection)
+        for connection in stale:
+            connection.close()
+        return found
+
+    def clear(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for entries in connections.values():
+            for _, connection in entries:
+                connection.close()
+
+
+_pool = ConnectionPool()
+
+
+def get_pool():
+    """Returns the pool of the connections opened in advance by the process."""
+    return _pool
+
+
+def _pooled(scheme, connection_class):
+    """Returns the connection factory of a handler, taking the connections
+    opened in advance when there are some."""
+
+    def factory(host, **kwargs):
+        connection = connection_class(host, **kwargs)
+        warm = _pool.get(scheme, connection.host, connection.port)
+        if warm is None:
+            utils_metrics.get_metrics().count('http.connections.cold')
+            return connection
+        utils_metrics.get_metrics().count('http.connections.warm')
+        if kwargs.get('timeout', socket._GLOBAL_DEFAULT_TIMEOUT) is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            warm.timeout = kwargs['timeout']
+            warm.sock.settimeout(warm.timeout)
+        return warm
+
+    return factory
+
+
+def warm(url):
+    """Opens a connection to the server of the given url (name resolution,
+    TCP and TLS handshakes) and keeps it in the pool for the next request
+    to that server."""
+    parsed = urlparse(url)
+    connection_class = TLSConnection if parsed.scheme == 'https' else Connection
+    connection = connection_class(parsed.netloc)
+    start = time.time()
+    connection.connect()
+    utils_metrics.get_metrics().observe('http.connect', time.time() - start)
+    _pool.put(parsed.scheme, connection)
 
 
 class HTTPErrorProcessor(HTTPErrorProcessor):
@@ -97,12 +412,129 @@ class NoRedirection(HTTPErrorProcessor):
 
 class SmartRedirectHandler(HTTPRedirectHandler):
     def http_error_302(self, req, fp, code, msg, headers):
+        # the query of the urls (tickets...) is not traced
+        utils_trace.instant('redirect', status=code, source=req.get_full_url().partition('?')[0],
+                            target=(headers.get('Location') or '').partition('?')[0])
         result = HTTPRedirectHandler.http_error_302(
             self, req, fp, code, msg, headers)
         result.status = code
         return result
 
 
+class DecodedResponse(object):
+    """Wraps a response whose body is compressed (gzip or deflate) and
+    decompresses it on the fly while it is read.
+
+    The Content-Encoding and Content-Length headers are removed since they
+    describe the compressed body."""
+
+    def __init__(self, response, block_size=65536):
+        self._response = response
+        self._block_size = block_size
+        # accepts both gzip and zlib headers
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        self._first = True
+        self._buffer = bytearray()
+        self._eof = False
+        del response.headers['Content-Encoding']
+        del response.headers['Content-Length']
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._response.read(self._block_size)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+            elif self._first:
+                self._first = False
+                try:
+                    self._buffer += self._decompressor.decompress(chunk)
+                except zlib.error:
+                    # some servers send raw deflate streams, without header
+                    self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    self._buffer += self._decompressor.decompress(chunk)
+            else:
+                self._buffer += self._decompressor.decompress(chunk)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        while True:
+            end = self._buffer.find(b"\n")
+            if end >= 0 or self._eof:
+                break
+            self._fill(len(self._buffer) + self._block_size)
+        return self.read(end + 1 if end >= 0 else -1)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class HTTPCompressionProcessor(BaseHandler):
+    """Asks for compressed responses (gzip, deflate) if accept is set, and
+    decodes compressed responses transparently."""
+
+    ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, accept=True):
+        self.accept = accept
+
+    def http_request(self, request):
+        if self.accept and not request.has_header('Accept-encoding'):
+            request.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        return request
+
+    def http_response(self, request, response):
+        encoding = response.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in self.ENCODINGS:
+            return DecodedResponse(response)
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+class Session(object):
+    """State shared between the requests of several jobs talking to the same
+    servers.
+
+    The session keeps the CAS Ticket Granting Tickets obtained for each
+    (CAS server, user) couple so that only the first job of a batch pays the
+    login round trip; the following ones only ask for a service ticket.
+    Cookies are deliberately not shared: Motu would then consider the
+    requests as already authenticated and skip the CAS redirection."""
+
+    def __init__(self):
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def get_ticket(self, cas_url, user):
+        with self._lock:
+            return self._tickets.get((cas_url, user))
+
+    def set_ticket(self, cas_url, user, tgt):
+        with self._lock:
+            if tgt is None:
+                self._tickets.pop((cas_url, user), None)
+            else:
+                self._tickets[(cas_url, user)] = tgt
+
+
 def open_url(url, **kwargs):
     """open an url and return an handler on it.
        arguments can be :
@@ -122,15 +554,24 @@ def open_url(url, **kwargs):
             authentication = { "mode": "basic",
                                "user": "username",
                                "password": "password" }
+
+         session: a Session instance shared between several requests
+
+         compressed: whether a compressed response is asked for. Only the
+            XML replies gain from it: a compressed NetCDF file has no length
+            (no preallocation nor truncation check) and cannot be resumed
     """
     data = None
     log = logging.getLogger("utils_http:open_url")
     kargs = kwargs.copy()
+    kargs.pop('session', None)
+    compressed = kargs.pop('compressed', False)
     # common handlers
     handlers = [SmartRedirectHandler(),
                 HTTPCookieProcessor(CookieJar()),
-                HTTPHandler(),
-                TLS1Handler(),
+                PooledHTTPHandler(),
+                TLSHandler(),
+                HTTPCompressionProcessor(compressed),
                 HTTPDebugProcessor(log),
                 HTTPErrorProcessor()
                 ]
@@ -151,11 +592,11 @@ def open_url(url, **kwargs):
     if 'authentication' in kargs.keys():
         raise NotImplementedError()
         # create the password manager
-        password_mgr = HTTPPasswordMgrWithDefaultRealm(ssl_version=ssl.PROTOCOL_TLSv1)
+        password_mgr = HTTPPasswordMgrWithDefaultRealm()
         urlPart = url.partition('?')
         password_mgr.add_password(None, urlPart, kargs['authentication']['user'], kargs['authentication']['password'])
         # add the basic authentication handler
-        handlers.append(TLS1Handler(password_mgr))
+        handlers.append(HTTPBasicAuthHandler(password_mgr))
         del kargs['authentication']
 
     if 'data' in kargs.keys():
@@ -163,9 +604,10 @@ def open_url(url, **kwargs):
         del kargs['data']
 
     _opener = build_opener(*handlers)
-    log.log(TRACE_LEVEL, 'list of handlers:')
-    for h in _opener.handlers:
-        log.log(TRACE_LEVEL, ' . %s', str(h))
+    if log.isEnabledFor(TRACE_LEVEL):
+        log.log(TRACE_LEVEL, 'list of handlers:')
+        for h in _opener.handlers:
+            log.log(TRACE_LEVEL, ' . %s', str(h))
 
     # create the request
     if data is not None:
@@ -174,7 +616,11 @@ def open_url(url, **kwargs):
         r = Request(url, **kargs)
 
     # open the url, but let the exception propagates to the caller  
-    return _opener.open(r)
+    start = time.time()
+    response = _opener.open(r)
+    # time to first byte: until the headers of the (last) response are received
+    utils_metrics.get_metrics().observe('http.ttfb', time.time() - start)
+    return response
 
 
 def encode(options):
@@ -183,3 +629,18 @@ def encode(options):
         for v in vset:
             opts.append('%s=%s' % (str(k), str(v).replace('#', '%23').replace(' ', '%20')))
     return '&'.join(opts)
+
+
+def interrupt(response):
+    """Shuts the connection of a response down, so that a thread blocked
+    reading it returns at once (used to cancel downloads)."""
+    target = response
+    # through DecodedResponse, HTTPResponse, its buffered reader and socket io
+    for name in ('_response', 'fp', 'raw', '_sock'):
+        target = getattr(target, name, target)
+    if isinstance(target, socket.socket):
+        try:
+            target.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # already closed
+            pass
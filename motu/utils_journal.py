@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# job statuses
+SUBMITTED = 'submitted'
+READY = 'ready'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# statuses of the jobs a restarted client can reattach to
+PENDING = (SUBMITTED, READY, DOWNLOADING)
+
+# columns of the jobs table, besides the key
+FIELDS = ('request', 'target', 'request_id', 'status_url', 'status', 'remote_uri',
+          'bytes', 'size', 'message', 'created', 'updated')
+
+# opened journals: path -> Journal
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+class Journal(object):
+    """Persistent record of the jobs submitted to Motu, stored in a SQLite
+    database so that it survives the client process and can be shared by
+    several processes.
+
+    Each job is identified by the canonical key of its request (see
+    motu_api.request_key) and records the Motu request id, the status url
+    to poll, the status, the remote uri of the result and the download
+    progress."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                                     "key TEXT PRIMARY KEY, request TEXT, target TEXT, request_id TEXT, "
+                                     "status_url TEXT, status TEXT, remote_uri TEXT, bytes INTEGER, "
+                                     "size INTEGER, message TEXT, created REAL, updated REAL)")
+
+    def get(self, key):
+        """Returns the job of the given key as a dictionary, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+        return _to_job(row)
+
+    def jobs(self, statuses=None):
+        """Returns the jobs, optionally restricted to the given statuses,
+        oldest first."""
+        query = "SELECT * FROM jobs"
+        args = ()
+        if statuses:
+            query += " WHERE status IN (%s)" % ','.join('?' * len(statuses))
+            args = tuple(statuses)
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY created", args).fetchall()
+        return [_to_job(row) for row in rows]
+
+    def record(self, key, **fields):
+        """Creates or updates the job of the given key with the given fields
+        (see FIELDS). The request can be given as any JSON serializable
+        value."""
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError("Unknown journal fields: %s" % ', '.join(sorted(unknown)))
+        if 'request' in fields and not isinstance(fields['request'], str):
+            fields['request'] = json.dumps(fields['request'])
+        now = time.time()
+        fields['updated'] = now
+        names = sorted(fields)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("INSERT OR IGNORE INTO jobs (key, created) VALUES (?, ?)", (key, now))
+            self._connection.execute("UPDATE jobs SET %s WHERE key = ?" % ', '.join('%s = ?' % n for n in names),
+                                     tuple(fields[n] for n in names) + (key,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    if job.get('request'):
+        try:
+            job['request'] = json.loads(job['request'])
+        except ValueError:
+            pass
+    return job
+
+
+def get_journal(path):
+    """Returns the journal stored in the given file, shared by all the threads
+    of the process, or None if path is not set."""
+    if not path:
+        return None
+    with _journals_lock:
+        if path not in _journals:
+            logging.getLogger("utils_journal").debug("Opening journal %s", path)
+            _journals[path] = Journal(path)
+        return _journals[path]
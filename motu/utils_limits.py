@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import logging
+import sqlite3
+import threading
+import time
+
+# time (seconds) after which a learned limit is no longer trusted, servers
+# being reconfigured from time to time
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+# fraction of the limit the parts of a pre-split request are sized for, the
+# estimates being approximate
+SAFETY_MARGIN = 0.9
+
+# the size of a request estimated offline is checked with a getSize request
+# before submitting it when it is between this fraction of the limit and the
+# limit divided by it, the offline estimates being rough
+CHECK_THRESHOLD = 0.5
+
+# path of the limits kept in memory only
+MEMORY = ':memory:'
+
+# opened limits: path -> SizeLimits
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+class SizeLimits(object):
+    """The maximum result sizes accepted by the services of Motu servers,
+    learned from their 004-7 errors and stored in a SQLite database with the
+    time they were learned."""
+
+    def __init__(self, path=MEMORY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            if path != MEMORY:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS size_limits ("
+                                     "server TEXT, service TEXT, allowed REAL, learned REAL, "
+                                     "PRIMARY KEY (server, service))")
+
+    def record(self, server, service_id, allowed):
+        """Records the maximum size (bytes) of the results of a service."""
+        logging.getLogger("utils_limits").info("Service %s of %s limited to %i bytes", service_id, server, allowed)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO size_limits VALUES (?, ?, ?, ?)",
+                                     (server, service_id, allowed, time.time()))
+
+    def allowed(self, server, service_id, max_age=DEFAULT_MAX_AGE):
+        """Returns the maximum size (bytes) of the results of a service,
+        None if unknown or learned more than max_age seconds ago."""
+        with self._lock:
+            row = self._connection.execute("SELECT allowed, learned FROM size_limits WHERE server = ? AND "
+                                           "service = ?", (server, service_id)).fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_limits(path=None):
+    """Returns the limits stored in the given file, shared by all the threads
+    of the process, or kept in memory by the process if path is not set."""
+    path = path or MEMORY
+    with _limits_lock:
+        if path not in _limits:
+            _limits[path] = SizeLimits(path)
+        return _limits[path]
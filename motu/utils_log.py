@@ -27,12 +27,24 @@
 #  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
 import urllib.parse as parse
-from urllib.request import BaseHandler
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import threading
 
 # trace level
 TRACE_LEVEL = 1
 
+# logger of the structured events (see event)
+EVENTS_LOGGER = 'motu_events'
+
+# the thread writing the events, and the file it writes into
+_events_listener = None
+_events_path = None
+_events_lock = threading.Lock()
+
 
 def log_url(log, message, url, level=logging.DEBUG):
     """Nicely logs the given url.
@@ -44,6 +56,8 @@ def log_url(log, message, url, level=logging.DEBUG):
     message: a message to print before the url
     url: the url to log
     level: (optional) the log level to use"""
+    if not log.isEnabledFor(level):
+        return
     if isinstance(url, bytes):
         url = url.decode("utf-8")
     urls = url.split('?')
@@ -56,31 +70,77 @@ def log_url(log, message, url, level=logging.DEBUG):
             log.log(level, ' . %s = %s', parse.unquote(param[0]), parse.unquote(param[1]))
 
 
-class HTTPDebugProcessor(BaseHandler):
-    """ Track HTTP requests and responses with this custom handler.
-    """
+class JSONLinesFormatter(logging.Formatter):
+    """Formats the events (see event) as JSON objects, one per line."""
+
+    def format(self, record):
+        fields = {'time': record.created, 'phase': record.msg}
+        fields.update(getattr(record, 'fields', {}))
+        return json.dumps(fields, default=str)
+
+
+def configure_events(path):
+    """Writes the structured events (see event) as JSON lines into the given
+    file, from a background thread so that the jobs do not wait for the
+    disk. Does nothing if path is not set or is already the event log."""
+    global _events_listener, _events_path
+    if not path:
+        return
+    with _events_lock:
+        if path == _events_path:
+            return
+        if _events_listener is not None:
+            _close_events()
+        else:
+            atexit.register(_stop_events)
+        handler = logging.FileHandler(path, encoding='utf-8')
+        handler.setFormatter(JSONLinesFormatter())
+        records = queue.SimpleQueue()
+        logger = logging.getLogger(EVENTS_LOGGER)
+        logger.handlers = [logging.handlers.QueueHandler(records)]
+        logger.propagate = False
+        logger.disabled = False
+        logger.setLevel(logging.INFO)
+        _events_listener = logging.handlers.QueueListener(records, handler)
+        _events_listener.start()
+        _events_path = path
+
+
+def _stop_events():
+    global _events_listener, _events_path
+    with _events_lock:
+        if _events_listener is not None:
+            _close_events()
+            _events_listener = None
+            _events_path = None
+
 
-    def __init__(self, log, log_level=TRACE_LEVEL):
-        self.log_level = log_level
-        self.log = log
+def _close_events():
+    # writes the events still queued, then closes the file
+    _events_listener.stop()
+    for handler in _events_listener.handlers:
+        handler.close()
 
-    def http_request(self, request):
-        host, full_url = request.host, request.get_full_url()
-        url_path = full_url[full_url.find(host) + len(host):]
-        log_url(self.log, "Requesting: ", full_url, TRACE_LEVEL)
-        self.log.log(self.log_level, "%s %s" % (request.get_method(), url_path))
 
-        for header in request.header_items():
-            self.log.log(self.log_level, " . %s: %s" % header[:])
+def events_enabled():
+    """Returns whether the structured events are written (see
+    configure_events)."""
+    return _events_path is not None
 
-        return request
 
-    def http_response(self, request, response):
-        code, msg, hdrs = response.code, response.msg, response.headers
-        self.log.log(self.log_level, "Response:")
-        self.log.log(self.log_level, " HTTP/1.x %s %s" % (code, msg))
+def event(phase, **fields):
+    """Logs a structured event of a job: its phase (auth, submit, poll,
+    download...) and fields such as the job id, the bytes transferred and
+    the latency (seconds). Does nothing unless the event log is configured
+    (see configure_events)."""
+    if _events_path is None:
+        return
+    logging.getLogger(EVENTS_LOGGER).info(phase, extra={'fields': fields})
 
-        for headers in hdrs.items():
-            self.log.log(self.log_level, " . %s : %s" % headers)
 
-        return response
+def __getattr__(name):
+    # HTTPDebugProcessor is defined by utils_http, as urllib.request is long to import
+    if name == 'HTTPDebugProcessor':
+        from .utils_http import HTTPDebugProcessor
+        return HTTPDebugProcessor
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
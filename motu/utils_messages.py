@@ -39,7 +39,7 @@ def get_external_messages():
     The table is lazzy instancied (loaded once when called the first time)."""
     global _messages
     if _messages is None:
-        with open(os.path.join(os.path.dirname(__file__), MESSAGES_FILE), "rU") as propFile:
+        with open(os.path.join(os.path.dirname(__file__), MESSAGES_FILE), "r") as propFile:
             prop_dict = dict()
             for propLine in propFile:
                 prop_def = propLine.strip()
@@ -0,0 +1,374 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import calendar
+import copy
+import datetime
+import logging
+import math
+import os
+import re
+import threading
+import time
+from xml.dom import minidom
+
+# default time (seconds) a cached describeProduct result is used before being
+# requested again
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# date formats of the describeProduct results and of the options
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%MZ', '%Y-%m-%d')
+
+# distance (in steps) under which a bound is considered on a grid point,
+# differences below being float noise
+SNAP_TOLERANCE = 1e-3
+
+# decimals kept in the snapped longitudes, latitudes and depths
+SNAP_DECIMALS = 6
+
+# distance (seconds) under which a time bound is considered on a grid time
+TIME_TOLERANCE = 1
+
+# grids already read by the process: (motu, service, product) -> (time, grid)
+_grids = {}
+_grids_lock = threading.Lock()
+
+# ISO 8601 durations (without years and months, which have no fixed length)
+DURATION_PATTERN = re.compile(r'^P(?:(\d+(?:\.\d+)?)W)?(?:(\d+(?:\.\d+)?)D)?'
+                              r'(?:T(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?(?:(\d+(?:\.\d+)?)S)?)?$')
+
+
+class Axis(object):
+    """A regular axis of a product grid: its bounds and its step (None if
+    not published by the server)."""
+
+    def __init__(self, lower, upper, step=None):
+        self.lower = lower
+        self.upper = upper
+        self.step = step
+
+    def __repr__(self):
+        return 'Axis(%r, %r, %r)' % (self.lower, self.upper, self.step)
+
+
+class ProductGrid(object):
+    """The grid of a product, as described by the describeProduct result of
+    Motu.
+
+    lon, lat: the Axis of the longitudes and latitudes (None if unknown)
+    depths: the sorted list of the depths (empty if the product has none)
+    times: the list of the (start, end, step) time ranges, in seconds since
+           the epoch, a step of 0 being a single time
+    variables: the list of the variable names
+    standard_names: the CF standard names of the variables, by name"""
+
+    def __init__(self, service_id, product_id, lon=None, lat=None, depths=(), times=(), variables=(),
+                 standard_names=None):
+        self.service_id = service_id
+        self.product_id = product_id
+        self.lon = lon
+        self.lat = lat
+        self.depths = sorted(depths)
+        self.times = list(times)
+        self.variables = list(variables)
+        self.standard_names = dict(standard_names or {})
+
+    @property
+    def time_range(self):
+        """The (first, last) times of the product, None if unknown."""
+        if not self.times:
+            return None
+        return min(t[0] for t in self.times), max(t[1] for t in self.times)
+
+
+def parse_date(value):
+    """Returns the given date (string, datetime or date, UTC) in seconds
+    since the epoch."""
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple())
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, date_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("Unknown date format: '%s'" % value)
+
+
+def parse_duration(value):
+    """Returns the given ISO 8601 duration (string) in seconds."""
+    match = DURATION_PATTERN.match(value.strip())
+    if match is None or not any(match.groups()):
+        raise ValueError("Unsupported duration: '%s'" % value)
+    weeks, days, hours, minutes, seconds = (float(g) if g else 0. for g in match.groups())
+    return (((weeks * 7 + days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_times(value):
+    """Parses the availableTimes of a product: a comma separated list of
+    times and START/END/PERIOD ranges.
+
+    returns a list of (start, end, step) tuples, in seconds"""
+    times = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split('/')
+        if len(parts) == 3:
+            times.append((parse_date(parts[0]), parse_date(parts[1]), parse_duration(parts[2])))
+        elif len(parts) == 1:
+            t = parse_date(parts[0])
+            times.append((t, t, 0))
+        else:
+            raise ValueError("Unsupported time range: '%s'" % item)
+    return times
+
+
+def parse_describe(reply, service_id=None, product_id=None):
+    """Builds the ProductGrid of a describeProduct result (XML string or
+    bytes).
+
+    Axes steps are read from their 'step' or 'resolution' attribute when the
+    server publishes them."""
+    dom = minidom.parseString(reply)
+    root = dom.documentElement
+    product_id = product_id or root.getAttribute('id') or None
+
+    def axis(node):
+        def number(name):
+            value = node.getAttribute(name)
+            return float(value) if value not in (None, '') else None
+        step = number('step')
+        if step is None:
+            step = number('resolution')
+        return Axis(number('lower'), number('upper'), abs(step) if step else None)
+
+    lon = lat = None
+    for node in dom.getElementsByTagName('axis'):
+        axis_type = node.getAttribute('axisType').lower()
+        if axis_type in ('lon', 'geox') and lon is None:
+            lon = axis(node)
+        elif axis_type in ('lat', 'geoy') and lat is None:
+            lat = axis(node)
+
+    depths = []
+    for node in dom.getElementsByTagName('availableDepths'):
+        text = ''.join(child.data for child in node.childNodes if child.nodeType == child.TEXT_NODE)
+        depths += [float(d) for d in re.split(r'[;,\s]+', text) if d and d.lower() != 'surface']
+
+    times = []
+    for node in dom.getElementsByTagName('availableTimes'):
+        text = ''.join(child.data for child in node.childNodes if child.nodeType == child.TEXT_NODE)
+        times += parse_times(text)
+    if not times:
+        for node in dom.getElementsByTagName('timeCoverage'):
+            if node.getAttribute('start') and node.getAttribute('end'):
+                times.append((parse_date(node.getAttribute('start')), parse_date(node.getAttribute('end')), None))
+
+    variables = []
+    standard_names = {}
+    for node in dom.getElementsByTagName('variable'):
+        name = node.getAttribute('name')
+        if name:
+            variables.append(name)
+            if node.getAttribute('standardName'):
+                standard_names[name] = node.getAttribute('standardName')
+
+    return ProductGrid(service_id, product_id, lon, lat, depths, times, variables, standard_names)
+
+
+def format_date(seconds):
+    """Returns the canonical string of a date (seconds since the epoch):
+    the day alone at midnight, the day and the time otherwise."""
+    date = datetime.datetime.utcfromtimestamp(seconds)
+    if date.time() == datetime.time():
+        return date.strftime('%Y-%m-%d')
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def snap_to_axis(value, origin, step, upward):
+    """Returns the point of the regular axis (origin + k * step) selected
+    first by a bound: the first point above the value for a lower bound
+    (upward), the last one below for an upper bound. A value within
+    SNAP_TOLERANCE steps of a point is that point."""
+    position = (value - origin) / step
+    nearest = round(position)
+    if abs(position - nearest) <= SNAP_TOLERANCE:
+        k = nearest
+    else:
+        k = math.ceil(position) if upward else math.floor(position)
+    return round(origin + k * step, SNAP_DECIMALS)
+
+
+def snap_to_values(value, values, upward, tolerance):
+    """Returns the first of the sorted values above the bound (upward), or
+    the last one below, None if there is none."""
+    if upward:
+        return next((v for v in values if v >= value - tolerance), None)
+    return next((v for v in reversed(values) if v <= value + tolerance), None)
+
+
+def snap_to_times(value, times, upward):
+    """Returns the first time of the (start, end, step) ranges above the
+    bound (upward), or the last one below, None if there is none."""
+    candidates = []
+    for start, end, step in times:
+        if upward:
+            if value <= start + TIME_TOLERANCE:
+                candidates.append(start)
+            elif value <= end + TIME_TOLERANCE and step:
+                candidates.append(min(end, start + math.ceil((value - start - TIME_TOLERANCE) / step) * step))
+        else:
+            if value >= end - TIME_TOLERANCE:
+                candidates.append(end)
+            elif value >= start - TIME_TOLERANCE and step:
+                candidates.append(max(start, start + math.floor((value - start + TIME_TOLERANCE) / step) * step))
+    if not candidates:
+        return None
+    return min(candidates) if upward else max(candidates)
+
+
+def snap_request(_options, grid):
+    """Normalizes the bounds of the (checked) request on the grid of its
+    product, so that requests selecting the same cells are identical: the
+    bounds of the box, the depths and the period are moved onto the first
+    and last grid points they select, reversed bounds are put back in order,
+    dates are formatted the same way (see format_date) and variables are
+    sorted.
+
+    Bounds are left as is on the axes whose grid is unknown (no step
+    published), and when they select no grid point at all."""
+
+    def snap_pair(lower, upper, snap, convert=float):
+        if lower is None or upper is None:
+            return lower, upper
+        lower, upper = convert(lower), convert(upper)
+        snapped = snap(lower, True), snap(upper, False)
+        if None in snapped or snapped[0] > snapped[1]:
+            return lower, upper
+        return snapped
+
+    def sorted_pair(lower, upper, convert=float):
+        if lower is not None and upper is not None and convert(lower) > convert(upper):
+            return upper, lower
+        return lower, upper
+
+    if _options.extraction_geographic:
+        _options.latitude_min, _options.latitude_max = sorted_pair(_options.latitude_min, _options.latitude_max)
+        for axis, names in ((grid.lon, ('longitude_min', 'longitude_max')),
+                            (grid.lat, ('latitude_min', 'latitude_max'))):
+            lower, upper = float(getattr(_options, names[0])), float(getattr(_options, names[1]))
+            # longitudes can cross the antimeridian
+            if axis is not None and axis.step and axis.lower is not None and lower <= upper:
+                lower, upper = snap_pair(lower, upper, lambda v, up: snap_to_axis(v, axis.lower, axis.step, up))
+            setattr(_options, names[0], lower)
+            setattr(_options, names[1], upper)
+
+    if _options.extraction_vertical:
+        depth_min, depth_max = sorted_pair(_options.depth_min, _options.depth_max)
+        if grid.depths:
+            depth_min, depth_max = snap_pair(depth_min, depth_max, lambda v, up: snap_to_values(
+                v, grid.depths, up, 10 ** -SNAP_DECIMALS))
+        _options.depth_min, _options.depth_max = depth_min, depth_max
+
+    if _options.extraction_temporal:
+        def seconds(value):
+            return parse_date(value) if value is not None else None
+
+        date_min, date_max = sorted_pair(seconds(_options.date_min), seconds(_options.date_max))
+        if grid.times and None not in (date_min, date_max):
+            date_min, date_max = snap_pair(date_min, date_max, lambda v, up: snap_to_times(v, grid.times, up))
+        _options.date_min = format_date(date_min) if date_min is not None else None
+        _options.date_max = format_date(date_max) if date_max is not None else None
+
+    if _options.variable:
+        _options.variable = sorted(set(_options.variable))
+
+
+def describe_product(_options):
+    """Asks Motu the describeProduct result of the product of a request.
+
+    returns the XML result, as bytes"""
+    from . import motu_api
+    _options = copy.copy(_options)
+    _options.describe = True
+    _options.size = False
+    reply = motu_api.read_request(_options, as_dataset=False)
+    if isinstance(reply, str):
+        try:
+            with open(reply, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(reply)
+    return bytes(reply)
+
+
+def cache_path(cache_dir, service_id, product_id):
+    """Returns the path of the cached describeProduct result of a product."""
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', '%s__%s' % (service_id, product_id))
+    return os.path.join(cache_dir, name + '.xml')
+
+
+def get_product_grid(_options, cache_dir=None, max_age=DEFAULT_MAX_AGE, offline=False):
+    """Returns the ProductGrid of the product of a request.
+
+    The describeProduct result is read from cache_dir when it holds a result
+    younger than max_age seconds, and requested to Motu otherwise (and kept in
+    cache_dir if set). The grid is then kept by the process for max_age
+    seconds.
+
+    offline: return None instead of requesting the description to Motu"""
+    log = logging.getLogger("utils_metadata")
+    key = (_options.motu, _options.service_id, _options.product_id)
+    with _grids_lock:
+        known = _grids.get(key)
+    if known is not None and time.time() - known[0] < max_age:
+        return known[1]
+    path = cache_path(cache_dir, _options.service_id, _options.product_id) if cache_dir else None
+    if path is not None and os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        with open(path, 'rb') as f:
+            reply = f.read()
+    elif offline:
+        return None
+    else:
+        log.info("Requesting the description of %s", _options.product_id)
+        reply = describe_product(_options)
+        if path is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            temp_path = '%s.%i.part' % (path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(reply)
+            os.replace(temp_path, path)
+    grid = parse_describe(reply, _options.service_id, _options.product_id)
+    with _grids_lock:
+        _grids[key] = (time.time(), grid)
+    return grid
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import threading
+
+
+class Metrics(object):
+    """Counters and timings of the process, shared by all its threads."""
+
+    def __init__(self):
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        """Adds n to the counter of the given name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        """Adds a sample (seconds) to the timing of the given name."""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = {'count': 1, 'total': value, 'min': value, 'max': value}
+            else:
+                timing['count'] += 1
+                timing['total'] += value
+                timing['min'] = min(timing['min'], value)
+                timing['max'] = max(timing['max'], value)
+
+    def stats(self):
+        """Returns the counters and the timings (count, total, mean, min and
+        max of their samples), as a dictionary."""
+        with self._lock:
+            timings = dict((name, dict(timing, mean=timing['total'] / timing['count']))
+                           for name, timing in self._timings.items())
+            return {'counters': dict(self._counters), 'timings': timings}
+
+    def clear(self):
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Returns the metrics of the whole process."""
+    return _metrics
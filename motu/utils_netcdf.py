@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import logging
+import os
+import threading
+
+# default deflate level of the transcoded files (1: fastest, 9: smallest)
+DEFAULT_COMPRESSION_LEVEL = 4
+
+# magic numbers of the NetCDF3 classic and 64-bit offset formats
+NETCDF3_MAGICS = (b'CDF\x01', b'CDF\x02')
+
+# kinds (numpy) of the variables compressed and chunked: integers and floats
+NUMERIC_KINDS = 'iuf'
+
+_pool = None
+_futures = []
+_lock = threading.Lock()
+
+
+def is_netcdf3(path):
+    """Returns whether the given file is a NetCDF3 (classic or 64-bit offset) file."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) in NETCDF3_MAGICS
+    except (IOError, OSError):
+        return False
+
+
+def transcode(path, level=DEFAULT_COMPRESSION_LEVEL):
+    """Rewrites the given NetCDF3 file as a compressed and chunked NetCDF4 file.
+
+    Numeric variables are chunked by time step (one step per chunk, full
+    extent on the other dimensions), which suits the usual map by map access.
+    Unlimited dimensions are chunked by one step too. Variables of strings or
+    characters, and variables with an empty fixed dimension, are left
+    uncompressed. The file is replaced atomically once the new one is
+    complete.
+
+    Requires xarray and netCDF4.
+
+    path: the NetCDF3 file
+    level: the deflate level (1 to 9)"""
+    import xarray as xr
+
+    temp_path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                             '.%s.nc4.part' % os.path.basename(path))
+    try:
+        with xr.open_dataset(path) as ds:
+            unlimited = set(ds.encoding.get('unlimited_dims') or ())
+            encoding = {}
+            for name, variable in ds.variables.items():
+                if not variable.dims or variable.dtype.kind not in NUMERIC_KINDS:
+                    continue
+                if any(size == 0 and dim not in unlimited for dim, size in zip(variable.dims, variable.shape)):
+                    continue
+                encoding[name] = {'zlib': True,
+                                  'complevel': level,
+                                  'chunksizes': tuple(1 if dim == 'time' or dim in unlimited else size
+                                                      for dim, size in zip(variable.dims, variable.shape))}
+            ds.to_netcdf(temp_path, format='NETCDF4', encoding=encoding)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+
+def submit(path, level=DEFAULT_COMPRESSION_LEVEL):
+    """Transcodes the given file in a background process (see transcode), so
+    that the transcoding overlaps with the next downloads. Files which are not
+    NetCDF3 files are left as is. The processes being spawned, the main
+    module of a script transcoding files must be guarded by
+    if __name__ == '__main__'.
+
+    returns the future of the transcoding, or None if there is nothing to do"""
+    global _pool
+    log = logging.getLogger("utils_netcdf")
+    if not is_netcdf3(path):
+        return None
+    with _lock:
+        if _pool is None:
+            # imported here as it is rather long to import
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # the processes are spawned rather than forked from a process
+            # which may run many threads (fan-out, daemon)
+            _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        log.info("Transcoding %s to NetCDF4 in background", path)
+        future = _pool.submit(transcode, path, level)
+        _futures.append((path, future))
+    return future
+
+
+def wait_all(paths=None):
+    """Waits for all the background transcodings submitted so far, or only
+    for the ones of the given files.
+
+    Raises the first error met, once every transcoding is over."""
+    log = logging.getLogger("utils_netcdf")
+    with _lock:
+        futures = [future for path, future in _futures if paths is None or path in paths]
+        _futures[:] = [(path, future) for path, future in _futures if paths is not None and path not in paths]
+    error = None
+    for future in futures:
+        try:
+            log.info("Transcoded %s", future.result())
+        except Exception as e:
+            log.error("Transcoding failed: %s", e)
+            error = error or e
+    if error is not None:
+        raise error
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+# interval (seconds) between two status requests when nothing is known about
+# the processing time of the request
+DEFAULT_INTERVAL = 10
+
+# interval (seconds) between two status requests around the predicted ready
+# time
+DENSE_INTERVAL = 2
+
+# the first status request is sent at this fraction of the early ready time
+EARLY_MARGIN = 0.9
+
+# quantiles of the past durations framing the predicted ready time
+EARLY_QUANTILE = 0.2
+LATE_QUANTILE = 0.9
+
+# minimal number of past durations of a size bucket to predict from it, the
+# durations of all the sizes of the product being used otherwise
+MIN_SAMPLES = 3
+
+# number of durations kept per service, product and size bucket
+HISTORY_SIZE = 50
+
+# opened histories: path -> PollHistory
+_histories = {}
+_histories_lock = threading.Lock()
+
+
+def size_bucket(size):
+    """Returns the bucket of the given size (bytes): its base 2 logarithm, or
+    None if the size is unknown."""
+    if size is None or size <= 0:
+        return None
+    return int(math.log(size, 2))
+
+
+def quantile(values, q):
+    """Returns the q quantile of the given sorted values (linear
+    interpolation)."""
+    position = (len(values) - 1) * q
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class PollSchedule(object):
+    """The delays between the status requests of a submitted request,
+    predicted from the durations the server took to process similar requests:
+    no request until shortly before the early ready time, requests every
+    DENSE_INTERVAL seconds until the late ready time, then less and less
+    often, up to DEFAULT_INTERVAL seconds.
+
+    Without past durations, the status is requested every DEFAULT_INTERVAL
+    seconds."""
+
+    def __init__(self, durations=()):
+        durations = sorted(durations)
+        self.predicted = bool(durations)
+        if durations:
+            self.early = quantile(durations, EARLY_QUANTILE) * EARLY_MARGIN
+            self.late = quantile(durations, LATE_QUANTILE)
+        else:
+            self.early = self.late = 0
+
+    def first_delay(self, elapsed):
+        """Returns the delay before the first status request, elapsed seconds
+        after the submission."""
+        return max(0, self.early - elapsed) if self.predicted else 0
+
+    def next_delay(self, elapsed):
+        """Returns the delay before the next status request, elapsed seconds
+        after the submission."""
+        if not self.predicted:
+            return DEFAULT_INTERVAL
+        if elapsed < self.early:
+            return self.early - elapsed
+        if elapsed < self.late:
+            return DENSE_INTERVAL
+        # later than usual: back off progressively
+        return min(DEFAULT_INTERVAL, DENSE_INTERVAL + (elapsed - self.late) / 5.)
+
+
+class PollHistory(object):
+    """The durations taken by the server between the submission of requests
+    and the availability of their result, per service, product and size
+    bucket, stored in a SQLite database."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS poll_durations ("
+                                     "service TEXT, product TEXT, bucket INTEGER, duration REAL, recorded REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS poll_durations_product "
+                                     "ON poll_durations (service, product, bucket, recorded)")
+
+    def record(self, service_id, product_id, bucket, duration):
+        """Records the duration (seconds) of a request, keeping the latest
+        HISTORY_SIZE durations of its service, product and size bucket."""
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("INSERT INTO poll_durations VALUES (?, ?, ?, ?, ?)",
+                                     (service_id, product_id, bucket, duration, time.time()))
+            self._connection.execute("DELETE FROM poll_durations WHERE service = ? AND product = ? AND bucket IS ? "
+                                     "AND rowid NOT IN (SELECT rowid FROM poll_durations WHERE service = ? AND "
+                                     "product = ? AND bucket IS ? ORDER BY recorded DESC LIMIT ?)",
+                                     (service_id, product_id, bucket) * 2 + (HISTORY_SIZE,))
+
+    def durations(self, service_id, product_id, bucket=None, any_bucket=False):
+        """Returns the recorded durations of a service, product and size
+        bucket, or of all the buckets if any_bucket is set."""
+        query = "SELECT duration FROM poll_durations WHERE service = ? AND product = ?"
+        args = (service_id, product_id)
+        if not any_bucket:
+            query += " AND bucket IS ?"
+            args += (bucket,)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(query, args)]
+
+    def schedule(self, service_id, product_id, bucket=None):
+        """Returns the PollSchedule of a request, predicted from the durations
+        of its size bucket, or of the whole product if the bucket has too few
+        of them."""
+        durations = self.durations(service_id, product_id, bucket)
+        if len(durations) < MIN_SAMPLES:
+            durations = self.durations(service_id, product_id, any_bucket=True)
+        if len(durations) < MIN_SAMPLES:
+            durations = ()
+        logging.getLogger("utils_polling").debug("Polling %s from %i past durations", product_id, len(durations))
+        return PollSchedule(durations)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_history(path):
+    """Returns the history stored in the given file, shared by all the threads
+    of the process, or None if path is not set."""
+    if not path:
+        return None
+    with _histories_lock:
+        if path not in _histories:
+            _histories[path] = PollHistory(path)
+        return _histories[path]
@@ -26,8 +26,18 @@
 #  along with this library; if not, write to the Free Software Foundation,
 #  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
 
-def copy(source_handler, dest_handler, callback=None, block_size=65535):
+# default size above which an in-memory result is spilled to a temporary file
+DEFAULT_MEMORY_LIMIT = 64 * 2 ** 20
+
+
+def copy(source_handler, dest_handler, callback=None, block_size=65535, throttle=None, cancel=None, partial=False):
     """Copy the available content through the given handler to another one. Process
     can be monitored with the (optional) callback function.
     
@@ -35,17 +45,198 @@ def copy(source_handler, dest_handler, callback=None, block_size=65535):
     destHandler: the handler into which writing data        
     callback: the callback function called for each block read. Signature: f: sizeRead -> void
     blockSize: the size of the block used to read data
+    throttle: (optional) function called with the size of each block read before
+              writing it, which can wait to limit the bandwidth. Signature: f: size -> void
+    cancel: (optional) the utils_cancel.CancelToken checked after each block read
+    partial: whether the data available is written without waiting for a
+             whole block (when the source supports read1), so that the
+             progress of slow transfers is seen
     
     returns the total size read
     """
 
     read = 0
+    read_block = getattr(source_handler, 'read1', source_handler.read) if partial else source_handler.read
     while 1:
-        block = source_handler.read(block_size)
+        block = read_block(block_size)
+        if cancel is not None:
+            cancel.check()
         if block == b"":
             break
+        if throttle is not None:
+            throttle(len(block))
         read += len(block)
         dest_handler.write(block)
         callback(read)
 
     return read
+
+
+class StallWatchdog(object):
+    """Watches the speed of a transfer, like the --speed-limit and
+    --speed-time options of curl: the transfer is stalled when it receives
+    less than limit bytes per second during period seconds. on_stall is then
+    called, from the thread of the watchdog, to interrupt the transfer.
+
+    limit: the minimal speed (bytes per second)
+    period: the time (seconds) the speed is measured over
+    on_stall: the function (without argument) interrupting the transfer"""
+
+    def __init__(self, limit, period, on_stall):
+        self.limit = limit
+        self.period = period
+        self.stalled = False
+        self._on_stall = on_stall
+        self.received = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stall-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, received):
+        """Sets the number of bytes received so far."""
+        self.received = received
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        start, received = time.time(), self.received
+        while not self._stop.wait(min(1., self.period / 4.)):
+            elapsed = time.time() - start
+            if elapsed < self.period:
+                continue
+            if (self.received - received) / elapsed < self.limit:
+                self.stalled = True
+                self._on_stall()
+                return
+            start, received = time.time(), self.received
+
+
+class AtomicFile(object):
+    """A file written under a temporary name in the directory of its target,
+    and renamed to the target only once complete, so that readers never see a
+    partially written file.
+
+    path: the target file
+    fsync: whether the data is flushed to the disk before the file is renamed
+    resume: whether the temporary file is kept on failure, and reused by the
+            next AtomicFile of the same target to resume the download"""
+
+    def __init__(self, path, fsync=False, resume=False):
+        self.path = path
+        self.fsync = fsync
+        self.resume = resume
+        directory, name = os.path.split(os.path.abspath(path))
+        self._size = 0
+        if resume:
+            self.temp_path = os.path.join(directory, '.%s.part' % name)
+            if os.path.exists(self.temp_path):
+                self._file = open(self.temp_path, 'r+b')
+                self._size = os.path.getsize(self.temp_path)
+                return
+        else:
+            self.temp_path = os.path.join(directory, '.%s.%s.part' % (name, uuid.uuid4().hex[:8]))
+        self._file = open(self.temp_path, 'x+b')
+
+    def written(self):
+        """Returns the size of the temporary file (when resuming). It can be
+        larger than the data actually written if the space was preallocated."""
+        return self._size
+
+    def restart_at(self, offset):
+        """Drops the data after the given offset, and writes from there."""
+        self._file.truncate(offset)
+        self._size = offset
+        self._file.seek(offset)
+
+    def allocate(self, size):
+        """Reserves the disk space of a file of the given size, so that it is
+        not fragmented while growing."""
+        if size <= 0:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._file.fileno(), 0, size)
+            except OSError:
+                # not supported by the file system, the file grows as usual
+                pass
+
+    def write(self, block):
+        self._file.write(block)
+        self._size = max(self._size, self._file.tell())
+
+    def commit(self):
+        """Publishes the file under its target name."""
+        # the allocated size may exceed what has actually been written
+        self._file.truncate(self._size)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.temp_path, self.path)
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def abort(self, discard=False):
+        """Drops the temporary file, unless it is kept to resume the download.
+        The target is left untouched.
+
+        discard: whether the temporary file is dropped even if kept to resume
+                 (cancelled download)"""
+        if self.resume and not discard:
+            # drop what the allocation has added after the data written
+            self._file.truncate(self._size)
+        self._file.close()
+        if (discard or not self.resume) and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class SpillingBuffer(object):
+    """A buffer receiving a download in memory up to a size limit, and spilled
+    into a temporary file beyond. It has the same writing interface as
+    AtomicFile.
+
+    limit: the size (bytes) above which the content is spilled
+    directory: (optional) the directory of the temporary file"""
+
+    def __init__(self, limit=DEFAULT_MEMORY_LIMIT, directory=None):
+        self.limit = limit
+        self.directory = directory
+        self.path = None
+        self._file = io.BytesIO()
+
+    def allocate(self, size):
+        """Spills right away when the announced size exceeds the limit."""
+        if size > self.limit:
+            self._spill()
+
+    def write(self, block):
+        if self.path is None and self._file.tell() + len(block) > self.limit:
+            self._spill()
+        self._file.write(block)
+
+    def commit(self):
+        if self.path is not None:
+            self._file.close()
+
+    def abort(self, discard=False):
+        self._file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def getbuffer(self):
+        """Returns a memoryview on the content kept in memory."""
+        return self._file.getbuffer()
+
+    def _spill(self):
+        if self.path is not None:
+            return
+        fd, self.path = tempfile.mkstemp(suffix='.nc', prefix='motu-', dir=self.directory)
+        spilled = os.fdopen(fd, 'w+b')
+        spilled.write(self._file.getbuffer())
+        self._file = spilled
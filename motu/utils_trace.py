@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python motu client
+#
+# Motu, a high efficient, robust and Standard compliant Web Server for Geographic
+#  Data Dissemination.
+# 
+#  http://cls-motu.sourceforge.net/
+# 
+#  (C) Copyright 2009-2010, by CLS (Collecte Localisation Satellites) -
+#  http://www.cls.fr - and Contributors
+# 
+# 
+#  This library is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+# 
+#  This library is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#  or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+#  License for more details.
+# 
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this library; if not, write to the Free Software Foundation,
+#  Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+import atexit
+import contextlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+# name of the service and of the instrumentation scope of the exported spans
+SERVICE_NAME = 'motu-client'
+
+# most spans written on a line of the trace file
+MAX_BATCH = 512
+
+# span kinds and status codes of OpenTelemetry
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# the exporter of the finished spans, None when tracing is off
+_exporter = None
+_exporter_lock = threading.Lock()
+
+# the spans in progress in each thread, innermost last
+_local = threading.local()
+
+
+class Span(object):
+    """An operation of a request (check, auth, submit, poll, redirect,
+    download...), timed from its start to its end, and part of the trace of
+    the request through its parent span.
+
+    name: the name of the operation
+    parent: (optional) the Span the operation is part of, a new trace being
+            started if not set
+    attributes: (optional) a dictionary describing the operation"""
+
+    def __init__(self, name, parent=None, attributes=None, kind=KIND_INTERNAL):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        """Adds attributes to the span."""
+        self.attributes.update(attributes)
+
+    def finish(self, error=None):
+        """Ends the span, failed if an error (exception or message) is
+        given, and exports it."""
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = str(error) or error.__class__.__name__
+        if _exporter is not None:
+            _exporter.export(self)
+
+    def to_otlp(self):
+        """Returns the span in the OpenTelemetry (OTLP/JSON) format."""
+        span = {'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'name': self.name,
+                'kind': self.kind,
+                'startTimeUnixNano': str(self.start),
+                'endTimeUnixNano': str(self.end),
+                'attributes': _attributes(self.attributes),
+                'status': {'code': STATUS_OK} if self.error is None else {'code': STATUS_ERROR,
+                                                                          'message': self.error}}
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _attributes(values):
+    attributes = []
+    for key, value in sorted(values.items()):
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = {'boolValue': value}
+        elif isinstance(value, int):
+            value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            value = {'doubleValue': value}
+        else:
+            value = {'stringValue': str(value)}
+        attributes.append({'key': key, 'value': value})
+    return attributes
+
+
+class FileExporter(object):
+    """Writes the finished spans into a file from a background thread, as
+    lines of OTLP/JSON (one ExportTraceServiceRequest per line, as written
+    by the file exporter of the OpenTelemetry collector), so that they can
+    be loaded by the usual tracing tools.
+
+    path: the file the spans are appended to"""
+
+    def __init__(self, path):
+        from . import motu_api
+        self.path = path
+        self._resource = {'attributes': _attributes({'service.name': SERVICE_NAME,
+                                                     'service.version': motu_api.get_client_version(),
+                                                     'process.pid': os.getpid()})}
+        self._spans = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='trace-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def export(self, span):
+        self._spans.put(span)
+
+    def close(self):
+        """Writes the spans still queued and stops the thread."""
+        self._spans.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._spans.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._spans.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [span for span in batch if span is not None]
+            if batch:
+                self._write(batch)
+
+    def _write(self, spans):
+        line = json.dumps({'resourceSpans': [{
+            'resource': self._resource,
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME},
+                            'spans': [span.to_otlp() for span in spans]}]}]})
+        try:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+        except (IOError, OSError) as e:
+            logging.getLogger("utils_trace").error("Unable to write the spans into %s: %s", self.path, e)
+
+
+def configure(path):
+    """Exports the spans of the requests into the given file (see
+    FileExporter). Does nothing if path is not set or is already the trace
+    file."""
+    global _exporter
+    if not path:
+        return
+    with _exporter_lock:
+        if _exporter is not None:
+            if _exporter.path == path:
+                return
+            _exporter.close()
+        else:
+            atexit.register(_close)
+        _exporter = FileExporter(path)
+
+
+def _close():
+    with _exporter_lock:
+        if _exporter is not None:
+            _exporter.close()
+
+
+def enabled():
+    """Returns whether the spans are exported (see configure)."""
+    return _exporter is not None
+
+
+def current(_options=None):
+    """Returns the innermost span in progress in the thread, or else the
+    span of the request the given options belong to (the 'trace_span'
+    option, set for the parts of a split request run by other threads),
+    None if there is none."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return getattr(_options, 'trace_span', None) if _options is not None else None
+
+
+@contextlib.contextmanager
+def span(name, _options=None, kind=KIND_INTERNAL, **attributes):
+    """Runs the enclosed operation in a span, child of the current span (see
+    current). The span is given to the block (None when tracing is off),
+    which can add attributes to it, and is failed by an exception."""
+    if _exporter is None:
+        yield None
+        return
+    new = Span(name, current(_options), attributes, kind)
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(new)
+    try:
+        yield new
+    except BaseException as e:
+        stack.pop()
+        new.finish(e)
+        raise
+    stack.pop()
+    new.finish()
+
+
+def instant(name, _options=None, **attributes):
+    """Records an operation without duration (e.g. a redirect) as a span,
+    child of the current span, if tracing is on."""
+    if _exporter is None:
+        return
+    Span(name, current(_options), attributes).finish()
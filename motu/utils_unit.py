@@ -30,6 +30,19 @@
 SI_K, SI_M, SI_G, SI_T = 10 ** 3, 10 ** 6, 10 ** 9, 10 ** 12
 
 
+# multipliers of the size units used by Motu
+SIZE_UNITS = {'b': 1, 'kb': SI_K, 'mb': SI_M, 'gb': SI_G, 'tb': SI_T}
+
+
+def to_bytes(value, unit):
+    """Converts a size expressed in the given unit (b, kb, mb, gb or tb,
+    optionally followed by 'ytes', whatever the case) into bytes."""
+    unit = unit.strip().lower()
+    if unit.endswith('ytes'):
+        unit = unit[:-4]
+    return float(value) * SIZE_UNITS[unit]
+
+
 def convert_bytes(n):
     """Converts the given bytes into a string with the most appropriate
     unit power.
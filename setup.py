@@ -16,6 +16,11 @@ install_requires = [
     "requests"
 ]
 
+extras_require = {
+    "netcdf4": ["xarray", "netCDF4"],
+    "estimate": ["numpy"]
+}
+
 setup(
     name="motu",
     version=version,
@@ -23,4 +28,5 @@ setup(
     include_package_data=False,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
 )
@@ -0,0 +1,153 @@
+import datetime
+import gc
+import http.server
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from motu import motu_api
+
+
+def _options():
+    return motu_api.default_options(motu='http://localhost/motu-web/Motu', auth_mode='none', service_id='S',
+                                    product_id='P', sync=True)
+
+
+def _fake_process_request(content):
+    def process_request(_options, fh):
+        fh.allocate(len(content))
+        fh.write(content)
+        fh.commit()
+        return []
+    return process_request
+
+
+def test_read_request_spilled_dataset_keeps_the_temporary_file_until_closed(tmp_path, monkeypatch):
+    xr = pytest.importorskip('xarray')
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+    content = xr.Dataset({'thetao': (('time',), np.arange(100.0))}).to_netcdf(engine='scipy')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(motu_api, 'process_request', _fake_process_request(content))
+
+    dataset = motu_api.read_request(_options(), memory_limit=10)
+
+    # read lazily from the spilled file, kept until the dataset is closed
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert dataset['thetao'].values.tolist() == list(range(100))
+    assert len(os.listdir(str(tmp_path))) == 1
+    dataset.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_read_request_spilled_dataset_removes_the_temporary_file_when_collected(tmp_path, monkeypatch):
+    xr = pytest.importorskip('xarray')
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+    content = xr.Dataset({'thetao': (('time',), np.arange(100.0))}).to_netcdf(engine='scipy')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(motu_api, 'process_request', _fake_process_request(content))
+
+    dataset = motu_api.read_request(_options(), memory_limit=10)
+    del dataset
+    gc.collect()
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_read_request_in_memory_dataset(tmp_path, monkeypatch):
+    xr = pytest.importorskip('xarray')
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+    content = xr.Dataset({'thetao': (('time',), np.arange(100.0))}).to_netcdf(engine='scipy')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(motu_api, 'process_request', _fake_process_request(content))
+
+    with motu_api.read_request(_options(), memory_limit=len(content)) as dataset:
+        assert dataset['thetao'].values.tolist() == list(range(100))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_read_request_spilled_raw_result_is_left_to_the_caller(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(motu_api, 'process_request', _fake_process_request(b'x' * 100))
+
+    path = motu_api.read_request(_options(), as_dataset=False, memory_limit=10)
+
+    assert os.path.dirname(path) == str(tmp_path)
+    with open(path, 'rb') as f:
+        assert f.read() == b'x' * 100
+
+
+def test_get_size_removes_the_spilled_reply(tmp_path, monkeypatch):
+    reply = b'<statusModeResponse><requestSize size="2048" unit="kb"/></statusModeResponse>'
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(motu_api, 'process_request', _fake_process_request(reply))
+    monkeypatch.setattr(motu_api.utils_stream, 'DEFAULT_MEMORY_LIMIT', 10)
+
+    assert motu_api.get_size(_options()) == 2048000
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_execute_request_shares_the_result_once_transcoded(tmp_path, monkeypatch):
+    events = []
+
+    def process_request(_options, fh):
+        events.append('download')
+        return [fh]
+
+    def coalesce(key, target, function, lock_dir=None, cancel=None):
+        files = function()
+        events.append('share')
+        return files
+    monkeypatch.setattr(motu_api, 'process_request', process_request)
+    monkeypatch.setattr(motu_api.utils_netcdf, 'wait_all', lambda paths=None: events.append('transcoded'))
+    monkeypatch.setattr(motu_api.utils_coalesce, 'coalesce', coalesce)
+    options = _options()
+    options.out_dir, options.out_name = str(tmp_path), 'out.nc'
+
+    assert motu_api.execute_request(options) == [str(tmp_path / 'out.nc')]
+    assert events == ['download', 'transcoded', 'share']
+
+
+def test_dl_2_file_resumes_a_stalled_download(tmp_path):
+    data = bytes(range(256)) * 1000
+    ranges = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            ranges.append(self.headers.get('Range'))
+            start = int(ranges[-1][len('bytes='):-1]) if ranges[-1] else 0
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Type', 'application/x-netcdf')
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            if len(ranges) == 1:
+                # the first connection stalls after 100 kB
+                self.wfile.write(data[:100000])
+                self.wfile.flush()
+                time.sleep(5)
+                return
+            self.wfile.write(data[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    motu_api.init_time = datetime.datetime.now()
+    target = str(tmp_path / 'out.nc')
+    try:
+        motu_api.dl_2_file('http://127.0.0.1:%i/file' % server.server_address[1], target, 65535, True,
+                           speed_limit=1000, speed_time=1)
+    finally:
+        server.shutdown()
+
+    assert ranges == [None, 'bytes=100000-']
+    with open(target, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,59 @@
+import pytest
+
+from motu import motu_cluster
+
+
+@pytest.fixture(params=['sqlite', 'directory'])
+def leases(request, tmp_path):
+    if request.param == 'sqlite':
+        leases = motu_cluster.get_leases(str(tmp_path / 'leases.db'))
+        assert isinstance(leases, motu_cluster.SQLiteLeases)
+        yield leases
+        leases.close()
+    else:
+        leases = motu_cluster.get_leases(str(tmp_path / 'leases') + '/')
+        assert isinstance(leases, motu_cluster.DirectoryLeases)
+        yield leases
+
+
+def test_a_job_is_leased_by_one_worker(leases):
+    assert leases.claim('job', 'a', 60)
+    assert not leases.claim('job', 'b', 60)
+    assert leases.renew('job', 'a', 60)
+    assert not leases.renew('job', 'b', 60)
+    assert leases.get('job')['status'] == motu_cluster.LEASED
+
+
+def test_done_jobs_are_not_run_again(leases):
+    assert leases.claim('job', 'a', 60)
+    leases.complete('job', 'a', ['/data/out.nc'])
+
+    assert not leases.claim('job', 'b', 60)
+    lease = leases.get('job')
+    assert (lease['status'], lease['files']) == (motu_cluster.DONE, ['/data/out.nc'])
+
+
+def test_expired_leases_are_taken_over(leases):
+    # the worker crashed: its lease is not renewed
+    assert leases.claim('job', 'a', -1)
+
+    assert leases.claim('job', 'b', 60)
+    assert not leases.renew('job', 'a', 60)
+    assert leases.get('job')['attempts'] == 2
+
+
+def test_released_leases_are_taken_at_once(leases):
+    assert leases.claim('job', 'a', 60)
+    leases.release('job', 'a')
+
+    assert leases.claim('job', 'b', 60)
+    assert leases.get('job')['attempts'] == 1
+
+
+def test_failed_jobs_are_tried_a_few_times(leases):
+    for attempt in range(motu_cluster.MAX_ATTEMPTS):
+        assert leases.claim('job', 'a', 60)
+        leases.fail('job', 'a', 'failure %i' % attempt)
+        assert leases.get('job')['status'] == motu_cluster.FAILED
+
+    assert not leases.claim('job', 'b', 60)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from motu import motu_scheduler
+
+SERVER = 'http://localhost/motu-web/Motu'
+
+
+def _blocked(scheduler):
+    """Fills the slot of the server with a job waiting for the returned event."""
+    release = threading.Event()
+    scheduler.submit(lambda: release.wait(10), SERVER, name='blocker')
+    return release
+
+
+def _queued(scheduler):
+    return [job['job'] for job in scheduler.report()['queued']]
+
+
+def test_jobs_are_ordered_by_priority_then_size():
+    scheduler = motu_scheduler.Scheduler(max_per_server=1)
+    release = _blocked(scheduler)
+    order = []
+    futures = [scheduler.submit(lambda name=name: order.append(name), SERVER, size, priority, name)
+               for name, size, priority in (('low', 10, motu_scheduler.LOW),
+                                            ('unknown', None, motu_scheduler.NORMAL),
+                                            ('large', 1000, motu_scheduler.NORMAL),
+                                            ('small', 10, motu_scheduler.NORMAL),
+                                            ('high', 1000, motu_scheduler.HIGH))]
+
+    assert _queued(scheduler) == ['high', 'small', 'large', 'unknown', 'low']
+    release.set()
+    for future in futures:
+        future.result(10)
+    assert order == ['high', 'small', 'large', 'unknown', 'low']
+
+
+def test_waiting_jobs_are_promoted():
+    scheduler = motu_scheduler.Scheduler(max_per_server=1, aging=60)
+    release = _blocked(scheduler)
+    scheduler.submit(lambda: None, SERVER, 1000, motu_scheduler.LOW, 'old')
+    scheduler.submit(lambda: None, SERVER, 10, motu_scheduler.NORMAL, 'new')
+    assert _queued(scheduler) == ['new', 'old']
+
+    # waiting for two aging periods promotes a low priority job to high
+    for entry in scheduler._queue:
+        if entry.name == 'old':
+            entry.submitted = time.time() - 130
+    assert _queued(scheduler) == ['old', 'new']
+    assert scheduler.report()['queued'][0]['effective_priority'] == 'high'
+    release.set()
+
+
+def test_jobs_without_server_are_run_immediately():
+    scheduler = motu_scheduler.Scheduler(max_per_server=1)
+    release = _blocked(scheduler)
+
+    assert scheduler.submit(lambda: 'done', name='fan-out').result(10) == 'done'
+    release.set()
+
+
+def test_batch_limits_its_own_jobs():
+    scheduler = motu_scheduler.Scheduler(max_per_server=4)
+    batch = motu_scheduler.Batch(1)
+    release = threading.Event()
+    for i in range(2):
+        scheduler.submit(lambda: release.wait(10), SERVER, name='batch %i' % i, batch=batch)
+    scheduler.submit(lambda: release.wait(10), SERVER, name='other')
+
+    assert [job['job'] for job in scheduler.report()['running']] == ['batch 0', 'other']
+    release.set()
+
+
+def test_parse_priority():
+    assert motu_scheduler.parse_priority(None) == motu_scheduler.NORMAL
+    assert motu_scheduler.parse_priority('High') == motu_scheduler.HIGH
+    assert motu_scheduler.parse_priority(motu_scheduler.LOW) == motu_scheduler.LOW
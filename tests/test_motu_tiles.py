@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from motu import motu_api
+from motu import motu_fanout
+from motu import motu_tiles
+
+np = pytest.importorskip('numpy')
+xr = pytest.importorskip('xarray')
+pytest.importorskip('scipy')
+
+
+def _grid():
+    # both -180 and 180 are points of the grid, as in some products
+    lon = np.arange(-180.0, 180.5, 1.0)
+    lat = np.arange(-20.0, 20.5, 1.0)
+    values = lon[None, :] * 1000 + lat[:, None]
+    return xr.Dataset({'thetao': (('lat', 'lon'), values)}, coords={'lat': lat, 'lon': lon})
+
+
+def _fake_run_jobs(grid):
+    def run_jobs(jobs, *args, **kwargs):
+        files = []
+        for job in jobs:
+            # the server returns the points on the edges of the box
+            tile = grid.sel(lon=slice(job.longitude_min, job.longitude_max),
+                            lat=slice(job.latitude_min, job.latitude_max))
+            path = os.path.join(job.out_dir, job.out_name)
+            tile.to_netcdf(path, engine='scipy')
+            files.append(path)
+        return files
+    return run_jobs
+
+
+@pytest.mark.parametrize('x_lo, x_hi, tile_size', [
+    (170, -170, None),
+    (170, -170, 5),
+    (-30, 30, 7),
+])
+def test_stitched_coordinates_are_strictly_monotonic(tmp_path, monkeypatch, x_lo, x_hi, tile_size):
+    grid = _grid()
+    monkeypatch.setattr(motu_fanout, 'run_jobs', _fake_run_jobs(grid))
+    options = motu_api.default_options(motu='http://localhost/motu-web/Motu', service_id='S', product_id='P', auth_mode='none',
+                                       longitude_min=x_lo, longitude_max=x_hi, latitude_min=-10,
+                                       latitude_max=10, out_dir=str(tmp_path), out_name='data.nc',
+                                       tile_size=tile_size)
+    motu_api.check_options(options)
+    assert motu_tiles.needs_tiling(options)
+
+    files = motu_tiles.execute_tiled_request(options)
+
+    assert files == [str(tmp_path / 'data.nc')]
+    with xr.open_dataset(files[0]) as stitched:
+        lon = stitched['lon'].values
+        lat = stitched['lat'].values
+        assert (np.diff(lon) > 0).all()
+        assert (np.diff(lat) > 0).all()
+        expected_lon = np.arange(x_lo, (x_hi if x_hi > x_lo else x_hi + 360) + 0.5, 1.0)
+        assert lon.tolist() == expected_lon.tolist()
+        assert lat.tolist() == np.arange(-10.0, 10.5, 1.0).tolist()
+    assert os.listdir(str(tmp_path)) == ['data.nc']
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import pytest
+
+from motu import motu_api
+from motu import utils_cancel
+from motu import utils_coalesce
+
+
+def _download(calls, started=None, release=None):
+    def function(target):
+        def run():
+            calls.append(target)
+            if started is not None:
+                started.set()
+                release.wait(10)
+            with open(target, 'w') as f:
+                f.write('data')
+            return [target]
+        return run
+    return function
+
+
+def test_identical_requests_share_a_single_result(tmp_path):
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    function = _download(calls, started, release)
+    results = {}
+
+    def request(name):
+        target = str(tmp_path / name)
+        results[name] = utils_coalesce.coalesce('key', target, function(target))
+
+    leader = threading.Thread(target=request, args=('a.nc',))
+    leader.start()
+    started.wait(10)
+    follower = threading.Thread(target=request, args=('b.nc',))
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    leader.join(10)
+    follower.join(10)
+
+    assert calls == [str(tmp_path / 'a.nc')]
+    assert results == {'a.nc': [str(tmp_path / 'a.nc')], 'b.nc': [str(tmp_path / 'b.nc')]}
+    assert (tmp_path / 'b.nc').read_text() == 'data'
+
+
+def test_processes_share_a_result_through_the_lock_directory(tmp_path):
+    pytest.importorskip('fcntl')
+    lock_dir = str(tmp_path / 'locks')
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    function = _download(calls, started, release)
+    results = {}
+
+    # _run_locked opens its own lock file, as another process would
+    def request(name):
+        target = str(tmp_path / name)
+        results[name] = utils_coalesce._run_locked('key', target, function(target), lock_dir)
+
+    leader = threading.Thread(target=request, args=('a.nc',))
+    leader.start()
+    started.wait(10)
+    follower = threading.Thread(target=request, args=('b.nc',))
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    leader.join(10)
+    follower.join(10)
+
+    assert calls == [str(tmp_path / 'a.nc')]
+    assert results['b.nc'] == [str(tmp_path / 'b.nc')]
+    # the lock file is removed once the result is published
+    assert not os.path.exists(os.path.join(lock_dir, 'key.lock'))
+
+
+def test_lock_directory_runs_later_requests_again(tmp_path):
+    pytest.importorskip('fcntl')
+    lock_dir = str(tmp_path / 'locks')
+    calls = []
+    target = str(tmp_path / 'a.nc')
+
+    utils_coalesce._run_locked('key', target, _download(calls)(target), lock_dir)
+    utils_coalesce._run_locked('key', target, _download(calls)(target), lock_dir)
+
+    assert len(calls) == 2
+    assert os.listdir(lock_dir) == ['key.json']
+
+
+@pytest.mark.parametrize('lock_dir', [False, True])
+def test_cancelled_follower_stops_waiting(tmp_path, lock_dir):
+    if lock_dir:
+        pytest.importorskip('fcntl')
+    # the follower waits for the leader in the process, or on the lock file
+    run = utils_coalesce._run_locked if lock_dir else utils_coalesce.coalesce
+    lock_dir = str(tmp_path / 'locks') if lock_dir else None
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    function = _download(calls, started, release)
+    target = str(tmp_path / 'a.nc')
+    leader = threading.Thread(target=run, args=('key', target, function(target), lock_dir))
+    leader.start()
+    started.wait(10)
+
+    token = utils_cancel.CancelToken()
+    token.cancel_after(0.2)
+    begin = time.time()
+    with pytest.raises(utils_cancel.Cancelled):
+        run('key', str(tmp_path / 'b.nc'), function(str(tmp_path / 'b.nc')), lock_dir, token)
+    assert time.time() - begin < 5
+    release.set()
+    leader.join(10)
+    assert calls == [target]
+
+
+def test_share_renames_the_parts(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    files = []
+    for name in ('data.nc', 'data_0.nc', 'data_1.nc', 'data_old.txt'):
+        (source / name).write_text(name)
+        files.append(str(source / name))
+
+    copies = utils_coalesce.share(str(source / 'data.nc'), files, str(tmp_path / 'out.nc'))
+
+    assert copies == [str(tmp_path / name) for name in ('out.nc', 'out_0.nc', 'out_1.nc', 'data_old.txt')]
+    assert (tmp_path / 'out_1.nc').read_text() == 'data_1.nc'
+
+
+def test_coalesce_key_depends_on_the_user(tmp_path):
+    def options(user):
+        options = motu_api.default_options(motu='http://localhost/motu-web/Motu', auth_mode='cas', user=user,
+                                           pwd='secret', service_id='S', product_id='P', out_dir=str(tmp_path),
+                                           out_name='out.nc')
+        motu_api.check_options(options)
+        return options
+
+    assert motu_api.coalesce_key(options('john')) == motu_api.coalesce_key(options('john'))
+    assert motu_api.coalesce_key(options('john')) != motu_api.coalesce_key(options('jane'))
+    assert motu_api.request_key(options('john')) == motu_api.request_key(options('jane'))
@@ -0,0 +1,67 @@
+import pytest
+
+from motu import utils_estimate
+from motu import utils_metadata
+
+np = pytest.importorskip('numpy')
+
+DAY = 86400
+
+
+def _grid():
+    return utils_metadata.ProductGrid('S', 'P', lon=utils_metadata.Axis(-180.0, 179.75, 0.25),
+                                      lat=utils_metadata.Axis(-80.0, 90.0, 0.25), depths=[0.5, 1.5, 5.0],
+                                      times=[(0, DAY * 9, DAY)], variables=['uo', 'vo'])
+
+
+def _cells_size(cells, variables=1, factor=1.):
+    return cells * variables * utils_estimate.BYTES_PER_VALUE * factor + utils_estimate.HEADER_BYTES
+
+
+def test_estimate():
+    # 5 x 5 points, 2 depths, 3 days, 1 variable
+    size = utils_estimate.estimate(_grid(), 0, 1, 0, 1, 1, 5, DAY, DAY * 3, ['uo'])
+
+    assert size == _cells_size(5 * 5 * 2 * 3)
+
+
+def test_estimate_across_the_antimeridian():
+    size = utils_estimate.estimate(_grid(), 179.5, -179.5, 0, 0, variables=1)
+
+    assert size == _cells_size(5 * 1 * 3 * 10)
+
+
+def test_estimate_arrays():
+    sizes = utils_estimate.estimate(_grid(), 0, np.array([1, 2]), 0, 1, variables=1)
+
+    assert sizes.tolist() == [_cells_size(5 * 5 * 30), _cells_size(9 * 5 * 30)]
+
+
+def test_calibration(tmp_path):
+    cache_dir = str(tmp_path)
+    assert utils_estimate.calibration_factor(cache_dir, 'S', 'P') == 1.
+
+    estimated = _cells_size(1000)
+    utils_estimate.calibrate(cache_dir, 'S', 'P', estimated, _cells_size(2000))
+    assert utils_estimate.calibration_factor(cache_dir, 'S', 'P') == pytest.approx(2.)
+    utils_estimate.calibrate(cache_dir, 'S', 'P', estimated, _cells_size(1000))
+    assert utils_estimate.calibration_factor(cache_dir, 'S', 'P') == pytest.approx(1.5)
+    assert utils_estimate.calibration_factor(cache_dir, 'S', 'other') == 1.
+
+
+def test_calibration_follows_the_latest_samples(tmp_path):
+    cache_dir = str(tmp_path)
+    estimated = _cells_size(1000)
+    for _ in range(utils_estimate.CALIBRATION_SAMPLES):
+        utils_estimate.calibrate(cache_dir, 'S', 'P', estimated, _cells_size(1000))
+    for _ in range(utils_estimate.CALIBRATION_SAMPLES * 5):
+        utils_estimate.calibrate(cache_dir, 'S', 'P', estimated, _cells_size(3000))
+
+    assert utils_estimate.calibration_factor(cache_dir, 'S', 'P') > 2.9
+
+
+def test_estimate_request_offline(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_metadata, 'get_product_grid', lambda _options, cache_dir, offline: None)
+    options = type('Options', (), {'service_id': 'S', 'product_id': 'P'})()
+
+    assert utils_estimate.estimate_request(options, str(tmp_path), offline=True) is None
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from motu import utils_cancel
+from motu import utils_governor
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = utils_governor.TokenBucket(rate=1000, burst=100)
+    start = time.time()
+    for _ in range(5):
+        bucket.consume(100)
+
+    # the first 100 bytes come from the full bucket, the next 400 at 1000 bytes/s
+    assert 0.3 < time.time() - start < 2
+
+
+def test_token_bucket_without_limit():
+    bucket = utils_governor.TokenBucket()
+    start = time.time()
+    bucket.consume(10 ** 9)
+
+    assert time.time() - start < 0.1
+
+
+def test_host_limiter_limits_the_connections():
+    limiter = utils_governor.HostLimiter('localhost', limit=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def connect():
+        limiter.acquire()
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        limiter.release()
+
+    threads = [threading.Thread(target=connect) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert peak[0] == 2
+    assert limiter.active == 0
+
+
+def test_adaptive_limiter_backs_off_on_errors():
+    limiter = utils_governor.HostLimiter('localhost', limit=8, adaptive=True)
+    limiter.report(1.0, error=True)
+
+    assert limiter.limit == 4
+
+
+def test_slot_wait_is_cancelled():
+    governor = utils_governor.Governor()
+    governor.configure(max_per_host=1)
+    token = utils_cancel.CancelToken()
+    with governor.slot('http://localhost/motu-web/Motu'):
+        token.cancel_after(0.2)
+        with pytest.raises(utils_cancel.Cancelled):
+            with governor.slot('http://localhost/motu-web/Motu', token):
+                pass
+
+    assert governor.stats()['hosts']['localhost']['active'] == 0
@@ -0,0 +1,45 @@
+import pytest
+
+from motu import utils_journal
+
+
+def test_record_and_get(tmp_path):
+    journal = utils_journal.Journal(str(tmp_path / 'journal.db'))
+    assert journal.get('key') is None
+
+    journal.record('key', request=[['product', 'P']], target='out.nc', status=utils_journal.SUBMITTED)
+    journal.record('key', status=utils_journal.DOWNLOADING, bytes=1024)
+
+    job = journal.get('key')
+    assert job['request'] == [['product', 'P']]
+    assert (job['target'], job['status'], job['bytes']) == ('out.nc', utils_journal.DOWNLOADING, 1024)
+    assert job['created'] <= job['updated']
+    journal.close()
+
+
+def test_jobs_survive_the_process(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = utils_journal.Journal(path)
+    journal.record('a', status=utils_journal.DONE)
+    journal.record('b', status=utils_journal.DOWNLOADING, remote_uri='http://localhost/file', bytes=10)
+    journal.close()
+
+    journal = utils_journal.Journal(path)
+    assert [job['key'] for job in journal.jobs()] == ['a', 'b']
+    assert [job['key'] for job in journal.jobs(utils_journal.PENDING)] == ['b']
+    journal.close()
+
+
+def test_record_rejects_unknown_fields(tmp_path):
+    journal = utils_journal.Journal(str(tmp_path / 'journal.db'))
+
+    with pytest.raises(ValueError):
+        journal.record('key', unknown=1)
+    journal.close()
+
+
+def test_get_journal_is_shared(tmp_path):
+    path = str(tmp_path / 'journal.db')
+
+    assert utils_journal.get_journal(None) is None
+    assert utils_journal.get_journal(path) is utils_journal.get_journal(path)
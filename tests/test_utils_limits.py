@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from motu import motu_api
+from motu import motu_scheduler
+from motu import utils_limits
+
+MB = 1000 * 1000
+
+
+def test_size_limits(tmp_path):
+    limits = utils_limits.SizeLimits(str(tmp_path / 'limits.db'))
+    assert limits.allowed('server', 'S') is None
+
+    limits.record('server', 'S', 100 * MB)
+    assert limits.allowed('server', 'S') == 100 * MB
+    assert limits.allowed('server', 'other') is None
+    limits.close()
+
+    # learned limits are kept in the file
+    limits = utils_limits.SizeLimits(str(tmp_path / 'limits.db'))
+    assert limits.allowed('server', 'S') == 100 * MB
+    limits.close()
+
+
+def test_size_limits_expire(monkeypatch):
+    limits = utils_limits.SizeLimits()
+    limits.record('server', 'S', 100 * MB)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + utils_limits.DEFAULT_MAX_AGE + 1)
+
+    assert limits.allowed('server', 'S') is None
+
+
+def _presplit(tmp_path, monkeypatch, offline, getsize):
+    limits_file = str(tmp_path / 'limits.db')
+    utils_limits.get_limits(limits_file).record('localhost', 'S', 100 * MB)
+    requests = []
+
+    def estimate_size(_options, source):
+        requests.append(source)
+        return getsize
+    monkeypatch.setattr(motu_scheduler, 'estimate_offline', lambda _options: offline)
+    monkeypatch.setattr(motu_scheduler, 'estimate_size', estimate_size)
+    options = motu_api.default_options(motu='http://localhost/motu-web/Motu', service_id='S', product_id='P',
+                                       date_min='2020-01-01', date_max='2020-01-31', limits_file=limits_file)
+    return motu_api.presplit_parts(options), requests
+
+
+@pytest.mark.parametrize('offline, getsize, parts, requests', [
+    # far below the limit: no getSize request
+    (10 * MB, None, 1, []),
+    # near the limit: checked with a getSize request
+    (80 * MB, 50 * MB, 1, [motu_scheduler.ESTIMATES_GETSIZE]),
+    (120 * MB, 200 * MB, 3, [motu_scheduler.ESTIMATES_GETSIZE]),
+    # unknown
+    (None, 200 * MB, 3, [motu_scheduler.ESTIMATES_GETSIZE]),
+    # far above the limit: split from the offline estimate
+    (500 * MB, None, 6, []),
+])
+def test_presplit_parts(tmp_path, monkeypatch, offline, getsize, parts, requests):
+    assert _presplit(tmp_path, monkeypatch, offline, getsize) == (parts, requests)
+
+
+def test_presplit_parts_bounded_by_the_days(tmp_path, monkeypatch):
+    parts, _ = _presplit(tmp_path, monkeypatch, 100000 * MB, None)
+
+    assert parts == 31
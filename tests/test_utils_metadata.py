@@ -0,0 +1,84 @@
+import copy
+
+from motu import motu_api
+from motu import utils_metadata
+
+
+def _grid(lon=None):
+    return utils_metadata.ProductGrid('S', 'P', lon=lon or utils_metadata.Axis(-180.0, 180.0, 0.25),
+                                      lat=utils_metadata.Axis(-80.0, 90.0, 0.25), depths=[0.5, 1.5, 5.0, 10.0],
+                                      times=[(0, 86400 * 9, 86400)])
+
+
+def _options(tmp_path, **values):
+    options = motu_api.default_options(motu='http://localhost/motu-web/Motu', auth_mode='none', service_id='S',
+                                       product_id='P', out_dir=str(tmp_path), out_name='out.nc', snap_to_grid=True,
+                                       **values)
+    motu_api.check_options(options)
+    return options
+
+
+def test_snap_to_axis():
+    assert utils_metadata.snap_to_axis(10.1, -180.0, 0.25, True) == 10.25
+    assert utils_metadata.snap_to_axis(10.1, -180.0, 0.25, False) == 10.0
+    # within the tolerance of a point
+    assert utils_metadata.snap_to_axis(10.2500001, -180.0, 0.25, False) == 10.25
+
+
+def test_snap_to_times():
+    day = 86400
+    assert utils_metadata.snap_to_times(day / 2, [(0, day * 9, day)], True) == day
+    assert utils_metadata.snap_to_times(day / 2, [(0, day * 9, day)], False) == 0
+    assert utils_metadata.snap_to_times(day * 10, [(0, day * 9, day)], True) is None
+
+
+def test_snap_request(tmp_path):
+    options = _options(tmp_path, longitude_min=10.1, longitude_max=20.9, latitude_min=-5.1, latitude_max=5.1,
+                       depth_min=1, depth_max=6, date_min='1970-01-01 12:00:00', date_max='1970-01-05 12:00:00',
+                       variable=['vo', 'uo', 'vo'])
+
+    utils_metadata.snap_request(options, _grid())
+
+    assert (options.longitude_min, options.longitude_max) == (10.25, 20.75)
+    assert (options.latitude_min, options.latitude_max) == (-5.0, 5.0)
+    assert (options.depth_min, options.depth_max) == (1.5, 5.0)
+    assert (options.date_min, options.date_max) == ('1970-01-02', '1970-01-05')
+    assert options.variable == ['uo', 'vo']
+
+
+def test_snap_request_selecting_no_point_is_kept(tmp_path):
+    options = _options(tmp_path, longitude_min=10.1, longitude_max=10.2, latitude_min=0, latitude_max=1)
+
+    utils_metadata.snap_request(options, _grid())
+
+    assert (options.longitude_min, options.longitude_max) == (10.1, 10.2)
+
+
+def test_snap_request_without_axis_origin(tmp_path):
+    options = _options(tmp_path, longitude_min=10.1, longitude_max=20.9, latitude_min=0, latitude_max=1)
+
+    utils_metadata.snap_request(options, _grid(lon=utils_metadata.Axis(None, None, 0.25)))
+
+    assert (options.longitude_min, options.longitude_max) == (10.1, 20.9)
+
+
+def test_normalize_request_snaps_copies_with_other_bounds(tmp_path, monkeypatch):
+    described = []
+
+    def get_product_grid(_options, cache_dir=None):
+        described.append(_options.product_id)
+        return _grid()
+    monkeypatch.setattr(utils_metadata, 'get_product_grid', get_product_grid)
+    options = _options(tmp_path, longitude_min=10.1, longitude_max=20.9, latitude_min=0, latitude_max=1)
+
+    motu_api.normalize_request(options)
+    motu_api.normalize_request(options)
+    assert (options.longitude_min, options.longitude_max) == (10.25, 20.75)
+    assert len(described) == 1
+
+    # a tile of the request, with bounds of its own
+    tile = copy.copy(options)
+    tile.longitude_min, tile.longitude_max = 15.1, 20.75
+    motu_api.normalize_request(tile)
+    assert (tile.longitude_min, tile.longitude_max) == (15.25, 20.75)
+    assert len(described) == 2
@@ -0,0 +1,56 @@
+import pytest
+
+from motu import utils_polling
+
+
+def test_schedule_without_history():
+    schedule = utils_polling.PollSchedule()
+
+    assert schedule.first_delay(0) == 0
+    assert schedule.next_delay(100) == utils_polling.DEFAULT_INTERVAL
+
+
+def test_schedule_predicted_from_the_durations():
+    schedule = utils_polling.PollSchedule([60, 50, 70, 80, 100])
+    early = 58 * utils_polling.EARLY_MARGIN
+
+    # nothing is requested before the early ready time
+    assert schedule.first_delay(0) == pytest.approx(early)
+    assert schedule.first_delay(10) == pytest.approx(early - 10)
+    # then often until the late ready time
+    assert schedule.next_delay(early + 1) == utils_polling.DENSE_INTERVAL
+    # then less and less often
+    assert utils_polling.DENSE_INTERVAL < schedule.next_delay(100) < utils_polling.DEFAULT_INTERVAL
+    assert schedule.next_delay(1000) == utils_polling.DEFAULT_INTERVAL
+
+
+def test_size_bucket():
+    assert utils_polling.size_bucket(None) is None
+    assert utils_polling.size_bucket(1024) == utils_polling.size_bucket(2047) == 10
+    assert utils_polling.size_bucket(2048) == 11
+
+
+def test_history_uses_the_bucket_then_the_product(tmp_path):
+    history = utils_polling.PollHistory(str(tmp_path / 'history.db'))
+    assert not history.schedule('S', 'P', 10).predicted
+
+    for duration in (10, 20, 30):
+        history.record('S', 'P', 10, duration)
+    for duration in (100, 200, 300):
+        history.record('S', 'P', 20, duration)
+
+    assert history.schedule('S', 'P', 10).late == pytest.approx(28)
+    assert history.schedule('S', 'P', 20).late == pytest.approx(280)
+    # too few durations of the bucket: all the durations of the product
+    assert history.schedule('S', 'P', 15).late == pytest.approx(250)
+    assert not history.schedule('S', 'other', 10).predicted
+    history.close()
+
+
+def test_history_keeps_a_bounded_number_of_durations(tmp_path):
+    history = utils_polling.PollHistory(str(tmp_path / 'history.db'))
+    for duration in range(utils_polling.HISTORY_SIZE + 10):
+        history.record('S', 'P', None, duration)
+
+    assert len(history.durations('S', 'P')) == utils_polling.HISTORY_SIZE
+    history.close()
@@ -0,0 +1,82 @@
+import io
+import os
+
+from motu import utils_stream
+
+
+def _temp_files(directory):
+    return [name for name in os.listdir(str(directory)) if name.endswith('.part')]
+
+
+def test_atomic_file_is_published_once_complete(tmp_path):
+    target = tmp_path / 'out.nc'
+    atomic = utils_stream.AtomicFile(str(target))
+    atomic.allocate(100)
+    atomic.write(b'data')
+
+    # readers never see a partial file
+    assert not target.exists()
+    atomic.commit()
+
+    # the allocated space beyond the data written is dropped
+    assert target.read_bytes() == b'data'
+    assert _temp_files(tmp_path) == []
+
+
+def test_atomic_file_abort_leaves_the_target(tmp_path):
+    target = tmp_path / 'out.nc'
+    target.write_bytes(b'previous')
+    atomic = utils_stream.AtomicFile(str(target))
+    atomic.write(b'data')
+    atomic.abort()
+
+    assert target.read_bytes() == b'previous'
+    assert _temp_files(tmp_path) == []
+
+
+def test_atomic_file_resumes_from_the_kept_data(tmp_path):
+    target = tmp_path / 'out.nc'
+    atomic = utils_stream.AtomicFile(str(target), resume=True)
+    atomic.allocate(10)
+    atomic.write(b'01234')
+    atomic.abort()
+    assert len(_temp_files(tmp_path)) == 1
+
+    atomic = utils_stream.AtomicFile(str(target), resume=True)
+    assert atomic.written() == 5
+    atomic.restart_at(3)
+    atomic.write(b'3456789')
+    atomic.commit()
+
+    assert target.read_bytes() == b'0123456789'
+    assert _temp_files(tmp_path) == []
+
+
+def test_atomic_file_discarded_when_cancelled(tmp_path):
+    atomic = utils_stream.AtomicFile(str(tmp_path / 'out.nc'), resume=True)
+    atomic.write(b'01234')
+    atomic.abort(True)
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spilling_buffer(tmp_path):
+    buffer = utils_stream.SpillingBuffer(8, str(tmp_path))
+    buffer.write(b'0123')
+    assert buffer.path is None
+    assert bytes(buffer.getbuffer()) == b'0123'
+
+    buffer.write(b'456789')
+    buffer.commit()
+    with open(buffer.path, 'rb') as f:
+        assert f.read() == b'0123456789'
+    os.remove(buffer.path)
+
+
+def test_copy():
+    received = []
+    target = io.BytesIO()
+
+    assert utils_stream.copy(io.BytesIO(b'0123456789'), target, received.append, block_size=4) == 10
+    assert target.getvalue() == b'0123456789'
+    assert received == [4, 8, 10]